@@ -3,25 +3,42 @@ from discord.ext import commands
 import json
 import os
 from datetime import datetime
-from flask import Flask
-from threading import Thread
+import aiohttp
+from aiohttp import web
+from threading import Lock, Thread, get_ident
+import sys
+import traceback
+from collections import deque
 import time
-app = Flask(__name__)
+import heapq
+import bisect
+import itertools
+import gzip
+import zlib
+import contextvars
+import re
+import inspect
+import tempfile
+routes = web.RouteTableDef()
 
 # Firebase関連のコードを削除し、ローカルファイルベースのデータストレージを使用
 db = None  # Firebaseは使用しません
 
-@app.route('/')
-def home():
-    return "Discord Bot is running!"
+@routes.get('/')
+async def home(request):
+    return web.Response(text="Discord Bot is running!")
 
-@app.route('/health')
-def health():
-    return {"status": "healthy", "bot": "running"}
+bot_start_error = None  # set when the Discord client stops; the HTTP server keeps running
 
-@app.route('/admin')
-def admin_panel():
-    return '''
+@routes.get('/health')
+async def health(request):
+    if bot_start_error:
+        return web.json_response({"status": "unhealthy", "bot": "stopped", "error": bot_start_error}, status=503)
+    return web.json_response({"status": "healthy", "bot": "running" if bot.is_ready() else "starting"})
+
+@routes.get('/admin')
+async def admin_panel(request):
+    return web.Response(content_type='text/html', text='''
 <!DOCTYPE html>
 <html lang="ja">
 <head>
@@ -277,6 +294,15 @@ def admin_panel():
             color: #ccc;
             font-size: 12px;
         }
+        
+        .live-events {
+            max-height: 200px;
+            overflow-y: auto;
+            font-size: 13px;
+        }
+        .live-events p {
+            margin: 4px 0;
+        }
     </style>
 </head>
 <body>
@@ -287,6 +313,11 @@ def admin_panel():
             <!-- Statistics will be loaded here -->
         </div>
         
+        <div class="stat-card" style="margin-bottom: 30px;">
+            <h3>📡 ライブイベント <span id="streamStatus" style="font-size: 12px;">接続中...</span></h3>
+            <div class="live-events" id="liveEvents"></div>
+        </div>
+        
         <div class="control-panel">
             <h3>📊 リアルタイム統計</h3>
             <button onclick="refreshStats()">🔄 統計を更新</button>
@@ -303,6 +334,8 @@ def admin_panel():
             
             <div class="form-group">
                 <h4>👥 ユーザー管理</h4>
+                <input type="text" id="userSearch" placeholder="ユーザー名 (前方一致) またはIDで検索" oninput="searchUsers()">
+                <div id="userSearchResults"></div>
                 <input type="text" id="userId" placeholder="ユーザーID">
                 <input type="text" id="guildId" placeholder="サーバーID">
                 <input type="number" id="warnCount" placeholder="警告回数" min="0" max="10">
@@ -310,6 +343,37 @@ def admin_panel():
                 <button onclick="resetUserLevel()" class="warning-btn">レベルリセット</button>
             </div>
             
+            <div class="form-group">
+                <h4>📥 データエクスポート</h4>
+                <input type="text" id="exportGuildId" placeholder="サーバーID (空欄で全サーバー)">
+                <select id="exportSection">
+                    <option value="">全セクション</option>
+                    <option value="levels">レベル</option>
+                    <option value="warnings">警告</option>
+                    <option value="tickets">チケット</option>
+                    <option value="polls">投票</option>
+                </select>
+                <input type="datetime-local" id="exportSince" title="この日時以降のデータのみ">
+                <select id="exportFormat">
+                    <option value="json">JSON</option>
+                    <option value="jsonl">JSONL (1行1レコード)</option>
+                </select>
+                <label><input type="checkbox" id="exportGzip" checked> gzip圧縮</label>
+                <button onclick="exportData()" class="warning-btn">エクスポート</button>
+            </div>
+            
+            <div class="form-group">
+                <h4>📤 データインポート</h4>
+                <input type="file" id="importFile" accept=".json,.jsonl,.gz">
+                <select id="importStrategy">
+                    <option value="overwrite">上書き</option>
+                    <option value="keep-max-xp">XPが多い方を保持</option>
+                    <option value="append-warnings">警告履歴を追加</option>
+                </select>
+                <button onclick="importData()" class="warning-btn">インポート</button>
+                <small id="importStatus"></small>
+            </div>
+            
             <div class="form-group">
                 <h4>🌐 サーバー管理</h4>
                 <input type="text" id="serverId" placeholder="サーバーID">
@@ -322,7 +386,30 @@ def admin_panel():
         <div class="control-panel">
             <h3>🌐 サーバー管理</h3>
             <div id="serverManagement">
-                <!-- Server management will be loaded here -->
+                <input type="text" id="serverSearch" placeholder="サーバー名 (前方一致) またはID" oninput="loadServers(0)">
+                <select id="serverSort" onchange="loadServers(0)">
+                    <option value="-members">メンバー数 (多い順)</option>
+                    <option value="members">メンバー数 (少ない順)</option>
+                    <option value="name">サーバー名</option>
+                </select>
+                <h4 id="serverListInfo">🌐 Bot参加サーバー一覧</h4>
+                <table>
+                    <thead>
+                        <tr>
+                            <th>サーバー名</th>
+                            <th>サーバーID</th>
+                            <th>メンバー数</th>
+                            <th>オーナー</th>
+                            <th>作成日</th>
+                            <th>許可状態</th>
+                            <th>Bot権限</th>
+                            <th>操作</th>
+                        </tr>
+                    </thead>
+                    <tbody id="serverTableBody"></tbody>
+                </table>
+                <button id="serverPrev" onclick="loadServers(serverOffset - SERVER_PAGE_SIZE)">◀ 前へ</button>
+                <button id="serverNext" onclick="loadServers(serverOffset + SERVER_PAGE_SIZE)">次へ ▶</button>
             </div>
         </div>
         
@@ -339,7 +426,14 @@ def admin_panel():
             fetch('/admin/stats')
                 .then(response => response.json())
                 .then(data => {
+                    if (data.error && data.server_count === undefined) {
+                        // Snapshot not published yet right after startup
+                        console.warn(data.error);
+                        return;
+                    }
+                    currentStats = data;
                     updateStatsDisplay(data);
+                    loadServers();
                 })
                 .catch(error => {
                     console.error('Error:', error);
@@ -365,7 +459,7 @@ def admin_panel():
             modal.innerHTML = `
                 <div class="modal-content">
                     <div class="modal-header">
-                        <h3>🌐 ${serverName} - サーバー設定</h3>
+                        <h3 class="modal-title"></h3>
                         <button class="close-btn" onclick="closeModal(this)">&times;</button>
                     </div>
                     <div class="modal-body">
@@ -450,6 +544,15 @@ def admin_panel():
                                 <small>これらのチャンネルでは連投対策を無効化</small>
                             </div>
                         </div>
+
+                        <div class="settings-section">
+                            <h4>🎫 チケット設定</h4>
+                            <div class="form-group">
+                                <label>サポートスタッフロール (ロール名をカンマ区切りで入力):</label>
+                                <input type="text" id="ticketStaffRoles_${serverId}" value="${(settings.ticket_staff_roles || []).join(', ')}" placeholder="例: サポート, モデレーター">
+                                <small>これらのロールは作成されたチケットチャンネルを閲覧・発言できます</small>
+                            </div>
+                        </div>
                     </div>
                     <div class="modal-footer">
                         <button onclick="saveServerSettings('${serverId}')" class="btn-primary">💾 設定を保存</button>
@@ -458,6 +561,7 @@ def admin_panel():
                     </div>
                 </div>
             `;
+            modal.querySelector('.modal-title').textContent = `🌐 ${serverName} - サーバー設定`;
             return modal;
         }
 
@@ -474,7 +578,8 @@ def admin_panel():
                 log_spam_detection: document.getElementById(`logSpamDetection_${serverId}`).checked,
                 dm_notify_user: document.getElementById(`dmNotifyUser_${serverId}`).checked,
                 excluded_roles: document.getElementById(`excludedRoles_${serverId}`).value.split(',').map(s => s.trim()).filter(s => s),
-                excluded_channels: document.getElementById(`excludedChannels_${serverId}`).value.split(',').map(s => s.trim()).filter(s => s)
+                excluded_channels: document.getElementById(`excludedChannels_${serverId}`).value.split(',').map(s => s.trim()).filter(s => s),
+                ticket_staff_roles: document.getElementById(`ticketStaffRoles_${serverId}`).value.split(',').map(s => s.trim()).filter(s => s)
             };
 
             fetch(`/admin/server_settings/${serverId}`, {
@@ -569,45 +674,6 @@ def admin_panel():
                 </div>
             `;
 
-            const serverManagement = document.getElementById('serverManagement');
-            serverManagement.innerHTML = `
-                <h4>🌐 Bot参加サーバー一覧 (${data.all_servers.length}サーバー)</h4>
-                <table>
-                    <tr>
-                        <th>サーバー名</th>
-                        <th>サーバーID</th>
-                        <th>メンバー数</th>
-                        <th>オーナー</th>
-                        <th>作成日</th>
-                        <th>許可状態</th>
-                        <th>Bot権限</th>
-                        <th>操作</th>
-                    </tr>
-                    ${data.all_servers.map(server => 
-                        `<tr>
-                            <td>${server.name}</td>
-                            <td><code>${server.id}</code></td>
-                            <td>${server.members}</td>
-                            <td>${server.owner}</td>
-                            <td>${server.created}</td>
-                            <td>
-                                <span class="status-indicator ${server.is_allowed ? 'online' : 'offline'}"></span>
-                                ${server.is_allowed ? '許可済み' : '未許可'}
-                            </td>
-                            <td>${server.bot_permissions}</td>
-                            <td>
-                                <button onclick="showServerSettings('${server.id}', '${server.name.replace(/'/g, '\\\'')}')" class="btn-settings" style="margin:2px;">⚙️ 設定</button><br>
-                                <button onclick="leaveSpecificServer('${server.id}')" class="danger-btn" style="margin:2px;">離脱</button>
-                                ${!server.is_allowed ? 
-                                    `<button onclick="allowServer('${server.id}')" style="margin:2px;">許可</button>` : 
-                                    `<button onclick="disallowServer('${server.id}')" class="warning-btn" style="margin:2px;">許可削除</button>`
-                                }
-                            </td>
-                        </tr>`
-                    ).join('')}
-                </table>
-            `;
-
             const detailedStats = document.getElementById('detailedStats');
             detailedStats.innerHTML = `
                 <h4>📋 上位アクティブサーバー</h4>
@@ -628,6 +694,122 @@ def admin_panel():
             `;
         }
 
+        let serverOffset = 0;
+        const SERVER_PAGE_SIZE = 50;
+
+        function loadServers(offset) {
+            if (offset !== undefined) {
+                serverOffset = Math.max(0, offset);
+            }
+            const params = new URLSearchParams({
+                q: document.getElementById('serverSearch').value.trim(),
+                sort: document.getElementById('serverSort').value,
+                offset: serverOffset,
+                limit: SERVER_PAGE_SIZE
+            });
+            fetch('/admin/servers?' + params.toString())
+                .then(response => response.json())
+                .then(data => renderServers(data))
+                .catch(error => console.error('Error:', error));
+        }
+
+        function searchUsers() {
+            const query = document.getElementById('userSearch').value.trim();
+            const results = document.getElementById('userSearchResults');
+            if (!query) {
+                results.innerHTML = '';
+                return;
+            }
+            fetch('/admin/users?' + new URLSearchParams({q: query}).toString())
+                .then(response => response.json())
+                .then(data => {
+                    if (data.error) {
+                        results.innerHTML = '';
+                        return;
+                    }
+                    results.innerHTML = '';
+                    if (!data.users.length) {
+                        results.innerHTML = '<p>該当するユーザーが見つかりません</p>';
+                        return;
+                    }
+                    // User and guild names come from Discord, so they are only ever set as text
+                    data.users.forEach(user => {
+                        const entry = document.createElement('div');
+                        entry.style.margin = '8px 0';
+                        const name = document.createElement('strong');
+                        name.textContent = user.name;
+                        const id = document.createElement('code');
+                        id.textContent = user.user_id;
+                        entry.append(name, ' ', id);
+                        user.guilds.forEach(guild => {
+                            const row = document.createElement('div');
+                            row.style.cursor = 'pointer';
+                            row.style.marginLeft = '16px';
+                            row.textContent = `${guild.guild_name}: Lv.${guild.level} (${guild.total_xp} XP) / 警告 ${guild.warnings}回` +
+                                (guild.open_ticket !== null ? ` / チケット #${guild.open_ticket} 対応中` : '');
+                            row.addEventListener('click', () => selectUser(user.user_id, guild.guild_id));
+                            entry.appendChild(row);
+                        });
+                        results.appendChild(entry);
+                    });
+                    if (data.total > data.users.length) {
+                        const more = document.createElement('p');
+                        more.textContent = `他 ${data.total - data.users.length} 件`;
+                        results.appendChild(more);
+                    }
+                })
+                .catch(error => console.error('Error:', error));
+        }
+
+        function selectUser(userId, guildId) {
+            document.getElementById('userId').value = userId;
+            document.getElementById('guildId').value = guildId;
+        }
+
+        function renderServers(data) {
+            const last = Math.min(data.offset + data.servers.length, data.total);
+            document.getElementById('serverListInfo').textContent =
+                `🌐 Bot参加サーバー一覧 (${data.total}サーバー中 ${data.total ? data.offset + 1 : 0}〜${last})`;
+            const body = document.getElementById('serverTableBody');
+            body.innerHTML = '';
+            // Server and owner names come from Discord, so they are only ever set as text
+            const button = (label, className, onClick) => {
+                const element = document.createElement('button');
+                element.textContent = label;
+                if (className) element.className = className;
+                element.style.margin = '2px';
+                element.addEventListener('click', onClick);
+                return element;
+            };
+            data.servers.forEach(server => {
+                const row = document.createElement('tr');
+                const cells = [server.name, server.id, server.members, server.owner, server.created, null, server.bot_permissions, null]
+                    .map(text => {
+                        const cell = document.createElement('td');
+                        if (text !== null) cell.textContent = text;
+                        row.appendChild(cell);
+                        return cell;
+                    });
+                const id = document.createElement('code');
+                id.textContent = server.id;
+                cells[1].replaceChildren(id);
+                const indicator = document.createElement('span');
+                indicator.className = `status-indicator ${server.is_allowed ? 'online' : 'offline'}`;
+                cells[5].append(indicator, server.is_allowed ? '許可済み' : '未許可');
+                cells[7].append(
+                    button('⚙️ 設定', 'btn-settings', () => showServerSettings(server.id, server.name)),
+                    document.createElement('br'),
+                    button('離脱', 'danger-btn', () => leaveSpecificServer(server.id)),
+                    server.is_allowed
+                        ? button('許可削除', 'warning-btn', () => disallowServer(server.id))
+                        : button('許可', null, () => allowServer(server.id))
+                );
+                body.appendChild(row);
+            });
+            document.getElementById('serverPrev').disabled = data.offset === 0;
+            document.getElementById('serverNext').disabled = last >= data.total;
+        }
+
         function updateSpamSettings() {
             const threshold = document.getElementById('spamThreshold').value;
             const timeWindow = document.getElementById('spamTimeWindow').value;
@@ -775,19 +957,51 @@ def admin_panel():
             });
         }
 
+        function showImportProgress(d) {
+            document.getElementById('importStatus').textContent =
+                `${d.status}: ${d.records}件 (適用 ${d.applied} / スキップ ${d.skipped} / 不正 ${d.invalid}) - ${d.records_per_second}件/秒`;
+        }
+
+        function importData() {
+            const file = document.getElementById('importFile').files[0];
+            if (!file) {
+                alert('インポートするファイルを選択してください');
+                return;
+            }
+            const strategy = document.getElementById('importStrategy').value;
+            if (!confirm(`${file.name} を「${strategy}」でインポートしますか？`)) {
+                return;
+            }
+            document.getElementById('importStatus').textContent = 'アップロード中...';
+            fetch('/admin/import_data?strategy=' + encodeURIComponent(strategy), {
+                method: 'POST',
+                body: file
+            })
+            .then(response => response.json())
+            .then(data => {
+                showImportProgress(data);
+                if (data.errors && data.errors.length) {
+                    alert('インポート時のエラー:' + String.fromCharCode(10) + data.errors.join(String.fromCharCode(10)));
+                }
+                refreshStats();
+            })
+            .catch(error => {
+                alert('エラーが発生しました: ' + error);
+            });
+        }
+
         function exportData() {
-            fetch('/admin/export_data')
-                .then(response => response.blob())
-                .then(blob => {
-                    const url = window.URL.createObjectURL(blob);
-                    const a = document.createElement('a');
-                    a.style.display = 'none';
-                    a.href = url;
-                    a.download = 'bot_data_export.json';
-                    document.body.appendChild(a);
-                    a.click();
-                    window.URL.revokeObjectURL(url);
-                });
+            // Navigate to the download so the browser streams it to disk instead of buffering a blob
+            const params = new URLSearchParams();
+            const guildId = document.getElementById('exportGuildId').value.trim();
+            const section = document.getElementById('exportSection').value;
+            const since = document.getElementById('exportSince').value;
+            if (guildId) params.set('guild_id', guildId);
+            if (section) params.set('section', section);
+            if (since) params.set('since', since);
+            params.set('format', document.getElementById('exportFormat').value);
+            if (document.getElementById('exportGzip').checked) params.set('gzip', '1');
+            window.location.href = '/admin/export_data?' + params.toString();
         }
 
         function leaveSpecificServer(serverId) {
@@ -850,19 +1064,79 @@ def admin_panel():
             });
         }
 
-        // Load initial stats
-        refreshStats();
-        
-        // Auto-refresh every 30 seconds
-        setInterval(refreshStats, 30000);
+        let currentStats = {};
+
+        function applyStatsDiff(diff) {
+            currentStats = Object.assign({}, currentStats, diff);
+            updateStatsDisplay(currentStats);
+        }
+
+        function showLiveEvent(text) {
+            const list = document.getElementById('liveEvents');
+            const item = document.createElement('p');
+            item.textContent = `[${new Date().toLocaleTimeString()}] ${text}`;
+            list.insertBefore(item, list.firstChild);
+            while (list.children.length > 50) {
+                list.removeChild(list.lastChild);
+            }
+        }
+
+        function connectStream() {
+            const status = document.getElementById('streamStatus');
+            if (!window.EventSource) {
+                // No SSE support: fall back to polling
+                status.textContent = '(30秒ごとに更新)';
+                refreshStats();
+                setInterval(refreshStats, 30000);
+                return;
+            }
+
+            const source = new EventSource('/admin/stream');
+            source.onopen = () => { status.textContent = '🟢 接続中'; };
+            source.onerror = () => { status.textContent = '🔴 再接続中...'; };
+            source.addEventListener('snapshot', e => {
+                currentStats = {};
+                applyStatsDiff(JSON.parse(e.data));
+            });
+            source.addEventListener('stats', e => applyStatsDiff(JSON.parse(e.data)));
+            source.addEventListener('spam', e => {
+                const d = JSON.parse(e.data);
+                showLiveEvent(`🚫 スパム検知: ${d.user} (${d.server}) - ${d.timeout_minutes}分タイムアウト`);
+            });
+            source.addEventListener('warning', e => {
+                const d = JSON.parse(e.data);
+                showLiveEvent(`⚠️ 警告: ${d.user_id} (サーバー ${d.guild_id}) - ${d.count}回目`);
+            });
+            source.addEventListener('ticket', e => {
+                const d = JSON.parse(e.data);
+                showLiveEvent(`🎫 チケット作成: #${d.ticket_id} (サーバー ${d.guild_id})`);
+            });
+            source.addEventListener('guild_join', e => {
+                const d = JSON.parse(e.data);
+                loadServers();
+                showLiveEvent(`➕ サーバー参加: ${d.name} (${d.members}人)`);
+            });
+            source.addEventListener('import_progress', e => showImportProgress(JSON.parse(e.data)));
+            source.addEventListener('guild_remove', e => {
+                const d = JSON.parse(e.data);
+                showLiveEvent(`➖ サーバー退出: ${d.name}`);
+            });
+            source.addEventListener('loop_stall', e => {
+                const d = JSON.parse(e.data);
+                showLiveEvent(`🐢 イベントループ遅延: ${d.lag_ms}ms (${d.function})`);
+            });
+        }
+
+        // Live updates pushed by the server; the initial snapshot arrives on connect
+        connectStream();
+        loadServers(0);
     </script>
 </body>
 </html>
-    '''
+    ''')
 
-from flask import request, jsonify, send_file
 import psutil
-import io
+import asyncio
 
 # Server settings storage
 server_settings = {}
@@ -879,8 +1153,11 @@ def load_server_settings():
 
 def save_server_settings():
     try:
+        started = time.perf_counter()
         with open('server_settings.json', 'w', encoding='utf-8') as f:
             json.dump(server_settings, f, ensure_ascii=False, indent=2)
+            size = f.tell()
+        record_storage_write('server_settings', started, size)
     except Exception as e:
         print(f"Error saving server settings: {e}")
 
@@ -898,7 +1175,8 @@ def get_server_settings(guild_id):
         'log_spam_detection': True,
         'dm_notify_user': False,
         'excluded_roles': [],
-        'excluded_channels': []
+        'excluded_channels': [],
+        'ticket_staff_roles': []
     }
     
     guild_key = str(guild_id)
@@ -913,461 +1191,1807 @@ def get_server_settings(guild_id):
     
     return server_settings[guild_key]
 
-@app.route('/admin/server_settings/<server_id>')
-def get_server_settings_api(server_id):
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def format_metric_labels(labelnames, labels):
+    if not labelnames:
+        return ''
+    pairs = []
+    for name, value in zip(labelnames, labels):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+class MetricCounter:
+    """Monotonic count per label tuple; only touched from the event loop, so no lock is needed"""
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.values = {}  # {labels: value}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        for labels, value in list(self.values.items()):
+            yield f'{self.name}{format_metric_labels(self.labelnames, labels)} {value}'
+
+class MetricHistogram:
+    """Bucketed observations per label tuple; buckets are cumulated only when rendered"""
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.values = {}  # {labels: [count per bucket..., +Inf count, sum]}
+
+    def observe(self, value, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    def render(self):
+        for labels, entry in list(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), entry):
+                cumulative += count
+                bucket_labels = format_metric_labels(self.labelnames + ('le',), labels + (bound,))
+                yield f'{self.name}_bucket{bucket_labels} {cumulative}'
+            label_text = format_metric_labels(self.labelnames, labels)
+            yield f'{self.name}_sum{label_text} {entry[-1]}'
+            yield f'{self.name}_count{label_text} {cumulative}'
+
+class MetricGauge:
+    """Value read from a callback at scrape time, so the hot path pays nothing"""
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, callback):
+        self.name = name
+        self.help_text = help_text
+        self.callback = callback
+
+    def render(self):
+        yield f'{self.name} {self.callback()}'
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                print(f"Error rendering metric {metric.name}: {e}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+message_stage_seconds = metrics.register(MetricHistogram('bot_message_stage_seconds', 'on_message processing time by stage', ('stage',)))
+storage_write_seconds = metrics.register(MetricHistogram('bot_storage_write_seconds', 'Time spent writing a JSON store', ('store',)))
+storage_write_bytes = metrics.register(MetricCounter('bot_storage_write_bytes_total', 'Bytes written to JSON stores', ('store',)))
+command_seconds = metrics.register(MetricHistogram('bot_command_seconds', 'Slash command handling time', ('command',)))
+command_errors = metrics.register(MetricCounter('bot_command_errors_total', 'Slash commands that raised an error', ('command',)))
+rest_request_seconds = metrics.register(MetricHistogram('bot_rest_request_seconds', 'Discord REST request time', ('method', 'route')))
+rest_responses = metrics.register(MetricCounter('bot_rest_responses_total', 'Discord REST responses by status', ('method', 'route', 'status')))
+rest_rate_limited = metrics.register(MetricCounter('bot_rest_rate_limited_total', 'Discord REST responses with status 429', ('method', 'route')))
+admin_http_seconds = metrics.register(MetricHistogram('bot_admin_http_seconds', 'Admin HTTP request time', ('method', 'route')))
+scheduler_lag_seconds = metrics.register(MetricHistogram('bot_scheduler_lag_seconds', 'Delay between a job\'s due time and its start'))
+metrics.register(MetricGauge('bot_scheduler_pending_jobs', 'Jobs waiting in the scheduler', lambda: len(scheduler.jobs)))
+metrics.register(MetricGauge('bot_antispam_tracked_users', 'Users with recent messages in the anti-spam history', lambda: len(user_message_history)))
+metrics.register(MetricGauge('bot_guilds', 'Guilds the bot is in', lambda: len(bot.guilds)))
+
+def record_storage_write(store, started, size):
+    storage_write_seconds.observe(time.perf_counter() - started, store)
+    storage_write_bytes.inc(store, amount=size)
+
+REST_ID_PATTERN = re.compile(r'/\d{15,21}')
+# Interaction and webhook tokens and reaction emoji would give every request its own route
+REST_TOKEN_PATTERN = re.compile(r'(/(?:interactions|webhooks)/\{id\}/|/reactions/)[^/]+')
+
+def rest_route(path):
+    # /api/v10/channels/123/messages -> /channels/{id}/messages
+    path = REST_ID_PATTERN.sub('/{id}', '/' + path.split('/api/v', 1)[-1].partition('/')[2])
+    return REST_TOKEN_PATTERN.sub(lambda match: match.group(1) + '{token}', path)
+
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100, 250, 1000)
+PERF_WINDOW = 200  # recent invocations kept per command for /perf
+
+command_first_response_seconds = metrics.register(MetricHistogram('bot_command_first_response_seconds', 'Time until a command first responds (defer or send)', ('command',)))
+command_rest_calls = metrics.register(MetricHistogram('bot_command_rest_calls', 'Discord REST requests issued per command invocation', ('command',), COUNT_BUCKETS))
+
+# Usage record of the command running in the current task; REST calls made by it are counted here
+command_usage = contextvars.ContextVar('command_usage', default=None)
+
+INTERACTION_RESPONSE_ROUTE = '/interactions/{id}/{token}/callback'
+CHANNEL_MESSAGE_ROUTE = '/channels/{id}/messages'
+
+def start_command_usage(name, response_route):
+    usage = {'command': name, 'started': time.perf_counter(), 'rest_calls': 0, 'first_response': None, 'response_route': response_route}
+    return usage, command_usage.set(usage)
+
+class CommandPerf:
+    """Rolling window of recent invocations per command"""
+    def __init__(self, window):
+        self.samples = {}  # {command: deque[(wall, first_response, rest_calls, failed)]}
+        self.window = window
+
+    def record(self, usage, failed):
+        wall = time.perf_counter() - usage['started']
+        name = usage['command']
+        command_seconds.observe(wall, name)
+        command_rest_calls.observe(usage['rest_calls'], name)
+        if usage['first_response'] is not None:
+            command_first_response_seconds.observe(usage['first_response'], name)
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = deque(maxlen=self.window)
+        samples.append((wall, usage['first_response'], usage['rest_calls'], failed))
+
+    def summary(self, sort):
+        rows = []
+        for name, samples in self.samples.items():
+            walls = sorted(sample[0] for sample in samples)
+            first_responses = sorted(sample[1] for sample in samples if sample[1] is not None)
+            rest_calls = [sample[2] for sample in samples]
+            rows.append({
+                'command': name,
+                'count': len(samples),
+                'errors': sum(1 for sample in samples if sample[3]),
+                'p50_ms': percentile(walls, 0.5) * 1000,
+                'p95_ms': percentile(walls, 0.95) * 1000,
+                'first_response_p95_ms': percentile(first_responses, 0.95) * 1000 if first_responses else None,
+                'rest_avg': sum(rest_calls) / len(rest_calls),
+                'rest_max': max(rest_calls)
+            })
+        keys = {
+            'time': lambda row: row['p95_ms'],
+            'rest': lambda row: row['rest_avg'],
+            'first_response': lambda row: row['first_response_p95_ms'] or 0
+        }
+        return sorted(rows, key=keys[sort], reverse=True)
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+command_perf = CommandPerf(PERF_WINDOW)
+
+async def on_rest_request_start(session, context, params):
+    context.started = time.perf_counter()
+    usage = command_usage.get()
+    if usage is not None:
+        usage['rest_calls'] += 1
+
+async def on_rest_request_end(session, context, params):
+    route = rest_route(params.url.path)
+    method = params.method
+    rest_request_seconds.observe(time.perf_counter() - context.started, method, route)
+    rest_responses.inc(method, route, params.response.status)
+    if params.response.status == 429:
+        rest_rate_limited.inc(method, route)
+    usage = command_usage.get()
+    if usage is not None and usage['first_response'] is None and method == 'POST' and route == usage['response_route']:
+        usage['first_response'] = time.perf_counter() - usage['started']
+
+# Handed to discord.py, which passes it to the aiohttp session it uses for REST calls
+rest_trace = aiohttp.TraceConfig()
+rest_trace.on_request_start.append(on_rest_request_start)
+rest_trace.on_request_end.append(on_rest_request_end)
+
+class HttpMetrics:
+    """Per-route request counts and latencies of the admin HTTP server"""
+    def __init__(self):
+        self.routes = {}  # {route: {'requests', 'errors', 'total_ms', 'max_ms'}}
+        self.in_flight = 0
+
+    def record(self, route, status, elapsed):
+        elapsed_ms = elapsed * 1000
+        entry = self.routes.setdefault(route, {'requests': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        entry['requests'] += 1
+        if status >= 500:
+            entry['errors'] += 1
+        entry['total_ms'] += elapsed_ms
+        entry['max_ms'] = max(entry['max_ms'], elapsed_ms)
+
+    def summary(self):
+        return {
+            'in_flight': self.in_flight,
+            'routes': {
+                route: {
+                    'requests': entry['requests'],
+                    'errors': entry['errors'],
+                    'avg_ms': round(entry['total_ms'] / entry['requests'], 2),
+                    'max_ms': round(entry['max_ms'], 2)
+                }
+                for route, entry in self.routes.items()
+            }
+        }
+
+http_metrics = HttpMetrics()
+
+@web.middleware
+async def http_metrics_middleware(request, handler):
+    started = time.perf_counter()
+    status = 500
+    http_metrics.in_flight += 1
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        http_metrics.in_flight -= 1
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource else 'unmatched'
+        elapsed = time.perf_counter() - started
+        http_metrics.record(f"{request.method} {route}", status, elapsed)
+        admin_http_seconds.observe(elapsed, request.method, route)
+
+worker_call_seconds = metrics.register(MetricHistogram('bot_worker_call_seconds', 'Admin work run in worker threads, from submit to result', ('call',)))
+worker_queue_seconds = metrics.register(MetricHistogram('bot_worker_queue_seconds', 'Time admin work waited for a worker thread', ('call',)))
+
+class WorkerBridge:
+    """Runs blocking admin work (data file parsing, dumping, encoding) in worker threads and records each call"""
+    def __init__(self):
+        self.metrics = {}  # {name: {'calls', 'errors', 'queue_ms', 'total_ms', 'max_ms'}}
+
+    async def call(self, name, func, *args):
+        submitted = time.perf_counter()
+        started = []
+
+        def run():
+            started.append(time.perf_counter())
+            return func(*args)
+
+        outcome = 'ok'
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, run)
+        except Exception:
+            outcome = 'error'
+            raise
+        finally:
+            # Back on the loop, so the counters need no lock
+            self.record(name, outcome, submitted, started[0] if started else None, time.perf_counter())
+
+    def record(self, name, outcome, submitted, started, finished):
+        total_ms = (finished - submitted) * 1000
+        entry = self.metrics.setdefault(name, {'calls': 0, 'errors': 0, 'queue_ms': 0.0, 'total_ms': 0.0, 'max_ms': 0.0})
+        entry['calls'] += 1
+        if outcome == 'error':
+            entry['errors'] += 1
+        if started is not None:
+            entry['queue_ms'] += (started - submitted) * 1000
+            worker_queue_seconds.observe(started - submitted, name)
+        entry['total_ms'] += total_ms
+        entry['max_ms'] = max(entry['max_ms'], total_ms)
+        worker_call_seconds.observe(finished - submitted, name)
+
+    def summary(self):
+        return {
+            name: {
+                'calls': entry['calls'],
+                'errors': entry['errors'],
+                'avg_queue_ms': round(entry['queue_ms'] / entry['calls'], 2),
+                'avg_ms': round(entry['total_ms'] / entry['calls'], 2),
+                'max_ms': round(entry['max_ms'], 2)
+            }
+            for name, entry in self.metrics.items()
+        }
+
+worker_bridge = WorkerBridge()
+
+@routes.get('/admin/bridge_metrics')
+async def bridge_metrics(request):
+    return web.json_response(worker_bridge.summary())
+
+SSE_QUEUE_SIZE = 100
+SSE_KEEPALIVE_INTERVAL = 15
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode('utf-8')
+
+class AdminEventHub:
+    """Fans events out to every connected /admin/stream client; each event is encoded once"""
+    def __init__(self):
+        self.subscribers = set()
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+    def publish(self, event, data):
+        if not self.subscribers:
+            return
+        payload = format_sse(event, data)
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(payload)
+            except asyncio.QueueFull:
+                # A client that cannot keep up is disconnected; EventSource reconnects and gets a fresh snapshot
+                self.subscribers.discard(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+admin_events = AdminEventHub()
+
+@routes.get('/admin/stream')
+async def admin_stream(request):
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    await response.prepare(request)
+
+    queue = admin_events.subscribe()
+    try:
+        if stats_aggregator.last_reseed:
+            await response.write(format_sse('snapshot', stats_aggregator.current()))
+        while True:
+            try:
+                payload = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                await response.write(b': keepalive\n\n')
+                continue
+            if payload is None:
+                break
+            await response.write(payload)
+    except ConnectionResetError:
+        pass
+    finally:
+        admin_events.unsubscribe(queue)
+    return response
+
+SERVER_PAGE_LIMIT = 100
+
+class GuildIndex:
+    """Guild rows for /admin/servers with a name prefix index and a member-count ordering"""
+    def __init__(self):
+        self.rows = {}  # {guild_id: row}
+        self.by_name = []  # sorted [(casefolded name, guild_id)]
+        self.by_members = []  # [(member_count, guild_id)], re-sorted lazily
+        self.members_dirty = False
+
+    def build(self, guilds):
+        self.rows = {guild.id: self.make_row(guild) for guild in guilds}
+        self.by_name = sorted((row['name'].casefold(), guild_id) for guild_id, row in self.rows.items())
+        self.members_dirty = True
+
+    def make_row(self, guild):
+        return {
+            'id': guild.id,
+            'name': guild.name,
+            'members': guild.member_count or 0,
+            'owner': guild.owner.display_name if guild.owner else 'Unknown',
+            'created': guild.created_at.strftime('%Y/%m/%d') if guild.created_at else 'Unknown',
+            'bot_permissions': 'Admin' if guild.me and guild.me.guild_permissions.administrator else 'Limited'
+        }
+
+    def upsert(self, guild):
+        self.remove(guild.id)
+        row = self.rows[guild.id] = self.make_row(guild)
+        bisect.insort(self.by_name, (row['name'].casefold(), guild.id))
+        self.members_dirty = True
+
+    def remove(self, guild_id):
+        row = self.rows.pop(guild_id, None)
+        if row is not None:
+            position = bisect.bisect_left(self.by_name, (row['name'].casefold(), guild_id))
+            if position < len(self.by_name) and self.by_name[position] == (row['name'].casefold(), guild_id):
+                del self.by_name[position]
+            self.members_dirty = True
+
+    def update_members(self, guild):
+        row = self.rows.get(guild.id)
+        if row is not None:
+            row['members'] = guild.member_count or 0
+            self.members_dirty = True
+
+    def search_ids(self, query, sort):
+        if query:
+            if query.isdigit() and int(query) in self.rows:
+                return [int(query)]
+            prefix = query.casefold()
+            start = bisect.bisect_left(self.by_name, (prefix,))
+            end = bisect.bisect_left(self.by_name, (prefix + '\U0010ffff',))
+            matches = [guild_id for _, guild_id in self.by_name[start:end]]
+            if sort == 'name':
+                return matches
+            return sorted(matches, key=lambda guild_id: self.rows[guild_id]['members'], reverse=sort == '-members')
+
+        if sort == 'name':
+            return [guild_id for _, guild_id in self.by_name]
+        if self.members_dirty:
+            # Counts drift by small steps, so the previous order is nearly sorted and this is close to linear
+            previous = [guild_id for _, guild_id in self.by_members if guild_id in self.rows]
+            known = set(previous)
+            previous.extend(guild_id for guild_id in self.rows if guild_id not in known)
+            self.by_members = sorted(((self.rows[guild_id]['members'], guild_id) for guild_id in previous), key=lambda item: item[0])
+            self.members_dirty = False
+        ids = [guild_id for _, guild_id in self.by_members]
+        return ids[::-1] if sort == '-members' else ids
+
+    def page(self, query, sort, offset, limit):
+        ids = self.search_ids(query, sort)
+        servers = []
+        for guild_id in ids[offset:offset + limit]:
+            row = dict(self.rows[guild_id])
+            row['is_allowed'] = allowlist.contains(guild_id)
+            servers.append(row)
+        return {'total': len(ids), 'offset': offset, 'limit': limit, 'servers': servers}
+
+guild_index = GuildIndex()
+
+@routes.get('/admin/servers')
+async def admin_servers(request):
     try:
-        settings = get_server_settings(int(server_id))
-        return jsonify(settings)
+        query = request.query.get('q', '').strip()
+        sort = request.query.get('sort', '-members')
+        if sort not in ('name', 'members', '-members'):
+            return web.json_response({'error': f'不明な並び順です: {sort}'}, status=400)
+        offset = max(int(request.query.get('offset', 0)), 0)
+        limit = min(max(int(request.query.get('limit', 50)), 1), SERVER_PAGE_LIMIT)
+        return web.json_response(guild_index.page(query, sort, offset, limit))
+    except ValueError:
+        return web.json_response({'error': 'offset と limit は数値で指定してください'}, status=400)
+    except Exception as e:
+        return web.json_response({'error': str(e)}, status=500)
+
+USER_SEARCH_LIMIT = 100
+
+class UserIndex:
+    """Cross-guild view of user_levels, warnings and open tickets with a prefix index over cached member names"""
+    def __init__(self):
+        self.users = {}  # {user_id: {guild_id: {'level', 'total_xp', 'warnings', 'open_ticket'}}}
+        self.names = {}  # {user_id: set(casefolded names)}
+        self.by_name = []  # sorted [(casefolded name, user_id)]
+        self.loaded = False
+
+    def build(self, data):
+        self.loaded = False
+        self.users = {}
+        self.names = {}
+        self.by_name = []
+        for guild_id, guild_levels in data.get('user_levels', {}).items():
+            for user_id, level_data in guild_levels.items():
+                row = self.entry(user_id, guild_id)
+                row['level'] = level_data.get('level', 1)
+                row['total_xp'] = level_data.get('total_xp', 0)
+        for guild_id, guild_warnings in data.get('warnings', {}).items():
+            for user_id, warning_data in guild_warnings.items():
+                self.entry(user_id, guild_id)['warnings'] = warning_data.get('count', 0)
+        for key, ticket_data in data.get('tickets', {}).items():
+            if ticket_data.get('status') == 'open':
+                self.entry(ticket_data['user_id'], ticket_data['guild_id'])['open_ticket'] = int(key.rsplit('-', 1)[-1])
+        for user_id in self.users:
+            self.index_names(user_id)
+        self.by_name.sort()
+        self.loaded = True
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.build(load_data())
+
+    def entry(self, user_id, guild_id):
+        guilds = self.users.setdefault(str(user_id), {})
+        return guilds.setdefault(str(guild_id), {'level': 1, 'total_xp': 0, 'warnings': 0, 'open_ticket': None})
+
+    def touch(self, user_id, guild_id):
+        # Write paths before the first build are picked up by build() from the data file
+        if not self.loaded:
+            return None
+        user_id = str(user_id)
+        is_new = str(guild_id) not in self.users.get(user_id, {})
+        row = self.entry(user_id, guild_id)
+        if is_new:
+            # A new guild row can bring a new nickname; only names not indexed yet are inserted
+            indexed = self.names.get(user_id, set())
+            for name in self.index_names(user_id) - indexed:
+                bisect.insort(self.by_name, (name, user_id))
+            # Names still in by_name stay recorded so refresh_names() can remove them later
+            self.names[user_id] |= indexed
+        return row
+
+    def set_level(self, user_id, guild_id, level, total_xp):
+        row = self.touch(user_id, guild_id)
+        if row is not None:
+            row['level'] = level
+            row['total_xp'] = total_xp
+
+    def set_warnings(self, user_id, guild_id, count):
+        row = self.touch(user_id, guild_id)
+        if row is not None:
+            row['warnings'] = count
+
+    def set_open_ticket(self, user_id, guild_id, ticket_id):
+        row = self.touch(user_id, guild_id)
+        if row is not None:
+            row['open_ticket'] = ticket_id
+
+    def cached_names(self, user_id):
+        names = set()
+        user = bot.get_user(int(user_id))
+        if user:
+            names.add(user.name)
+            if user.global_name:
+                names.add(user.global_name)
+        for guild_id in self.users.get(user_id, {}):
+            guild = bot.get_guild(int(guild_id))
+            member = guild.get_member(int(user_id)) if guild else None
+            if member and member.nick:
+                names.add(member.nick)
+        return {name.casefold() for name in names}
+
+    def index_names(self, user_id):
+        """Record the user's names; build() sorts once, touch() inserts the returned names itself"""
+        names = self.cached_names(user_id)
+        self.names[user_id] = names
+        if not self.loaded:
+            self.by_name.extend((name, user_id) for name in names)
+        return names
+
+    def refresh_names(self, user_id):
+        user_id = str(user_id)
+        if not self.loaded or user_id not in self.users:
+            return
+        for name in self.names.get(user_id, ()):
+            position = bisect.bisect_left(self.by_name, (name, user_id))
+            if position < len(self.by_name) and self.by_name[position] == (name, user_id):
+                del self.by_name[position]
+        for name in self.index_names(user_id):
+            bisect.insort(self.by_name, (name, user_id))
+
+    def search(self, query, limit):
+        self.ensure_loaded()
+        if query.isdigit():
+            user_ids = [query] if query in self.users else []
+        else:
+            prefix = query.casefold()
+            start = bisect.bisect_left(self.by_name, (prefix,))
+            end = bisect.bisect_left(self.by_name, (prefix + '\U0010ffff',))
+            # One user can match on several names
+            user_ids = list(dict.fromkeys(user_id for _, user_id in self.by_name[start:end]))
+        return {'total': len(user_ids), 'users': [self.describe(user_id) for user_id in user_ids[:limit]]}
+
+    def describe(self, user_id):
+        user = bot.get_user(int(user_id))
+        guilds = []
+        for guild_id, row in self.users[user_id].items():
+            guilds.append({
+                'guild_id': guild_id,
+                'guild_name': guild_display_name(guild_id),
+                'level': row['level'],
+                'total_xp': row['total_xp'],
+                'warnings': row['warnings'],
+                'open_ticket': row['open_ticket']
+            })
+        guilds.sort(key=lambda guild: guild['total_xp'], reverse=True)
+        return {'user_id': user_id, 'name': user.name if user else 'Unknown', 'guilds': guilds}
+
+user_index = UserIndex()
+
+@routes.get('/admin/users')
+async def admin_users(request):
+    try:
+        query = request.query.get('q', '').strip()
+        if not query:
+            return web.json_response({'error': '検索語を指定してください'}, status=400)
+        limit = min(max(int(request.query.get('limit', 20)), 1), USER_SEARCH_LIMIT)
+        return web.json_response(user_index.search(query, limit))
+    except ValueError:
+        return web.json_response({'error': 'limit は数値で指定してください'}, status=400)
+    except Exception as e:
+        return web.json_response({'error': str(e)}, status=500)
+
+def guild_display_name(server_id):
+    guild = bot.get_guild(int(server_id))
+    return guild.name if guild else f'サーバーID: {server_id}'
+
+@routes.get('/admin/server_settings/{server_id}')
+async def get_server_settings_api(request):
+    try:
+        settings = get_server_settings(int(request.match_info['server_id']))
+        return web.json_response(settings)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return web.json_response({'error': str(e)}, status=500)
 
-@app.route('/admin/server_settings/<server_id>', methods=['POST'])
-def update_server_settings_api(server_id):
+@routes.post('/admin/server_settings/{server_id}')
+async def update_server_settings_api(request):
     try:
-        request_data = request.json
+        server_id = request.match_info['server_id']
+        request_data = await request.json()
         guild_id = str(server_id)
         
         # Validate settings
         if request_data.get('spam_threshold', 0) < 2:
-            return jsonify({'error': '連投検知閾値は2以上である必要があります'}), 400
+            return web.json_response({'error': '連投検知閾値は2以上である必要があります'}, status=400)
         
         if request_data.get('time_window', 0) < 10:
-            return jsonify({'error': '時間窓は10秒以上である必要があります'}), 400
+            return web.json_response({'error': '時間窓は10秒以上である必要があります'}, status=400)
         
         server_settings[guild_id] = request_data
         save_server_settings()
         
-        # Get guild name for display
-        guild = bot.get_guild(int(server_id)) if bot else None
-        guild_name = guild.name if guild else f'サーバーID: {server_id}'
-        
-        return jsonify({'message': f'サーバー "{guild_name}" の設定を保存しました'})
+        return web.json_response({'message': f'サーバー "{guild_display_name(server_id)}" の設定を保存しました'})
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return web.json_response({'error': str(e)}, status=500)
 
-@app.route('/admin/server_settings/<server_id>/reset', methods=['POST'])
-def reset_server_settings_api(server_id):
+@routes.post('/admin/server_settings/{server_id}/reset')
+async def reset_server_settings_api(request):
     try:
+        server_id = request.match_info['server_id']
         guild_id = str(server_id)
         if guild_id in server_settings:
             del server_settings[guild_id]
             save_server_settings()
         
-        # Get guild name for display
-        guild = bot.get_guild(int(server_id)) if bot else None
-        guild_name = guild.name if guild else f'サーバーID: {server_id}'
-        
-        return jsonify({'message': f'サーバー "{guild_name}" の設定をデフォルトに戻しました'})
+        return web.json_response({'message': f'サーバー "{guild_display_name(server_id)}" の設定をデフォルトに戻しました'})
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return web.json_response({'error': str(e)}, status=500)
 
 # Admin API endpoints
-@app.route('/admin/stats')
-def admin_stats():
-    try:
-        # Calculate uptime
-        uptime_seconds = (datetime.now() - bot_start_time).total_seconds()
-        uptime_hours = int(uptime_seconds // 3600)
-        uptime_minutes = int((uptime_seconds % 3600) // 60)
-        uptime_str = f"{uptime_hours}時間 {uptime_minutes}分"
-        
-        # Load data safely
-        try:
-            data = load_data()
-        except Exception as e:
-            print(f"Error loading data: {e}")
-            data = {}
-        
-        # Calculate statistics safely
-        total_warnings = 0
-        warnings_this_month = 0
-        total_bans = 0
-        tickets_created = len(data.get('tickets', {}))
-        polls_created = len(data.get('polls', {}))
-        
-        try:
-            if 'warnings' in data:
-                for guild_warnings in data['warnings'].values():
-                    for user_warnings in guild_warnings.values():
-                        total_warnings += user_warnings.get('count', 0)
-                        for warning in user_warnings.get('history', []):
-                            try:
-                                warning_date = datetime.fromisoformat(warning['timestamp'])
-                                if warning_date.month == datetime.now().month and warning_date.year == datetime.now().year:
-                                    warnings_this_month += 1
-                            except:
-                                continue
-        except Exception as e:
-            print(f"Error calculating warnings: {e}")
-        
-        # Level statistics
-        level_ups = 0
-        try:
-            if 'user_levels' in data:
-                for guild_levels in data['user_levels'].values():
-                    for user_level in guild_levels.values():
-                        level_ups += user_level.get('level', 1) - 1
-        except Exception as e:
-            print(f"Error calculating level ups: {e}")
-        
-        # Get system info
+STATS_SNAPSHOT_INTERVAL = 5
+STATS_RESEED_INTERVAL = 600
+
+def count_stored_stats(data):
+    """Warning, level-up and ticket totals of the data file and ticket archive; runs in a worker thread"""
+    total_warnings = 0
+    warnings_by_month = {}
+    latest_warnings = {}
+    for guild_id, guild_warnings in data.get('warnings', {}).items():
+        for user_id, user_warnings in guild_warnings.items():
+            total_warnings += user_warnings.get('count', 0)
+            for warning in user_warnings.get('history', []):
+                try:
+                    warning_date = datetime.fromisoformat(warning['timestamp'])
+                except Exception:
+                    continue
+                month = (warning_date.year, warning_date.month)
+                warnings_by_month[month] = warnings_by_month.get(month, 0) + 1
+            if user_warnings.get('history'):
+                latest_warnings[(guild_id, user_id)] = (user_warnings['history'][-1]['timestamp'], user_warnings['count'])
+
+    # Tickets are counted one by one: counters seeded from the old global sequence overstate each guild
+    hot_ticket_ids = {}  # {guild_id: set(ticket_id)}
+    for key, ticket_data in data.get('tickets', {}).items():
+        hot_ticket_ids.setdefault(str(ticket_data.get('guild_id')), set()).add(int(key.rsplit('-', 1)[-1]))
+    tickets_created = sum(len(ticket_ids) for ticket_ids in hot_ticket_ids.values())
+    if os.path.isdir(TICKET_ARCHIVE_DIR):
+        for name in os.listdir(TICKET_ARCHIVE_DIR):
+            if name.endswith('.jsonl'):
+                archive_guild = name[:-len('.jsonl')]
+                tickets_created += len(load_archive_offsets(archive_guild).keys() - hot_ticket_ids.get(archive_guild, set()))
+
+    return {
+        'total_warnings': total_warnings,
+        'warnings_by_month': warnings_by_month,
+        'latest_warnings': latest_warnings,
+        'level_ups': sum(user_level.get('level', 1) - 1
+                         for guild_levels in data.get('user_levels', {}).values()
+                         for user_level in guild_levels.values()),
+        'tickets_created': tickets_created
+    }
+
+class StatsAggregator:
+    """Running counters for /admin/stats, kept on the bot loop and published as snapshots"""
+    def __init__(self, interval):
+        self.interval = interval
+        # Replaced wholesale on every publish and never mutated afterwards, so readers always see one consistent set
+        self.snapshot = {}
+        self.snapshot_at = 0
+        self.total_warnings = 0
+        self.warnings_by_month = {}  # {(year, month): count}
+        self.latest_warnings = {}  # {(guild_id, user_id): (timestamp, count)}
+        self.level_ups = 0
+        self.tickets_created = 0
+        self.timeouts = {}  # {(guild_id, member_id): timed_out_until}
+        self.reseed_requested = True
+        self.last_reseed = 0
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    def request_reseed(self):
+        """Recount from the data file on the next tick (after bulk edits such as imports)"""
+        self.reseed_requested = True
+
+    def adjust(self, warnings=0, level_ups=0):
+        """Apply admin edits that change stored totals without going through the event hooks"""
+        self.total_warnings += warnings
+        self.level_ups += level_ups
+
+    def record_warning(self, guild_id, user_id, count, timestamp):
+        self.total_warnings += 1
+        month = (timestamp.year, timestamp.month)
+        self.warnings_by_month[month] = self.warnings_by_month.get(month, 0) + 1
+        self.latest_warnings[(str(guild_id), str(user_id))] = (timestamp.isoformat(), count)
+        admin_events.publish('warning', {'guild_id': str(guild_id), 'user_id': str(user_id), 'count': count})
+
+    def record_level_up(self, levels):
+        self.level_ups += levels
+
+    def record_ticket(self, guild_id, ticket_id):
+        self.tickets_created += 1
+        admin_events.publish('ticket', {'guild_id': str(guild_id), 'ticket_id': ticket_id})
+
+    def record_timeout(self, member):
+        key = (member.guild.id, member.id)
+        if member.timed_out_until:
+            self.timeouts[key] = member.timed_out_until
+        else:
+            self.timeouts.pop(key, None)
+
+    async def reseed(self):
+        """Recount from the data file in a worker thread; the incremental hooks keep the totals current in between.
+
+        Events saved while the count runs can be missing from it until the next reseed.
+        """
+        self.reseed_requested = False
+        counts = await worker_bridge.call('stats_reseed', lambda: count_stored_stats(load_data()))
+        self.total_warnings = counts['total_warnings']
+        self.warnings_by_month = counts['warnings_by_month']
+        self.latest_warnings = counts['latest_warnings']
+        self.level_ups = counts['level_ups']
+        self.tickets_created = counts['tickets_created']
+
+        # Timeouts only need the member walk once; on_member_update keeps them current afterwards
+        if not self.last_reseed:
+            self.timeouts = {(guild.id, member.id): member.timed_out_until
+                             for guild in bot.guilds for member in guild.members
+                             if member.timed_out_until}
+        self.last_reseed = time.time()
+
+    def build_snapshot(self):
+        now = datetime.now()
+        utc_now = discord.utils.utcnow()
+        self.timeouts = {key: until for key, until in self.timeouts.items() if until > utc_now}
+
+        recent_warnings = []
+        for (guild_id, user_id), (timestamp, count) in heapq.nlargest(5, self.latest_warnings.items(), key=lambda item: item[1][0]):
+            guild = bot.get_guild(int(guild_id))
+            user = guild.get_member(int(user_id)) if guild else None
+            recent_warnings.append({
+                'user': user.display_name if user else f'Unknown User ({user_id})',
+                'server': guild.name if guild else f'Unknown Server ({guild_id})',
+                'count': count,
+                'last_warning': timestamp[:10]
+            })
+
         memory_usage = 0
         cpu_usage = 0
         try:
-            import psutil
             memory_usage = psutil.virtual_memory().used // 1024 // 1024  # MB
             cpu_usage = psutil.cpu_percent()
         except Exception as e:
             print(f"Error getting system info: {e}")
-        
-        # Calculate real statistics safely
-        total_messages_today = 0
-        active_spam_detections = 0
-        try:
-            total_messages_today = sum(len(history) for history in user_message_history.values())
-            active_spam_detections = len([uid for uid, history in user_message_history.items() if history])
-        except Exception as e:
-            print(f"Error calculating message stats: {e}")
-        
-        # Calculate recent warnings safely
-        recent_warnings_list = []
-        try:
-            if 'warnings' in data and bot:
-                for guild_id, guild_warnings in data['warnings'].items():
-                    try:
-                        guild = bot.get_guild(int(guild_id))
-                        guild_name = guild.name if guild else f'Unknown Server ({guild_id})'
-                        
-                        for user_id, user_warnings in guild_warnings.items():
-                            if user_warnings.get('history'):
-                                try:
-                                    latest_warning = user_warnings['history'][-1]
-                                    user = None
-                                    if guild:
-                                        user = guild.get_member(int(user_id))
-                                    user_name = user.display_name if user else f'Unknown User ({user_id})'
-                                    
-                                    recent_warnings_list.append({
-                                        'user': user_name,
-                                        'server': guild_name,
-                                        'count': user_warnings['count'],
-                                        'last_warning': latest_warning['timestamp'][:10]
-                                    })
-                                except Exception as e:
-                                    print(f"Error processing warning for user {user_id}: {e}")
-                                    continue
-                    except Exception as e:
-                        print(f"Error processing guild {guild_id}: {e}")
-                        continue
-        except Exception as e:
-            print(f"Error calculating recent warnings: {e}")
-        
-        # Sort by timestamp and get last 5
-        try:
-            recent_warnings_list.sort(key=lambda x: x['last_warning'], reverse=True)
-            recent_warnings_list = recent_warnings_list[:5]
-        except Exception as e:
-            print(f"Error sorting warnings: {e}")
-            recent_warnings_list = []
-        
-        # Calculate server stats safely
-        server_count = 0
-        total_members = 0
-        latency = 0
-        active_timeouts = 0
-        roles_assigned = 0
-        top_servers = []
-        all_servers = []
-        
-        try:
-            if bot:
-                server_count = len(bot.guilds)
-                total_members = sum(guild.member_count for guild in bot.guilds)
-                latency = round(bot.latency * 1000)
-                
-                try:
-                    active_timeouts = sum(1 for guild in bot.guilds 
-                                         for member in guild.members 
-                                         if hasattr(member, 'timed_out_until') and member.timed_out_until and member.timed_out_until > datetime.now())
-                except Exception as e:
-                    print(f"Error calculating timeouts: {e}")
-                
-                try:
-                    roles_assigned = sum(len(member.roles) - 1 for guild in bot.guilds 
-                                        for member in guild.members)
-                except Exception as e:
-                    print(f"Error calculating roles: {e}")
-                
-                try:
-                    top_servers = [
-                        {'name': guild.name, 'members': guild.member_count, 'messages': 0, 'warnings': 0}
-                        for guild in bot.guilds[:5]
-                    ]
-                except Exception as e:
-                    print(f"Error calculating top servers: {e}")
-                
-                try:
-                    all_servers = [
-                        {
-                            'id': guild.id,
-                            'name': guild.name,
-                            'members': guild.member_count,
-                            'owner': guild.owner.display_name if guild.owner else 'Unknown',
-                            'created': guild.created_at.strftime('%Y/%m/%d') if guild.created_at else 'Unknown',
-                            'is_allowed': guild.id in ALLOWED_SERVERS,
-                            'bot_permissions': 'Admin' if guild.me.guild_permissions.administrator else 'Limited'
-                        }
-                        for guild in bot.guilds
-                    ]
-                except Exception as e:
-                    print(f"Error calculating all servers: {e}")
-        except Exception as e:
-            print(f"Error accessing bot guilds: {e}")
-        
-        stats = {
-            'server_count': server_count,
-            'allowed_servers': len(ALLOWED_SERVERS),
-            'total_members': total_members,
-            'uptime': uptime_str,
+
+        total_messages = sum(len(history) for history in user_message_history.values())
+        guilds = list(bot.guilds)
+        uptime_seconds = (now - bot_start_time).total_seconds()
+        uptime_hours = int(uptime_seconds // 3600)
+        uptime_minutes = int((uptime_seconds % 3600) // 60)
+        return {
+            'uptime': f"{uptime_hours}時間 {uptime_minutes}分",
+            'avg_messages_per_hour': total_messages // uptime_hours if uptime_hours > 0 else 0,
+            'server_count': len(guilds),
+            'allowed_servers': len(allowlist),
+            'total_members': sum(guild.member_count or 0 for guild in guilds),
             'monitored_users': len(user_message_history),
             'tracked_bots': len(bot_message_count),
-            'spam_detections_today': active_spam_detections,
-            'total_spam_detections': sum(len(history) for history in user_message_history.values()),
-            'messages_today': total_messages_today,
-            'total_messages': sum(len(history) for history in user_message_history.values()),
-            'avg_messages_per_hour': total_messages_today // max(uptime_hours, 1) if uptime_hours > 0 else 0,
-            'latency': latency,
-            'total_warnings': total_warnings,
-            'warnings_this_month': warnings_this_month,
-            'total_bans': total_bans,
-            'active_timeouts': active_timeouts,
-            'tickets_created': tickets_created,
-            'polls_created': polls_created,
-            'level_ups': level_ups,
-            'roles_assigned': roles_assigned,
+            'spam_detections_today': len([uid for uid, history in user_message_history.items() if history]),
+            'total_spam_detections': total_messages,
+            'messages_today': total_messages,
+            'total_messages': total_messages,
+            'latency': round(bot.latency * 1000) if bot.latency == bot.latency else 0,
+            'total_warnings': self.total_warnings,
+            'warnings_this_month': self.warnings_by_month.get((now.year, now.month), 0),
+            'total_bans': 0,
+            'active_timeouts': len(self.timeouts),
+            'tickets_created': self.tickets_created,
+            'polls_created': len(active_polls),
+            'level_ups': self.level_ups,
+            'roles_assigned': sum(role_assignment_totals.values()),
             'memory_usage': memory_usage,
             'cpu_usage': cpu_usage,
             'last_restart': bot_start_time.strftime('%Y/%m/%d %H:%M:%S'),
-            'top_servers': top_servers,
-            'recent_warnings': recent_warnings_list,
-            'all_servers': all_servers
+            'top_servers': [
+                {'name': guild.name, 'members': guild.member_count, 'messages': 0, 'warnings': 0}
+                for guild in guilds[:5]
+            ],
+            'recent_warnings': recent_warnings,
+            'snapshot_time': now.isoformat()
         }
-        
-        return jsonify(stats)
-    except Exception as e:
-        print(f"Critical error in admin_stats: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({
-            'error': str(e),
-            'server_count': 0,
-            'allowed_servers': len(ALLOWED_SERVERS) if 'ALLOWED_SERVERS' in globals() else 0,
-            'total_members': 0,
-            'uptime': '0時間 0分',
-            'monitored_users': 0,
-            'tracked_bots': 0,
-            'spam_detections_today': 0,
-            'total_spam_detections': 0,
-            'messages_today': 0,
-            'total_messages': 0,
-            'avg_messages_per_hour': 0,
-            'latency': 0,
-            'total_warnings': 0,
-            'warnings_this_month': 0,
-            'total_bans': 0,
-            'active_timeouts': 0,
-            'tickets_created': 0,
-            'polls_created': 0,
-            'level_ups': 0,
-            'roles_assigned': 0,
-            'memory_usage': 0,
-            'cpu_usage': 0,
-            'last_restart': 'Unknown',
-            'top_servers': [],
-            'recent_warnings': [],
-            'all_servers': []
-        }), 500
-
-@app.route('/admin/update_spam_settings', methods=['POST'])
-def update_spam_settings():
+
+    def publish(self):
+        snapshot = self.build_snapshot()
+        previous = self.snapshot
+        self.snapshot = snapshot
+        self.snapshot_at = time.time()
+        # One diff per tick, shared by every connected dashboard
+        diff = {key: value for key, value in snapshot.items() if previous.get(key) != value}
+        if previous and set(diff) != {'snapshot_time'}:
+            admin_events.publish('stats', diff)
+
+    def current(self):
+        """Latest snapshot, rebuilt on demand while no dashboard is subscribed to keep it fresh"""
+        if not self.snapshot or time.time() - self.snapshot_at >= self.interval:
+            self.publish()
+        return self.snapshot
+
+    async def _run(self):
+        while True:
+            try:
+                if self.reseed_requested or time.time() - self.last_reseed > STATS_RESEED_INTERVAL:
+                    await self.reseed()
+                # psutil and the guild walk are only worth it while someone is watching
+                if admin_events.subscribers:
+                    self.publish()
+            except Exception as e:
+                print(f"Error building stats snapshot: {e}")
+            await asyncio.sleep(self.interval)
+
+stats_aggregator = StatsAggregator(STATS_SNAPSHOT_INTERVAL)
+
+@routes.get('/admin/stats')
+async def admin_stats(request):
+    # The counters are kept by the stats aggregator; only the snapshot is rebuilt when stale
+    if not stats_aggregator.last_reseed:
+        return web.json_response({'error': '統計情報を準備中です'}, status=503)
+    return web.json_response(stats_aggregator.current())
+
+@routes.post('/admin/update_spam_settings')
+async def update_spam_settings(request):
     try:
-        data = request.json
+        data = await request.json()
         threshold = int(data.get('threshold', 3))
         time_window = int(data.get('time_window', 30))
         
         # Here you would update the spam detection settings
         # For now, we'll just return success
         
-        return jsonify({'message': f'スパム設定を更新しました: 閾値={threshold}, 時間窓={time_window}秒'})
+        return web.json_response({'message': f'スパム設定を更新しました: 閾値={threshold}, 時間窓={time_window}秒'})
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return web.json_response({'error': str(e)}, status=500)
 
-@app.route('/admin/update_user_warnings', methods=['POST'])
-def update_user_warnings():
+@routes.post('/admin/update_user_warnings')
+async def update_user_warnings(request):
     try:
-        request_data = request.json
+        request_data = await request.json()
         user_id = str(request_data.get('user_id'))
         guild_id = str(request_data.get('guild_id'))
         warn_count = int(request_data.get('warn_count', 0))
         
-        data = load_data()
-        if 'warnings' not in data:
-            data['warnings'] = {}
-        
-        if guild_id not in data['warnings']:
-            data['warnings'][guild_id] = {}
-        
-        if user_id not in data['warnings'][guild_id]:
-            data['warnings'][guild_id][user_id] = {'count': 0, 'history': []}
+        def set_warning_count(data):
+            if 'warnings' not in data:
+                data['warnings'] = {}
+            
+            if guild_id not in data['warnings']:
+                data['warnings'][guild_id] = {}
+            
+            if user_id not in data['warnings'][guild_id]:
+                data['warnings'][guild_id][user_id] = {'count': 0, 'history': []}
+            
+            previous_count = data['warnings'][guild_id][user_id]['count']
+            data['warnings'][guild_id][user_id]['count'] = warn_count
+            return True, previous_count
         
-        data['warnings'][guild_id][user_id]['count'] = warn_count
-        save_data(data)
+        previous_count = await update_data(set_warning_count)
+        stats_aggregator.adjust(warnings=warn_count - previous_count)
+        user_index.set_warnings(user_id, guild_id, warn_count)
         
-        return jsonify({'message': f'ユーザー {user_id} の警告回数を {warn_count} に更新しました'})
+        return web.json_response({'message': f'ユーザー {user_id} の警告回数を {warn_count} に更新しました'})
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return web.json_response({'error': str(e)}, status=500)
 
-@app.route('/admin/reset_user_level', methods=['POST'])
-def reset_user_level():
+@routes.post('/admin/reset_user_level')
+async def reset_user_level(request):
     try:
-        request_data = request.json
+        request_data = await request.json()
         user_id = str(request_data.get('user_id'))
         guild_id = str(request_data.get('guild_id'))
         
-        data = load_data()
-        if 'user_levels' not in data:
-            data['user_levels'] = {}
+        def reset_level(data):
+            if guild_id in data.get('user_levels', {}) and user_id in data['user_levels'][guild_id]:
+                previous_level = data['user_levels'][guild_id][user_id].get('level', 1)
+                data['user_levels'][guild_id][user_id] = {'level': 1, 'xp': 0, 'total_xp': 0}
+                return True, previous_level
+            return False, None
         
-        if guild_id in data['user_levels'] and user_id in data['user_levels'][guild_id]:
-            data['user_levels'][guild_id][user_id] = {'level': 1, 'xp': 0, 'total_xp': 0}
-            save_data(data)
-            return jsonify({'message': f'ユーザー {user_id} のレベルをリセットしました'})
+        previous_level = await update_data(reset_level)
+        if previous_level is not None:
+            stats_aggregator.adjust(level_ups=1 - previous_level)
+            user_index.set_level(user_id, guild_id, 1, 0)
+            return web.json_response({'message': f'ユーザー {user_id} のレベルをリセットしました'})
         else:
-            return jsonify({'message': 'ユーザーのレベルデータが見つかりません'})
+            return web.json_response({'message': 'ユーザーのレベルデータが見つかりません'})
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return web.json_response({'error': str(e)}, status=500)
 
-@app.route('/admin/add_allowed_server', methods=['POST'])
-def add_allowed_server():
+@routes.post('/admin/add_allowed_server')
+async def add_allowed_server(request):
     try:
-        request_data = request.json
+        request_data = await request.json()
         server_id = int(request_data.get('server_id'))
         
-        if server_id not in ALLOWED_SERVERS:
-            ALLOWED_SERVERS.append(server_id)
-            # Get server name for display
-            guild = bot.get_guild(server_id) if bot else None
-            server_name = guild.name if guild else f'サーバーID: {server_id}'
-            return jsonify({'message': f'サーバー "{server_name}" を許可リストに追加しました'})
+        server_name = guild_display_name(server_id)
+        if allowlist.add(server_id):
+            return web.json_response({'message': f'サーバー "{server_name}" を許可リストに追加しました'})
         else:
-            guild = bot.get_guild(server_id) if bot else None
-            server_name = guild.name if guild else f'サーバーID: {server_id}'
-            return jsonify({'message': f'サーバー "{server_name}" は既に許可リストに含まれています'})
+            return web.json_response({'message': f'サーバー "{server_name}" は既に許可リストに含まれています'})
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return web.json_response({'error': str(e)}, status=500)
 
-@app.route('/admin/remove_allowed_server', methods=['POST'])
-def remove_allowed_server():
+@routes.post('/admin/remove_allowed_server')
+async def remove_allowed_server(request):
     try:
-        request_data = request.json
+        request_data = await request.json()
         server_id = int(request_data.get('server_id'))
         
-        if server_id in ALLOWED_SERVERS:
-            ALLOWED_SERVERS.remove(server_id)
-            # Get server name for display
-            guild = bot.get_guild(server_id) if bot else None
-            server_name = guild.name if guild else f'サーバーID: {server_id}'
-            return jsonify({'message': f'サーバー "{server_name}" を許可リストから削除しました'})
+        server_name = guild_display_name(server_id)
+        if allowlist.remove(server_id):
+            return web.json_response({'message': f'サーバー "{server_name}" を許可リストから削除しました'})
         else:
-            guild = bot.get_guild(server_id) if bot else None
-            server_name = guild.name if guild else f'サーバーID: {server_id}'
-            return jsonify({'message': f'サーバー "{server_name}" は許可リストに含まれていません'})
+            return web.json_response({'message': f'サーバー "{server_name}" は許可リストに含まれていません'})
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return web.json_response({'error': str(e)}, status=500)
 
-@app.route('/admin/leave_server', methods=['POST'])
-def leave_server():
+@routes.post('/admin/leave_server')
+async def leave_server(request):
     try:
-        request_data = request.json
+        request_data = await request.json()
         server_id = int(request_data.get('server_id'))
         
-        if bot:
-            guild = bot.get_guild(server_id)
-            if guild:
-                # Schedule the leave operation in the bot's event loop
-                import asyncio
-                
-                async def leave_guild():
-                    try:
-                        await guild.leave()
-                        print(f"Bot left server {server_id} ({guild.name}) via admin panel")
-                    except Exception as e:
-                        print(f"Error leaving server {server_id}: {e}")
-                
-                # Add the task to the bot's event loop
-                if hasattr(bot, 'loop') and bot.loop and bot.loop.is_running():
-                    asyncio.run_coroutine_threadsafe(leave_guild(), bot.loop)
-                
-                return jsonify({'message': f'サーバー "{guild.name}" からの退出を実行しました'})
-            else:
-                return jsonify({'message': 'サーバーが見つかりません'})
-        else:
-            return jsonify({'error': 'Botが利用できません'})
+        guild = bot.get_guild(server_id)
+        if guild is None:
+            return web.json_response({'message': 'サーバーが見つかりません'})
+        
+        await guild.leave()
+        print(f"Bot left server {server_id} ({guild.name}) via admin panel")
+        return web.json_response({'message': f'サーバー "{guild.name}" からの退出を実行しました'})
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return web.json_response({'error': str(e)}, status=500)
 
-@app.route('/admin/clear_spam_data', methods=['POST'])
-def clear_spam_data():
+@routes.post('/admin/clear_spam_data')
+async def clear_spam_data(request):
     try:
-        global user_message_history, bot_message_count
         user_message_history.clear()
         bot_message_count.clear()
-        return jsonify({'message': 'スパムデータをクリアしました'})
+        return web.json_response({'message': 'スパムデータをクリアしました'})
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return web.json_response({'error': str(e)}, status=500)
 
-@app.route('/admin/export_data')
-def export_data():
-    try:
-        data = load_data()
-        export_data = {
-            'bot_data': data,
-            'spam_tracking': {
-                'user_message_history': len(user_message_history),
-                'bot_message_count': len(bot_message_count)
-            },
-            'allowed_servers': ALLOWED_SERVERS,
-            'export_timestamp': datetime.now().isoformat()
-        }
-        
-        # Create a BytesIO object to send as file
-        output = io.BytesIO()
-        output.write(json.dumps(export_data, ensure_ascii=False, indent=2).encode('utf-8'))
-        output.seek(0)
-        
-        return send_file(
-            output,
-            mimetype='application/json',
-            as_attachment=True,
-            download_name=f'bot_data_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
-        )
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+EXPORT_SECTIONS = {'levels': 'user_levels', 'warnings': 'warnings', 'tickets': 'tickets', 'polls': 'polls'}
+EXPORT_CHUNK_SIZE = 64 * 1024
 
-def run_flask():
-    port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port)
+def iter_export_records(data, guild_id=None, sections=None, since=None, include_archive=True):
+    """Yield (path, value) pairs of the export, grouped by path prefix; since is a naive local datetime.
 
-intents = discord.Intents.default()
-intents.message_content = True
-intents.members = True
-bot = commands.Bot(command_prefix='!', intents=intents)
+    include_archive adds this bot's compacted tickets; it is off when walking an uploaded document.
+    """
+    def after_since(timestamp):
+        if since is None:
+            return True
+        try:
+            return datetime.fromisoformat(timestamp) >= since
+        except (TypeError, ValueError):
+            return False
 
-bot_start_time = datetime.now()
+    selected = sections or list(EXPORT_SECTIONS)
 
-ALLOWED_SERVERS = [1373116978709139577, 1383225206797242398]
+    if 'levels' in selected:
+        # Level records carry no timestamp, so since does not apply to them
+        for level_guild, guild_levels in data.get('user_levels', {}).items():
+            if guild_id and level_guild != guild_id:
+                continue
+            for user_id, user_level in guild_levels.items():
+                yield ('user_levels', level_guild, user_id), user_level
 
-spam_tracker = {}
+    if 'warnings' in selected:
+        for warning_guild, guild_warnings in data.get('warnings', {}).items():
+            if guild_id and warning_guild != guild_id:
+                continue
+            for user_id, user_warnings in guild_warnings.items():
+                if since is not None:
+                    history = [warning for warning in user_warnings.get('history', []) if after_since(warning.get('timestamp'))]
+                    if not history:
+                        continue
+                    user_warnings = dict(user_warnings, history=history)
+                yield ('warnings', warning_guild, user_id), user_warnings
+
+    if 'tickets' in selected:
+        hot_ticket_ids = {}  # {guild_id: set(ticket_id)}, so archived copies are not exported twice
+        for key, ticket_data in data.get('tickets', {}).items():
+            hot_ticket_ids.setdefault(ticket_data.get('guild_id'), set()).add(int(key.rsplit('-', 1)[-1]))
+            if guild_id and ticket_data.get('guild_id') != guild_id:
+                continue
+            if after_since(ticket_data.get('created_at')):
+                yield ('tickets', key), ticket_data
+        # Compacted tickets are read line by line from the archive
+        if include_archive and os.path.isdir(TICKET_ARCHIVE_DIR):
+            archive_guilds = [guild_id] if guild_id else [name[:-len('.jsonl')] for name in sorted(os.listdir(TICKET_ARCHIVE_DIR)) if name.endswith('.jsonl')]
+            for archive_guild in archive_guilds:
+                for ticket_id, ticket_data in iter_archived_tickets(archive_guild, exclude=hot_ticket_ids.get(archive_guild, set())):
+                    if after_since(ticket_data.get('created_at')):
+                        yield ('tickets', ticket_key(archive_guild, ticket_id)), ticket_data
+
+    if 'polls' in selected:
+        for poll_id, poll_data in data.get('polls', {}).items():
+            if guild_id and str(poll_data.get('guild_id')) != guild_id:
+                continue
+            # The poll ID is the message snowflake, which encodes the creation time
+            if since is not None and poll_id.isdigit():
+                if discord.utils.snowflake_time(int(poll_id)).astimezone().replace(tzinfo=None) < since:
+                    continue
+            yield ('polls', poll_id), poll_data
+
+    # Everything else is global (users, counters...) and only part of an unfiltered export
+    if not guild_id and not sections and since is None:
+        exported = set(EXPORT_SECTIONS.values())
+        for key, value in data.items():
+            if key not in exported:
+                yield (key,), value
+
+class NestedJsonWriter:
+    """Turns (path, value) pairs that arrive grouped by path prefix into one nested JSON object"""
+    def __init__(self):
+        self.stack = []
+        self.first = [True]
+
+    def start(self):
+        return '{'
+
+    def entry(self, path, value):
+        parts = []
+        common = 0
+        while common < len(self.stack) and common < len(path) - 1 and self.stack[common] == path[common]:
+            common += 1
+        while len(self.stack) > common:
+            parts.append('}')
+            self.stack.pop()
+            self.first.pop()
+        for key in path[len(self.stack):-1]:
+            parts.append(('' if self.first[-1] else ',') + json.dumps(str(key)) + ':{')
+            self.first[-1] = False
+            self.stack.append(key)
+            self.first.append(True)
+        parts.append(('' if self.first[-1] else ',') + json.dumps(str(path[-1])) + ':' + json.dumps(value, ensure_ascii=False))
+        self.first[-1] = False
+        return ''.join(parts)
+
+    def finish(self):
+        return '}' * (len(self.stack) + 1)
+
+def iter_byte_chunks(pieces, compress=False):
+    """Encode text pieces into chunks of about EXPORT_CHUNK_SIZE bytes, gzip-compressing on the fly if requested"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer = []
+    buffered = 0
+    for text in pieces:
+        chunk = text.encode('utf-8')
+        if compressor:
+            chunk = compressor.compress(chunk)
+        if chunk:
+            buffer.append(chunk)
+            buffered += len(chunk)
+        if buffered >= EXPORT_CHUNK_SIZE:
+            yield b''.join(buffer)
+            buffer = []
+            buffered = 0
+    if compressor:
+        buffer.append(compressor.flush())
+    if buffer:
+        yield b''.join(buffer)
+
+async def stream_chunks(response, chunks, name):
+    """Produce each chunk in a worker thread and send it from the loop"""
+    while True:
+        chunk = await worker_bridge.call(name, next, chunks, None)
+        if chunk is None:
+            break
+        await response.write(chunk)
+    await response.write_eof()
+
+def iter_export_text(data, meta, export_format, guild_id, sections, since):
+    if export_format == 'jsonl':
+        # One self-describing record per line, so imports can stream it back in
+        yield json.dumps(dict(meta, record_type='meta'), ensure_ascii=False) + '\n'
+        for path, value in iter_export_records(data, guild_id, sections, since):
+            yield json.dumps({'record_type': path[0], 'path': list(path[1:]), 'data': value}, ensure_ascii=False) + '\n'
+        return
+
+    writer = NestedJsonWriter()
+    yield writer.start()
+    has_records = False
+    for path, value in iter_export_records(data, guild_id, sections, since):
+        yield writer.entry(('bot_data',) + path, value)
+        has_records = True
+    if not has_records:
+        yield writer.entry(('bot_data',), {})
+    for key, value in meta.items():
+        yield writer.entry((key,), value)
+    yield writer.finish()
+
+@routes.get('/admin/export_data')
+async def export_data(request):
+    try:
+        guild_id = request.query.get('guild_id') or None
+        section = request.query.get('section') or None
+        export_format = request.query.get('format', 'json')
+        compress = request.query.get('gzip') == '1'
+
+        if section and section not in EXPORT_SECTIONS:
+            return web.json_response({'error': f'不明なセクションです: {section}'}, status=400)
+        if export_format not in ('json', 'jsonl'):
+            return web.json_response({'error': f'不明な形式です: {export_format}'}, status=400)
+
+        since = None
+        if request.query.get('since'):
+            try:
+                since = datetime.fromisoformat(request.query['since'])
+            except ValueError:
+                return web.json_response({'error': 'since はISO形式の日時で指定してください'}, status=400)
+            if since.tzinfo is not None:
+                since = since.astimezone().replace(tzinfo=None)
+
+        filters = {'guild_id': guild_id, 'section': section, 'since': since.isoformat() if since else None}
+        sections = [section] if section else None
+        export_timestamp = datetime.now()
+
+        filename = f'bot_data_export_{export_timestamp.strftime("%Y%m%d_%H%M%S")}'
+        if guild_id:
+            filename += f'_{guild_id}'
+        filename += '.jsonl' if export_format == 'jsonl' else '.json'
+        if compress:
+            filename += '.gz'
+
+        response = web.StreamResponse(headers={
+            'Content-Type': 'application/gzip' if compress else ('application/x-ndjson' if export_format == 'jsonl' else 'application/json'),
+            'Content-Disposition': f'attachment; filename="{filename}"'
+        })
+        await response.prepare(request)
+
+        # Parsing and encoding run in worker threads on a private copy of the data file
+        data = await worker_bridge.call('export_load', load_data)
+        meta = {
+            'spam_tracking': {
+                'user_message_history': len(user_message_history),
+                'bot_message_count': len(bot_message_count)
+            },
+            'allowed_servers': allowlist.to_list(),
+            'export_timestamp': export_timestamp.isoformat(),
+            'filters': filters
+        }
+
+        await stream_chunks(response, iter_byte_chunks(iter_export_text(data, meta, export_format, guild_id, sections, since), compress), 'export_chunk')
+        return response
+    except Exception as e:
+        print(f"Error exporting data: {e}")
+        if 'response' in locals() and response.prepared:
+            raise
+        return web.json_response({'error': str(e)}, status=500)
+
+IMPORT_BATCH_SIZE = 500
+IMPORT_FLUSH_BATCHES = 20  # batches merged into the data file per load/save
+IMPORT_STRATEGIES = ('overwrite', 'keep-max-xp', 'append-warnings')
+IMPORT_MAX_ERRORS = 20
+IMPORT_JOB_TTL = 3600  # seconds a finished job's progress stays queryable
+import_jobs = {}  # {job_id: progress}
+import_job_counter = itertools.count(1)
+
+def prune_import_jobs():
+    cutoff = time.time() - IMPORT_JOB_TTL
+    for job_id in [job_id for job_id, job in import_jobs.items() if job['finished_at'] and job['finished_at'] < cutoff]:
+        del import_jobs[job_id]
+
+def validate_import_record(record):
+    """Return (section, path, data) for a valid export record, or raise ValueError"""
+    if not isinstance(record, dict):
+        raise ValueError('レコードがオブジェクトではありません')
+    section = record.get('record_type')
+    path = record.get('path')
+    data = record.get('data')
+    if section not in EXPORT_SECTIONS.values():
+        raise ValueError(f'未対応のレコード種別です: {section}')
+    if not isinstance(path, list) or not isinstance(data, dict):
+        raise ValueError('path または data の形式が不正です')
+    path = [str(key) for key in path]
+
+    if section == 'user_levels':
+        if len(path) != 2:
+            raise ValueError('レベルのpathは [サーバーID, ユーザーID] です')
+        for field in ('level', 'xp', 'total_xp'):
+            if not isinstance(data.get(field), int) or data[field] < 0:
+                raise ValueError(f'レベルの {field} が不正です')
+    elif section == 'warnings':
+        if len(path) != 2:
+            raise ValueError('警告のpathは [サーバーID, ユーザーID] です')
+        if not isinstance(data.get('count'), int) or not isinstance(data.get('history', []), list):
+            raise ValueError('警告の count または history が不正です')
+        for warning in data.get('history', []):
+            if not isinstance(warning, dict) or 'timestamp' not in warning:
+                raise ValueError('警告履歴に timestamp がありません')
+    elif section == 'tickets':
+        if data.get('status') not in ('open', 'closed') or 'guild_id' not in data or 'user_id' not in data:
+            raise ValueError('チケットの status / guild_id / user_id が不正です')
+        if len(path) == 1 and path[0].isdigit():
+            # Exports of a bot that still has globally numbered tickets carry the old keys
+            path = [ticket_key(data['guild_id'], path[0])]
+        if len(path) != 1 or not path[0].rpartition('-')[2].isdigit() or path[0].rpartition('-')[0] != str(data['guild_id']):
+            raise ValueError('チケットのpathは [サーバーID-チケット番号] です')
+    elif section == 'polls':
+        if len(path) != 1:
+            raise ValueError('投票のpathは [投票ID] です')
+        if not isinstance(data.get('options'), list) or not isinstance(data.get('votes'), list) or len(data['options']) != len(data['votes']):
+            raise ValueError('投票の options / votes が不正です')
+        if not isinstance(data.get('closed', False), bool):
+            raise ValueError('投票の closed が不正です')
+        if data.get('ends_at') is not None and (isinstance(data['ends_at'], bool) or not isinstance(data['ends_at'], (int, float))):
+            raise ValueError('投票の ends_at が不正です')
+        # Closed polls have their voters moved to the archive; open ones need the map to record votes
+        if not isinstance(data.get('voters', {}), dict) or (not data.get('closed') and 'voters' not in data):
+            raise ValueError('投票の voters が不正です')
+    return section, path, data
+
+def merge_import_poll(poll_id, record, strategy):
+    """Polls live in memory and are flushed through the poll store, so they are merged on the loop"""
+    if poll_id in active_polls and strategy != 'overwrite':
+        return False
+    active_polls[poll_id] = record
+    dirty_polls.add(poll_id)
+    # Same rule as after a restart: an open timed poll gets its close job, one already past its end closes right away
+    if record.get('ends_at') and not record.get('closed'):
+        schedule_poll_close(poll_id, record['ends_at'])
+    else:
+        scheduler.cancel(f"poll:{poll_id}")
+    return True
+
+def merge_import_record(data, section, path, record, strategy):
+    """Apply one validated record to the loaded data; returns True if anything changed. Touches nothing but data"""
+    if section == 'tickets':
+        tickets = data.setdefault('tickets', {})
+        if path[0] in tickets and strategy != 'overwrite':
+            return False
+        tickets[path[0]] = record
+        guild_id, ticket_id = path[0].split('-', 1)
+        counters = data.setdefault('ticket_counters', {})
+        counters[guild_id] = max(counters.get(guild_id, 0), int(ticket_id))
+        return True
+
+    guild_records = data.setdefault(section, {}).setdefault(path[0], {})
+    existing = guild_records.get(path[1])
+    if existing is None or strategy == 'overwrite':
+        guild_records[path[1]] = record
+        return True
+
+    if section == 'user_levels' and strategy == 'keep-max-xp':
+        if record['total_xp'] > existing.get('total_xp', 0):
+            guild_records[path[1]] = record
+            return True
+        return False
+
+    if section == 'warnings' and strategy == 'append-warnings':
+        seen = {(warning.get('timestamp'), warning.get('reason')) for warning in existing.get('history', [])}
+        added = [warning for warning in record.get('history', []) if (warning.get('timestamp'), warning.get('reason')) not in seen]
+        if not added:
+            return False
+        existing.setdefault('history', []).extend(added)
+        existing['history'].sort(key=lambda warning: warning['timestamp'])
+        existing['count'] = existing.get('count', 0) + len(added)
+        return True
+
+    # The strategy targets another section; existing records are kept
+    return False
+
+def merge_import_records(data, records, strategy):
+    """update_data mutation for an import flush; returns the applied records as stored after merging"""
+    applied = []
+    for section, path, record in records:
+        if merge_import_record(data, section, path, record, strategy):
+            stored = data[section][path[0]] if section == 'tickets' else data[section][path[0]][path[1]]
+            applied.append((section, path, stored))
+    return bool(applied), (applied, len(records) - len(applied))
+
+async def flush_import_records(pending, strategy, job):
+    """Merge the pending records with one load/save of the data file, done in a worker thread"""
+    if not pending:
+        return
+    # Taken off the list first so a failed flush is never retried with the same records
+    records = pending[:]
+    pending.clear()
+    applied, skipped = await update_data(lambda data: merge_import_records(data, records, strategy))
+    job['applied'] += len(applied)
+    job['skipped'] += skipped
+    for section, path, stored in applied:
+        if section == 'user_levels':
+            user_index.set_level(path[1], path[0], stored.get('level', 1), stored.get('total_xp', 0))
+        elif section == 'warnings':
+            user_index.set_warnings(path[1], path[0], stored.get('count', 0))
+        elif section == 'tickets':
+            guild_id, ticket_id = path[0].split('-', 1)
+            # The replaced record may have been an open ticket; drop its entry before indexing the new one
+            unindex_open_ticket(guild_id, int(ticket_id))
+            index_ticket(guild_id, int(ticket_id), stored)
+
+def apply_import_batch(batch, strategy, job, pending):
+    """Merge polls right away and queue everything else for the next data file flush"""
+    for section, path, record in batch:
+        if section != 'polls':
+            pending.append((section, path, record))
+        elif merge_import_poll(path[0], record, strategy):
+            job['applied'] += 1
+        else:
+            job['skipped'] += 1
+    job['batches'] += 1
+
+async def iter_upload_lines(request, job):
+    """Yield the uploaded body line by line, transparently un-gzipping it"""
+    decompressor = None
+    pending = b''
+    head = b''  # held back until the two bytes of the gzip magic number are known
+    async for chunk in request.content.iter_chunked(EXPORT_CHUNK_SIZE):
+        job['bytes_read'] += len(chunk)
+        if head is not None:
+            head += chunk
+            if len(head) < 2:
+                continue
+            if head[:2] == b'\x1f\x8b':
+                decompressor = zlib.decompressobj(31)
+            chunk, head = head, None
+        if decompressor:
+            chunk = decompressor.decompress(chunk)
+        pending += chunk
+        *lines, pending = pending.split(b'\n')
+        for line in lines:
+            yield line
+    if head:
+        pending += head
+    if decompressor:
+        pending += decompressor.flush()
+    for line in pending.split(b'\n'):
+        yield line
+
+def import_job_summary(job):
+    elapsed = max((job.get('finished_at') or time.time()) - job['started_at'], 0.001)
+    summary = dict(job)
+    summary['elapsed_seconds'] = round(elapsed, 2)
+    summary['records_per_second'] = round(job['records'] / elapsed, 1)
+    summary['bytes_per_second'] = round(job['bytes_read'] / elapsed, 1)
+    return summary
+
+@routes.post('/admin/import_data')
+async def import_data(request):
+    strategy = request.query.get('strategy', 'overwrite')
+    if strategy not in IMPORT_STRATEGIES:
+        return web.json_response({'error': f'不明なマージ方式です: {strategy}'}, status=400)
+
+    prune_import_jobs()
+    job_id = str(next(import_job_counter))
+    job = import_jobs[job_id] = {
+        'job_id': job_id,
+        'strategy': strategy,
+        'status': 'running',
+        'format': None,
+        'bytes_read': 0,
+        'records': 0,
+        'applied': 0,
+        'skipped': 0,
+        'invalid': 0,
+        'batches': 0,
+        'errors': [],
+        'started_at': time.time(),
+        'finished_at': None
+    }
+
+    def reject(line_number, message):
+        job['invalid'] += 1
+        if len(job['errors']) < IMPORT_MAX_ERRORS:
+            job['errors'].append(f'{line_number}行目: {message}')
+
+    pending = []
+    try:
+        # Imported tickets replace indexed ones, so the index must exist before the first flush
+        ensure_ticket_index()
+        batch = []
+        document_lines = None
+        line_number = 0
+        async for line in iter_upload_lines(request, job):
+            line_number += 1
+            if document_lines is not None:
+                document_lines.append(line)
+                continue
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+
+            if job['format'] is None:
+                # JSONL exports are self-describing records; anything else is a whole JSON document
+                if not (isinstance(record, dict) and 'record_type' in record):
+                    job['format'] = 'json'
+                    document_lines = [line]
+                    continue
+                job['format'] = 'jsonl'
+            if isinstance(record, dict) and record.get('record_type') == 'meta':
+                continue
+
+            job['records'] += 1
+            if record is None:
+                reject(line_number, 'JSONとして解析できません')
+                continue
+            try:
+                batch.append(validate_import_record(record))
+            except ValueError as e:
+                reject(line_number, str(e))
+                continue
+
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                apply_import_batch(batch, strategy, job, pending)
+                batch = []
+                if job['batches'] % IMPORT_FLUSH_BATCHES == 0:
+                    await flush_import_records(pending, strategy, job)
+                admin_events.publish('import_progress', import_job_summary(job))
+                await asyncio.sleep(0)
+
+        if document_lines is not None:
+            # A JSON document cannot be parsed incrementally without an extra dependency, so it is read whole
+            document = await worker_bridge.call('import_parse', json.loads, b'\n'.join(document_lines))
+            for path, value in iter_export_records(document.get('bot_data', {}), include_archive=False):
+                if path[0] not in EXPORT_SECTIONS.values():
+                    continue
+                job['records'] += 1
+                try:
+                    batch.append(validate_import_record({'record_type': path[0], 'path': list(path[1:]), 'data': value}))
+                except ValueError as e:
+                    reject(job['records'], str(e))
+                    continue
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    apply_import_batch(batch, strategy, job, pending)
+                    batch = []
+                    if job['batches'] % IMPORT_FLUSH_BATCHES == 0:
+                        await flush_import_records(pending, strategy, job)
+                    admin_events.publish('import_progress', import_job_summary(job))
+                    await asyncio.sleep(0)
+
+        if batch:
+            apply_import_batch(batch, strategy, job, pending)
+        await flush_import_records(pending, strategy, job)
+        job['status'] = 'completed'
+    except Exception as e:
+        print(f"Error importing data: {e}")
+        job['status'] = 'failed'
+        job['errors'].append(str(e))
+        # Keep what was already validated, as an upload cut off midway still applied its earlier batches
+        try:
+            await flush_import_records(pending, strategy, job)
+        except Exception as flush_error:
+            print(f"Error saving partial import: {flush_error}")
+    finally:
+        job['finished_at'] = time.time()
+        stats_aggregator.request_reseed()
+
+    summary = import_job_summary(job)
+    admin_events.publish('import_progress', summary)
+    return web.json_response(summary, status=200 if job['status'] == 'completed' else 500)
+
+@routes.get(r'/admin/import_data/{job_id:\d+}')
+async def import_data_status(request):
+    job = import_jobs.get(request.match_info['job_id'])
+    if job is None:
+        return web.json_response({'error': 'インポートジョブが見つかりません'}, status=404)
+    return web.json_response(import_job_summary(job))
+
+@routes.get('/admin/http_metrics')
+async def admin_http_metrics(request):
+    return web.json_response(http_metrics.summary())
+
+@routes.get('/metrics')
+async def prometheus_metrics(request):
+    """Prometheus text exposition of the bot's counters and histograms"""
+    return web.Response(body=metrics.render().encode('utf-8'), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+LOOP_LAG_INTERVAL = 0.5  # seconds between loop heartbeats
+LOOP_LAG_THRESHOLD = float(os.environ.get('LOOP_LAG_THRESHOLD', 0.25))  # seconds of lag that count as a stall
+LOOP_LAG_ALERT_CHANNEL_ID = os.environ.get('LOOP_LAG_ALERT_CHANNEL_ID')
+LOOP_LAG_ALERT_COOLDOWN = 300
+LOOP_STALL_HISTORY = 50
+
+loop_lag_seconds = metrics.register(MetricHistogram('bot_loop_lag_seconds', 'Event loop scheduling lag of the heartbeat task'))
+loop_stalls = metrics.register(MetricCounter('bot_loop_stalls_total', 'Event loop stalls over the threshold by blocking function', ('function',)))
+
+class LoopWatchdog:
+    """Measure event loop lag and, from a helper thread, capture what is blocking the loop"""
+    def __init__(self, interval, threshold):
+        self.interval = interval
+        self.threshold = threshold
+        self.loop = None
+        self.loop_thread_id = None
+        self.last_beat = 0.0
+        self.max_lag = 0.0
+        self.stalls = deque(maxlen=LOOP_STALL_HISTORY)
+        self.pending = []  # stalls captured by the helper thread, not yet reported on the loop
+        self.pending_lock = Lock()
+        self.last_alert = 0.0
+        self.task = None
+        self.thread = None
+
+    def start(self):
+        if self.task is not None and not self.task.done():
+            return
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = get_ident()
+        self.last_beat = time.monotonic()
+        self.task = asyncio.create_task(self._heartbeat())
+        if self.thread is None:
+            self.thread = Thread(target=self._watch, name='loop-watchdog', daemon=True)
+            self.thread.start()
+
+    async def _heartbeat(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.last_beat = time.monotonic()
+            lag = max(self.last_beat - started - self.interval, 0)
+            loop_lag_seconds.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            with self.pending_lock:
+                captured, self.pending = self.pending, []
+            for stall in captured:
+                # The stall ended with this heartbeat, so its full length is known now
+                stall['lag_ms'] = round(lag * 1000, 1)
+                loop_stalls.inc(stall['function'])
+                admin_events.publish('loop_stall', stall)
+                print(f"Event loop blocked for {stall['lag_ms']}ms in {stall['function']} (task: {stall['task']})")
+                # Sending the alert must not hold up the next heartbeat
+                asyncio.create_task(self.alert(stall))
+
+    def _watch(self):
+        """Helper thread; it keeps running while the loop thread is stuck"""
+        captured_beat = None
+        while True:
+            time.sleep(self.interval / 2)
+            beat = self.last_beat
+            if beat == captured_beat or time.monotonic() - beat - self.interval < self.threshold:
+                continue
+            # Capture once per stall, while the loop thread is still inside the blocking call
+            captured_beat = beat
+            try:
+                stall = self.capture()
+            except Exception as e:
+                print(f"Error capturing event loop stack: {e}")
+                continue
+            if stall:
+                with self.pending_lock:
+                    self.stalls.append(stall)
+                    self.pending.append(stall)
+
+    def capture(self):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None:
+            return None
+        # The outermost coroutine frame is the one the running task was created from;
+        # asyncio.current_task() cannot be asked from this thread while the loop runs
+        task_name = None
+        walker = frame
+        while walker is not None:
+            if walker.f_code.co_flags & inspect.CO_COROUTINE:
+                task_name = getattr(walker.f_code, 'co_qualname', walker.f_code.co_name)
+            walker = walker.f_back
+        stack = traceback.extract_stack(frame)
+        # Blame the innermost frame in this file; library frames below it are the blocking call itself
+        own_frames = [entry for entry in stack if entry.filename == __file__]
+        culprit = own_frames[-1] if own_frames else stack[-1]
+        return {
+            'at': datetime.now().isoformat(),
+            'function': f'{culprit.name}:{culprit.lineno}',
+            'task': task_name,
+            'stack': [f'{os.path.basename(entry.filename)}:{entry.lineno} {entry.name}' for entry in stack[-12:]],
+            'lag_ms': None
+        }
+
+    async def alert(self, stall):
+        if not LOOP_LAG_ALERT_CHANNEL_ID or time.time() - self.last_alert < LOOP_LAG_ALERT_COOLDOWN:
+            return
+        channel = bot.get_channel(int(LOOP_LAG_ALERT_CHANNEL_ID))
+        if channel is None:
+            return
+        self.last_alert = time.time()
+        embed = discord.Embed(
+            title='🐢 イベントループの遅延を検知',
+            description=f"**{stall['lag_ms']}ms** の間ブロックされました\n**関数:** `{stall['function']}`\n**タスク:** `{stall['task']}`",
+            color=0xff9900
+        )
+        embed.add_field(name='スタック', value='```\n' + '\n'.join(stall['stack'][-6:])[:1000] + '\n```', inline=False)
+        try:
+            await channel.send(embed=embed)
+        except Exception as e:
+            print(f"Error sending loop lag alert: {e}")
+
+    def summary(self):
+        with self.pending_lock:
+            stalls = list(self.stalls)
+        return {
+            'threshold_ms': round(self.threshold * 1000, 1),
+            'max_lag_ms': round(self.max_lag * 1000, 1),
+            'stall_count': len(stalls),
+            'stalls': stalls[::-1]
+        }
+
+loop_watchdog = LoopWatchdog(LOOP_LAG_INTERVAL, LOOP_LAG_THRESHOLD)
+
+@routes.get('/admin/loop_lag')
+async def admin_loop_lag(request):
+    return web.json_response(loop_watchdog.summary())
+
+@routes.get(r'/admin/ticket_transcript/{guild_id}/{ticket_id:\d+}')
+async def ticket_transcript(request):
+    try:
+        guild_id = request.match_info['guild_id']
+        ticket_id = int(request.match_info['ticket_id'])
+
+        def find_ticket():
+            ticket_data = load_data().get('tickets', {}).get(ticket_key(guild_id, ticket_id))
+            return ticket_data if ticket_data is not None else find_archived_ticket(guild_id, ticket_id)
+
+        ticket_data = await worker_bridge.call('transcript_lookup', find_ticket)
+        transcript = ticket_data.get('transcript') if ticket_data else None
+        if not transcript or not os.path.exists(transcript):
+            return web.json_response({'error': 'トランスクリプトが見つかりません'}, status=404)
+
+        if request.query.get('format') == 'html':
+            response = web.StreamResponse(headers={'Content-Type': 'text/html; charset=utf-8'})
+            await response.prepare(request)
+            await stream_chunks(response, iter_byte_chunks(iter_transcript_html(transcript, f'チケット #{ticket_id}')), 'transcript_chunk')
+            return response
+
+        # The stored file is already gzip'd JSONL; stream it as-is
+        return web.FileResponse(transcript, headers={
+            'Content-Type': 'application/gzip',
+            'Content-Disposition': f'attachment; filename="{os.path.basename(transcript)}"'
+        })
+    except Exception as e:
+        return web.json_response({'error': str(e)}, status=500)
+
+admin_runner = None
+
+async def start_admin_server():
+    """Serve the admin API from the bot's own event loop"""
+    global admin_runner
+    app = web.Application(middlewares=[http_metrics_middleware])
+    app.add_routes(routes)
+    admin_runner = web.AppRunner(app, access_log=None)
+    await admin_runner.setup()
+    port = int(os.environ.get('PORT', 5000))
+    await web.TCPSite(admin_runner, '0.0.0.0', port).start()
+    print(f"Admin HTTP server started on port {port}")
+
+async def run_services(token):
+    """Bind the HTTP port first, so health checks answer even if the Discord login fails"""
+    global bot_start_error
+    discord.utils.setup_logging()
+    await start_admin_server()
+    try:
+        async with bot:
+            await bot.start(token)
+    except Exception as e:
+        # /health reports the failure instead of the port disappearing with the process
+        bot_start_error = f'{type(e).__name__}: {e}'
+        print(f"Discord bot stopped: {bot_start_error}")
+        await asyncio.Event().wait()
+
+ALLOWLIST_FILE = 'allowed_servers.json'
+DEFAULT_ALLOWED_SERVERS = [1373116978709139577, 1383225206797242398]
+# Commands that manage the allowlist itself must work from any server
+ALLOWLIST_EXEMPT_COMMANDS = {'use_bot', 'leave_bot', 'perf'}
+PURCHASE_MESSAGE = '❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq'
+
+class AllowlistService:
+    """Allowed guild IDs; readers see an immutable frozenset that writers swap on change"""
+    def __init__(self, path, defaults):
+        self.path = path
+        self.snapshot = frozenset(defaults)
+        self.write_lock = Lock()
+
+    def load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.snapshot = frozenset(int(guild_id) for guild_id in json.load(f))
+        except Exception as e:
+            print(f"Error loading allowlist: {e}")
+
+    def save(self, snapshot):
+        # Write to a temporary file and rename, so a crash never leaves a truncated allowlist
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(sorted(snapshot), f, indent=2)
+        os.replace(temp_path, self.path)
+
+    def contains(self, guild_id):
+        return guild_id in self.snapshot
+
+    def add(self, guild_id):
+        with self.write_lock:
+            if guild_id in self.snapshot:
+                return False
+            snapshot = self.snapshot | {guild_id}
+            self.save(snapshot)
+            self.snapshot = snapshot
+            return True
+
+    def remove(self, guild_id):
+        with self.write_lock:
+            if guild_id not in self.snapshot:
+                return False
+            snapshot = self.snapshot - {guild_id}
+            self.save(snapshot)
+            self.snapshot = snapshot
+            return True
+
+    def __len__(self):
+        return len(self.snapshot)
+
+    def to_list(self):
+        return sorted(self.snapshot)
+
+allowlist = AllowlistService(ALLOWLIST_FILE, DEFAULT_ALLOWED_SERVERS)
+allowlist.load()
+
+class AllowlistCommandTree(discord.app_commands.CommandTree):
+    async def interaction_check(self, interaction: discord.Interaction):
+        """Single allowlist gate for every slash command"""
+        if interaction.command:
+            # interaction_check runs in the task that invokes the command, so the usage record follows it
+            interaction.extras['usage'], _ = start_command_usage(interaction.command.qualified_name, INTERACTION_RESPONSE_ROUTE)
+        if interaction.command and interaction.command.name in ALLOWLIST_EXEMPT_COMMANDS:
+            return True
+        if interaction.guild is not None and allowlist.contains(interaction.guild.id):
+            return True
+        await interaction.response.send_message(PURCHASE_MESSAGE, ephemeral=True)
+        return False
+
+    async def on_error(self, interaction: discord.Interaction, error):
+        if interaction.command:
+            command_errors.inc(interaction.command.qualified_name)
+            finish_command_usage(interaction, True)
+        await super().on_error(interaction, error)
+
+def finish_command_usage(interaction, failed):
+    usage = interaction.extras.pop('usage', None)
+    if usage is not None:
+        command_perf.record(usage, failed)
+
+intents = discord.Intents.default()
+intents.message_content = True
+intents.members = True
+bot = commands.Bot(command_prefix='!', intents=intents, tree_cls=AllowlistCommandTree, http_trace=rest_trace)
+
+bot_start_time = datetime.now()
+
+spam_tracker = {}
 bot_spam_tracker = {}
 
 user_message_history = {}
@@ -1386,18 +3010,183 @@ def load_data():
         'user_levels': {}
     }
 
-def save_data(data):
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
+# Bumped by every save on the loop; work done in a worker thread checks it to detect saves made meanwhile
+data_generation = 0
+
+def write_data_file(data, path):
+    with open(path, 'w', encoding='utf-8') as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+        return f.tell()
+
+def save_data(data):
+    global data_generation
+    started = time.perf_counter()
+    # Written aside and renamed, so readers in worker threads never see a half-written file
+    temp_path = DATA_FILE + '.tmp'
+    size = write_data_file(data, temp_path)
+    os.replace(temp_path, DATA_FILE)
+    data_generation += 1
+    record_storage_write('bot_data', started, size)
+
+def prepare_data_update(data, mutate):
+    """Worker-thread half of update_data: apply mutate and write the result next to the data file"""
+    changed, result = mutate(data)
+    if not changed:
+        return False, result, None, 0
+    # One file per call: executor threads are reused, so overlapping updates may share a thread
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(DATA_FILE) or '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        return True, result, temp_path, write_data_file(data, temp_path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+async def update_data(mutate):
+    """Load, change and save the data file with parsing and dumping done in a worker thread.
+
+    mutate(data) returns (changed, result) and must only touch data. If the loop saved the file while
+    the worker was busy, the change is redone synchronously on fresh data so neither write is lost.
+    """
+    global data_generation
+    generation = data_generation
+    started = time.perf_counter()
+    data = await worker_bridge.call('update_data_load', load_data)
+    if generation == data_generation:
+        changed, result, temp_path, size = await worker_bridge.call('update_data_write', prepare_data_update, data, mutate)
+        if not changed:
+            return result
+        if generation == data_generation:
+            os.replace(temp_path, DATA_FILE)
+            data_generation += 1
+            record_storage_write('bot_data', started, size)
+            return result
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+
+    data = load_data()
+    changed, result = mutate(data)
+    if changed:
+        save_data(data)
+    return result
+
+class TaskScheduler:
+    """Run timed jobs from a single background task instead of one sleeper per job"""
+    def __init__(self):
+        self.heap = []  # [(when, seq, key)]
+        self.jobs = {}  # {key: (when, callback)}
+        self.seq = 0
+        self.wakeup = None
+        self.task = None
+
+    def schedule(self, key, when, callback):
+        """Run callback (a coroutine function) at unix time `when`, replacing any job with the same key"""
+        self.jobs[key] = (when, callback)
+        self.seq += 1
+        heapq.heappush(self.heap, (when, self.seq, key))
+        if self.wakeup:
+            self.wakeup.set()
+
+    def cancel(self, key):
+        # Heap entries of cancelled jobs are discarded lazily
+        self.jobs.pop(key, None)
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self._run())
+
+    def _next_due(self):
+        while self.heap:
+            when, _, key = self.heap[0]
+            job = self.jobs.get(key)
+            if job is not None and job[0] == when:
+                return when
+            heapq.heappop(self.heap)
+        return None
+
+    async def _run(self):
+        while True:
+            when = self._next_due()
+            delay = None if when is None else when - time.time()
+            if delay is None or delay > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            when, _, key = heapq.heappop(self.heap)
+            _, callback = self.jobs.pop(key)
+            scheduler_lag_seconds.observe(max(time.time() - when, 0))
+            asyncio.create_task(self._execute(key, callback))
+
+    async def _execute(self, key, callback):
+        try:
+            await callback()
+        except Exception as e:
+            print(f"Error running scheduled job {key}: {e}")
+
+scheduler = TaskScheduler()
+
+class MessageEditDebouncer:
+    """Coalesce edits so each message is edited at most once per interval"""
+    def __init__(self, interval):
+        self.interval = interval
+        self.pending = {}  # {key: (message, render)}
+        self.tasks = {}  # {key: task}
+
+    def schedule(self, key, message, render):
+        # Only the latest render is kept; it is evaluated when the edit is sent
+        # and may return None to skip the edit (e.g. the poll has since closed)
+        self.pending[key] = (message, render)
+        if key not in self.tasks:
+            self.tasks[key] = asyncio.create_task(self._run(key))
+
+    async def _run(self, key):
+        try:
+            while key in self.pending:
+                message, render = self.pending.pop(key)
+                try:
+                    edit_kwargs = render()
+                    if edit_kwargs is None:
+                        continue
+                    await message.edit(**edit_kwargs)
+                except Exception as e:
+                    print(f"Error editing message for {key}: {e}")
+                await asyncio.sleep(self.interval)
+        finally:
+            self.tasks.pop(key, None)
+
+    def cancel(self, key):
+        """Drop the pending edit for key; an edit already being sent still completes"""
+        self.pending.pop(key, None)
+
+def parse_duration(duration):
+    """Parse durations like 30m, 2h or 1d into seconds"""
+    units = {'m': 60, 'h': 3600, 'd': 86400}
+    if not duration or duration[-1] not in units:
+        raise ValueError("Invalid format")
+    seconds = int(duration[:-1]) * units[duration[-1]]
+    if seconds <= 0:
+        raise ValueError("Duration must be positive")
+    return seconds
 
 # Persistent views storage
 persistent_views = {}
 
 def save_persistent_views():
     """Save persistent view data"""
+    # Every add and prune ends in a save, which rewrites the whole file anyway, so the index is rebuilt here
+    index_view_entries()
     try:
+        started = time.perf_counter()
         with open('persistent_views.json', 'w', encoding='utf-8') as f:
             json.dump(persistent_views, f, ensure_ascii=False, indent=2)
+            size = f.tell()
+        record_storage_write('persistent_views', started, size)
     except Exception as e:
         print(f"Error saving persistent views: {e}")
 
@@ -1416,41 +3205,164 @@ async def restore_persistent_views():
     """Restore persistent views after bot restart"""
     load_persistent_views()
     
-    # Restore ticket panel views
+    # Buttons are routed by custom_id prefix, so one registration per type
+    # covers every panel regardless of how many exist
+    bot.add_dynamic_items(PollVoteButton, GiveawayJoinButton, TicketCloseButton, SpecificRoleButton)
+    bot.add_view(TicketPanelView())
+    bot.add_view(PublicAuthView())
+    
+    # Panels created before custom_ids carried their target share fixed custom_ids;
+    # they are resolved through the message index until migrated
+    index_view_entries()
+    bot.add_view(LegacyPanelView())
+    
+    print(f"Restored {len(persistent_views)} persistent views")
+
+view_keys_by_message = {}  # {(message_id, type): persistent_views key}
+
+def index_view_entries():
+    view_keys_by_message.clear()
     for view_id, view_data in persistent_views.items():
+        if view_data.get('message_id'):
+            view_keys_by_message[(view_data['message_id'], view_data['type'])] = view_id
+
+def find_view_entry(message_id, view_type):
+    """O(1) lookup of a panel's entry by the clicked message; misses are answered from the index alone"""
+    view_id = view_keys_by_message.get((str(message_id), view_type))
+    return persistent_views.get(view_id) if view_id else None
+
+async def migrate_legacy_panels():
+    """Re-send the buttons of older panels with custom_ids that encode their ticket or role"""
+    migrated = 0
+    for view_id, view_data in list(persistent_views.items()):
+        if 'custom_id' in view_data or view_data['type'] not in ('ticket_close', 'specific_role'):
+            continue
         try:
-            if view_data['type'] == 'ticket_panel':
-                view = TicketPanelView(view_data.get('category_name'))
-                bot.add_view(view)
-                print(f"Restored TicketPanelView: {view_id}")
-            elif view_data['type'] == 'ticket_close':
+            channel = bot.get_channel(int(view_data['channel_id']))
+            if channel is None:
+                continue
+            if view_data['type'] == 'ticket_close':
                 view = TicketCloseView(view_data['ticket_id'])
-                bot.add_view(view)
-                print(f"Restored TicketCloseView for ticket {view_data['ticket_id']}")
-            elif view_data['type'] == 'public_auth':
-                view = PublicAuthView()
-                bot.add_view(view)
-                print(f"Restored PublicAuthView: {view_id}")
-            elif view_data['type'] == 'specific_role':
-                guild = bot.get_guild(int(view_data['guild_id']))
-                if guild:
-                    role = guild.get_role(int(view_data['role_id']))
-                    if role:
-                        view = SpecificRoleView(role)
-                        bot.add_view(view)
-                        print(f"Restored SpecificRoleView for role {role.name}")
+                custom_id = f"ticket_close:{view_data['ticket_id']}"
+            else:
+                role = channel.guild.get_role(int(view_data['role_id']))
+                if role is None:
+                    continue
+                view = SpecificRoleView(role)
+                custom_id = f"role:{role.id}"
+            await channel.get_partial_message(int(view_data['message_id'])).edit(view=view)
+            view_data['custom_id'] = custom_id
+            migrated += 1
+        except discord.NotFound:
+            persistent_views.pop(view_id, None)
         except Exception as e:
-            print(f"Error restoring view {view_id}: {e}")
-    
-    print(f"Restored {len(persistent_views)} persistent views")
+            print(f"Error migrating panel {view_id}: {e}")
+        await asyncio.sleep(1)
+
+    save_persistent_views()
+    print(f"Migrated {migrated} legacy panels to encoded custom_ids")
+
+class LegacyPanelView(discord.ui.View):
+    """Handles the fixed custom_ids of older panels by looking up the clicked message's entry"""
+    def __init__(self):
+        super().__init__(timeout=None)
+
+    @discord.ui.button(label='🔒 チケットを閉じる', style=discord.ButtonStyle.danger, emoji='🔒', custom_id='close_ticket_button')
+    async def close_ticket(self, interaction: discord.Interaction, button: discord.ui.Button):
+        view_data = find_view_entry(interaction.message.id, 'ticket_close')
+        if view_data is None:
+            await interaction.response.send_message('❌ チケットが見つかりません。', ephemeral=True)
+            return
+        await close_ticket_from_button(interaction, view_data['ticket_id'])
+
+    @discord.ui.button(label='ろーるをしゅとく！', style=discord.ButtonStyle.primary, custom_id='specific_role_button')
+    async def get_role_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        view_data = find_view_entry(interaction.message.id, 'specific_role')
+        role = interaction.guild.get_role(int(view_data['role_id'])) if view_data else None
+        if role is None:
+            await interaction.response.send_message('❌ ロールが見つかりません。削除された可能性があります。', ephemeral=True)
+            return
+        await grant_specific_role(interaction, role)
+
+VIEW_JANITOR_INTERVAL = 12 * 60 * 60
+clicked_view_messages = set()  # IDs of bot messages whose components were used since the last janitor pass
+
+@bot.event
+async def on_interaction(interaction):
+    if interaction.type == discord.InteractionType.component and interaction.message is not None and interaction.message.author == bot.user:
+        clicked_view_messages.add(str(interaction.message.id))
+
+async def prune_persistent_views():
+    """Drop registry entries whose channel or message no longer exists"""
+    pruned = 0
+    fetched = 0
+    # A message clicked since the last pass still exists, so only the others need a fetch
+    clicked = set(clicked_view_messages)
+    clicked_view_messages.clear()
+    for view_id, view_data in list(persistent_views.items()):
+        channel_id = view_data.get('channel_id')
+        message_id = view_data.get('message_id')
+        # Entries removed while the janitor slept (a poll closing, say) need no check
+        if not channel_id or not message_id or str(message_id) in clicked or view_id not in persistent_views:
+            continue
+        try:
+            guild = bot.get_guild(int(view_data['guild_id'])) if view_data.get('guild_id') else None
+            channel = bot.get_channel(int(channel_id))
+            if channel is None:
+                # The guild being unavailable is an outage, not a deletion
+                if guild is not None and guild.unavailable:
+                    continue
+                persistent_views.pop(view_id, None)
+                pruned += 1
+                continue
+        except Exception as e:
+            print(f"Error checking persistent view {view_id}: {e}")
+            continue
+        fetched += 1
+        try:
+            await channel.fetch_message(int(message_id))
+        except discord.NotFound:
+            persistent_views.pop(view_id, None)
+            pruned += 1
+        except Exception as e:
+            print(f"Error checking persistent view {view_id}: {e}")
+        # One message fetch at a time keeps the janitor well under the rate limits
+        await asyncio.sleep(1)
+
+    if pruned:
+        save_persistent_views()
+        print(f"Pruned {pruned} stale persistent views")
+    print(f"View janitor fetched {fetched} panel messages")
+    return pruned
+
+async def run_view_janitor():
+    try:
+        await prune_persistent_views()
+    finally:
+        scheduler.schedule('view_janitor', time.time() + VIEW_JANITOR_INTERVAL, run_view_janitor)
 
 def is_allowed_server(guild_id):
-    return guild_id in ALLOWED_SERVERS
+    return allowlist.contains(guild_id)
+
+@bot.event
+async def on_app_command_completion(interaction, command):
+    finish_command_usage(interaction, False)
+
+@bot.before_invoke
+async def start_prefix_command_usage(ctx):
+    ctx.usage, ctx.usage_token = start_command_usage(f'!{ctx.command.qualified_name}', CHANNEL_MESSAGE_ROUTE)
+
+@bot.after_invoke
+async def finish_prefix_command_usage(ctx):
+    command_perf.record(ctx.usage, ctx.command_failed)
+    # Prefix commands run inside on_message's task; stop counting its REST calls as the command's
+    command_usage.reset(ctx.usage_token)
 
 @bot.event
 async def on_ready():
     print(f'{bot.user} has connected to Discord!')
 
+
     server_count = len(bot.guilds)
     activity = discord.Game(name=f"{server_count}サーバをプレイ中...")
     await bot.change_presence(status=discord.Status.online, activity=activity)
@@ -1485,6 +3397,29 @@ async def on_ready():
     
     print(f"Restored {len(scheduled_message_tasks)} scheduled message tasks")
     
+    # Member cache is chunked by now; seed the per-role counters and the guild and user indexes once
+    for guild in bot.guilds:
+        seed_role_member_counts(guild)
+    guild_index.build(bot.guilds)
+    user_index.build(load_data())
+    
+    # Start batched poll and giveaway persistence
+    global flush_task
+    load_polls()
+    load_giveaways()
+    if flush_task is None or flush_task.done():
+        flush_task = asyncio.create_task(batched_flush_loop())
+    
+    # Timed jobs (poll closes, giveaway draws) run from the central scheduler
+    restore_poll_schedules()
+    restore_giveaway_schedules()
+    scheduler.schedule('ticket_compaction', time.time() + 60, run_ticket_compaction)
+    scheduler.schedule('view_janitor', time.time() + 300, run_view_janitor)
+    scheduler.schedule('legacy_panel_migration', time.time() + 30, migrate_legacy_panels)
+    scheduler.start()
+    stats_aggregator.start()
+    loop_watchdog.start()
+    
     for guild_id, config in meigen_channels.items():
         if guild_id not in meigen_tasks:
             if isinstance(config, dict):
@@ -1504,6 +3439,9 @@ async def on_ready():
 
 @bot.event
 async def on_guild_join(guild):
+    seed_role_member_counts(guild)
+    guild_index.upsert(guild)
+    admin_events.publish('guild_join', {'id': str(guild.id), 'name': guild.name, 'members': guild.member_count})
     server_count = len(bot.guilds)
     activity = discord.Game(name=f"{server_count}サーバをプレイ中...")
     await bot.change_presence(status=discord.Status.online, activity=activity)
@@ -1511,6 +3449,11 @@ async def on_guild_join(guild):
 
 @bot.event
 async def on_guild_remove(guild):
+    admin_events.publish('guild_remove', {'id': str(guild.id), 'name': guild.name})
+    guild_index.remove(guild.id)
+    role_member_counts.pop(guild.id, None)
+    role_assignment_totals.pop(guild.id, None)
+    invalidate_assignable_roles(guild.id)
     server_count = len(bot.guilds)
     activity = discord.Game(name=f"{server_count}サーバをプレイ中...")
     await bot.change_presence(status=discord.Status.online, activity=activity)
@@ -1524,9 +3467,11 @@ async def on_message(message):
     if not is_allowed_server(message.guild.id):
         return
 
+    stage_started = time.perf_counter()
     await on_message_for_copy(message)
     await on_message_for_server_translation(message)
     await on_message_for_server_logging(message)
+    message_stage_seconds.observe(time.perf_counter() - stage_started, 'logging')
 
     if message.content.startswith('!'):
         await bot.process_commands(message)
@@ -1541,6 +3486,7 @@ async def on_message(message):
         pass
 
     if not message.author.bot:
+        stage_started = time.perf_counter()
         if user_id not in user_message_history:
             user_message_history[user_id] = []
 
@@ -1559,17 +3505,20 @@ async def on_message(message):
         
         # Check if anti-spam is enabled for this server
         if not guild_settings.get('enable_antispam', True):
+            message_stage_seconds.observe(time.perf_counter() - stage_started, 'spam')
             return
         
         # Check if user has excluded role
         if guild_settings.get('excluded_roles'):
             user_roles = [role.name for role in message.author.roles]
             if any(role in user_roles for role in guild_settings['excluded_roles']):
+                message_stage_seconds.observe(time.perf_counter() - stage_started, 'spam')
                 return
         
         # Check if channel is excluded
         if guild_settings.get('excluded_channels'):
             if message.channel.name in guild_settings['excluded_channels']:
+                message_stage_seconds.observe(time.perf_counter() - stage_started, 'spam')
                 return
         
         spam_threshold = guild_settings.get('spam_threshold', 3)
@@ -1617,6 +3566,12 @@ async def on_message(message):
                     await message.author.timeout(timeout_duration, reason="同じメッセージの連投によるスパム")
 
                     print(f"Successfully timed out {message.author.name} for {timeout_minutes} minutes")
+                    admin_events.publish('spam', {
+                        'user': message.author.name,
+                        'user_id': str(user_id),
+                        'server': message.guild.name,
+                        'timeout_minutes': timeout_minutes
+                    })
 
                     # Send warning if logging enabled
                     if guild_settings.get('log_spam_detection', True):
@@ -1646,8 +3601,12 @@ async def on_message(message):
                 except Exception as e:
                     print(f"Error in anti-spam: {e}")
 
+        message_stage_seconds.observe(time.perf_counter() - stage_started, 'spam')
+
     if not message.author.bot and not message.content.startswith('/'):
+        stage_started = time.perf_counter()
         add_experience(message.author.id, message.guild.id, 5)
+        message_stage_seconds.observe(time.perf_counter() - stage_started, 'xp')
 
     await bot.process_commands(message)
 
@@ -1701,38 +3660,158 @@ class RoleSelectionView(discord.ui.View):
         except Exception as e:
             await interaction.response.send_message(f'❌ ロールの付与に失敗しました: {str(e)}', ephemeral=True)
 
+async def grant_specific_role(interaction, role):
+    data = load_data()
+    user_id = str(interaction.user.id)
+
+    if user_id not in data['users']:
+        data['users'][user_id] = {
+            'authenticated': True,
+            'join_date': datetime.now().isoformat()
+        }
+    else:
+        data['users'][user_id]['authenticated'] = True
+
+    save_data(data)
+
+    try:
+        if role in interaction.user.roles:
+            await interaction.response.send_message(f'❌ あなたは既に {role.name} ロールを持っています。', ephemeral=True)
+            return
+
+        await interaction.user.add_roles(role)
+        await interaction.response.send_message(f'✅ {role.name} ロールが付与されました！', ephemeral=True)
+
+    except discord.Forbidden:
+        await interaction.response.send_message('❌ ロールを付与する権限がありません。', ephemeral=True)
+    except Exception as e:
+        await interaction.response.send_message(f'❌ ロールの付与に失敗しました: {str(e)}', ephemeral=True)
+
+class SpecificRoleButton(discord.ui.DynamicItem[discord.ui.Button], template=r'role:(?P<role_id>[0-9]+)'):
+    """Role panel button; the role is encoded in the custom_id and resolved on click"""
+    def __init__(self, role_id):
+        super().__init__(
+            discord.ui.Button(
+                label='ろーるをしゅとく！',
+                style=discord.ButtonStyle.primary,
+                custom_id=f"role:{role_id}"
+            )
+        )
+        self.role_id = int(role_id)
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match['role_id'])
+
+    async def callback(self, interaction):
+        role = interaction.guild.get_role(self.role_id)
+        if role is None:
+            await interaction.response.send_message('❌ ロールが見つかりません。削除された可能性があります。', ephemeral=True)
+            return
+        await grant_specific_role(interaction, role)
+
 class SpecificRoleView(discord.ui.View):
     def __init__(self, role):
         super().__init__(timeout=None)
         self.role = role
+        self.add_item(SpecificRoleButton(role.id))
+
+# Per-role member counts, seeded once from the member cache and kept current from gateway events
+role_member_counts = {}  # {guild_id: {role_id: count}}
+role_assignment_totals = {}  # {guild_id: members' non-default role count}
+
+def seed_role_member_counts(guild):
+    counts = {role.id: 0 for role in guild.roles}
+    for member in guild.members:
+        for role in member.roles:
+            counts[role.id] = counts.get(role.id, 0) + 1
+    role_member_counts[guild.id] = counts
+    role_assignment_totals[guild.id] = sum(counts.values()) - counts.get(guild.id, 0)
+
+def get_role_member_count(role):
+    """O(1) replacement for len(role.members)"""
+    if role.guild.id not in role_member_counts:
+        seed_role_member_counts(role.guild)
+    return role_member_counts[role.guild.id].get(role.id, 0)
+
+def adjust_role_member_counts(guild, roles, delta):
+    counts = role_member_counts.get(guild.id)
+    if counts is None:
+        return
+    for role in roles:
+        counts[role.id] = counts.get(role.id, 0) + delta
+        if role.id != guild.id:
+            role_assignment_totals[guild.id] += delta
+
+# Roles the bot can hand out per guild, dropped whenever roles or the bot's own roles change
+assignable_role_cache = {}  # {guild_id: [role]}
+
+def invalidate_assignable_roles(guild_id):
+    assignable_role_cache.pop(guild_id, None)
+
+def get_assignable_roles(guild):
+    roles = assignable_role_cache.get(guild.id)
+    if roles is None:
+        roles = []
+        for role in guild.roles:
+            if (role.name != '@everyone' and 
+                not role.managed and 
+                not role.permissions.administrator and
+                role < guild.me.top_role):
+                roles.append(role)
+        assignable_role_cache[guild.id] = roles
+    return roles
 
-    @discord.ui.button(label='ろーるをしゅとく！', style=discord.ButtonStyle.primary, custom_id='specific_role_button')
-    async def get_role_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        data = load_data()
-        user_id = str(interaction.user.id)
+@bot.event
+async def on_guild_role_create(role):
+    invalidate_assignable_roles(role.guild.id)
+    role_member_counts.get(role.guild.id, {}).setdefault(role.id, 0)
 
-        if user_id not in data['users']:
-            data['users'][user_id] = {
-                'authenticated': True,
-                'join_date': datetime.now().isoformat()
-            }
-        else:
-            data['users'][user_id]['authenticated'] = True
+@bot.event
+async def on_guild_role_update(before, after):
+    invalidate_assignable_roles(after.guild.id)
 
-        save_data(data)
+@bot.event
+async def on_guild_role_delete(role):
+    invalidate_assignable_roles(role.guild.id)
+    # Discord removes the role from its members without sending member updates
+    counts = role_member_counts.get(role.guild.id)
+    if counts is not None:
+        role_assignment_totals[role.guild.id] -= counts.pop(role.id, 0)
 
-        try:
-            if self.role in interaction.user.roles:
-                await interaction.response.send_message(f'❌ あなたは既に {self.role.name} ロールを持っています。', ephemeral=True)
-                return
+@bot.event
+async def on_member_update(before, after):
+    if before.roles != after.roles:
+        before_roles = set(before.roles)
+        after_roles = set(after.roles)
+        adjust_role_member_counts(after.guild, after_roles - before_roles, 1)
+        adjust_role_member_counts(after.guild, before_roles - after_roles, -1)
+        if after.id == after.guild.me.id:
+            invalidate_assignable_roles(after.guild.id)
+    if before.timed_out_until != after.timed_out_until:
+        stats_aggregator.record_timeout(after)
+    if before.nick != after.nick:
+        user_index.refresh_names(after.id)
 
-            await interaction.user.add_roles(self.role)
-            await interaction.response.send_message(f'✅ {self.role.name} ロールが付与されました！', ephemeral=True)
+@bot.event
+async def on_user_update(before, after):
+    if before.name != after.name or before.global_name != after.global_name:
+        user_index.refresh_names(after.id)
 
-        except discord.Forbidden:
-            await interaction.response.send_message('❌ ロールを付与する権限がありません。', ephemeral=True)
-        except Exception as e:
-            await interaction.response.send_message(f'❌ ロールの付与に失敗しました: {str(e)}', ephemeral=True)
+@bot.event
+async def on_member_join(member):
+    adjust_role_member_counts(member.guild, member.roles, 1)
+    guild_index.update_members(member.guild)
+
+@bot.event
+async def on_member_remove(member):
+    adjust_role_member_counts(member.guild, member.roles, -1)
+    guild_index.update_members(member.guild)
+
+@bot.event
+async def on_guild_update(before, after):
+    # Name, owner or icon changes; the row is rebuilt so the name index stays sorted
+    guild_index.upsert(after)
 
 class PublicAuthView(discord.ui.View):
     def __init__(self):
@@ -1743,23 +3822,18 @@ class PublicAuthView(discord.ui.View):
         data = load_data()
         user_id = str(interaction.user.id)
 
+        # Only write when the flag actually changes; repeat clicks leave the file alone
         if user_id not in data['users']:
             data['users'][user_id] = {
                 'authenticated': True,
                 'join_date': datetime.now().isoformat()
             }
-        else:
+            save_data(data)
+        elif not data['users'][user_id].get('authenticated'):
             data['users'][user_id]['authenticated'] = True
+            save_data(data)
 
-        save_data(data)
-
-        assignable_roles = []
-        for role in interaction.guild.roles:
-            if (role.name != '@everyone' and 
-                not role.managed and 
-                not role.permissions.administrator and
-                role < interaction.guild.me.top_role):
-                assignable_roles.append(role)
+        assignable_roles = get_assignable_roles(interaction.guild)
 
         if not assignable_roles:
             await interaction.response.send_message('❌ 付与可能なロールがありません。', ephemeral=True)
@@ -1773,7 +3847,7 @@ class PublicAuthView(discord.ui.View):
 
         role_list = []
         for role in assignable_roles[:10]:
-            role_list.append(f'• {role.name} ({len(role.members)} メンバー)')
+            role_list.append(f'• {role.name} ({get_role_member_count(role)} メンバー)')
 
         embed.add_field(
             name='📋 ロール一覧',
@@ -1797,10 +3871,6 @@ class PublicAuthView(discord.ui.View):
 # Nuke channel
 @bot.tree.command(name='nuke', description='チャンネルを再生成（設定を引き継ぎ）')
 async def nuke_channel(interaction: discord.Interaction):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
-
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message('❌ 管理者権限が必要です。', ephemeral=True)
         return
@@ -1841,10 +3911,6 @@ async def nuke_channel(interaction: discord.Interaction):
 
 @bot.tree.command(name='profile', description='ユーザープロフィールを表示')
 async def view_profile(interaction: discord.Interaction, user: discord.Member = None):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
-
     if user is None:
         user = interaction.user
 
@@ -1871,10 +3937,6 @@ async def setup_role(interaction: discord.Interaction, role_name: str = None):
     try:
         await interaction.response.defer()
         
-        if not is_allowed_server(interaction.guild.id):
-            await interaction.followup.send('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-            return
-
         if not interaction.user.guild_permissions.administrator:
             await interaction.followup.send('❌ 管理者権限が必要です。', ephemeral=True)
             return
@@ -1902,7 +3964,7 @@ async def setup_role(interaction: discord.Interaction, role_name: str = None):
             )
             embed.add_field(
                 name='📋 取得可能なロール',
-                value=f'• {role_name} ({len(role.members)} メンバー)',
+                value=f'• {role_name} ({get_role_member_count(role)} メンバー)',
                 inline=False
             )
             embed.set_footer(text='認証は無料です | 24時間利用可能')
@@ -1913,6 +3975,7 @@ async def setup_role(interaction: discord.Interaction, role_name: str = None):
             # Save persistent view data
             persistent_views[f"specific_role_{message.id}"] = {
                 'type': 'specific_role',
+                'custom_id': f"role:{role.id}",
                 'role_id': str(role.id),
                 'guild_id': str(interaction.guild.id),
                 'channel_id': str(interaction.channel.id),
@@ -1954,10 +4017,6 @@ async def setup_role(interaction: discord.Interaction, role_name: str = None):
 
 @bot.tree.command(name='servers', description='ユーザーが参加しているサーバー一覧を表示')
 async def view_servers(interaction: discord.Interaction, user: discord.Member = None):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
-
     if user is None:
         user = interaction.user
 
@@ -1995,10 +4054,6 @@ async def view_servers(interaction: discord.Interaction, user: discord.Member =
 
 @bot.tree.command(name='antispam-config', description='荒らし対策設定を表示・変更')
 async def antispam_config(interaction: discord.Interaction, action: str = "show"):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
-
     if not interaction.user.guild_permissions.manage_messages:
         await interaction.response.send_message('❌ メッセージ管理権限が必要です。', ephemeral=True)
         return
@@ -2036,10 +4091,6 @@ async def antispam_config(interaction: discord.Interaction, action: str = "show"
 
 @bot.tree.command(name='spam-status', description='現在のスパム検知状況を表示')
 async def spam_status(interaction: discord.Interaction):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
-
     if not interaction.user.guild_permissions.manage_messages:
         await interaction.response.send_message('❌ メッセージ管理権限が必要です。', ephemeral=True)
         return
@@ -2058,67 +4109,192 @@ async def spam_status(interaction: discord.Interaction):
 
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
-active_giveaways = {}
+active_giveaways = {}  # {message_id: giveaway_data}
+giveaway_participant_sets = {}  # {message_id: set(user_id)} built from the participant arrays
+giveaways_dirty = False
+
+GIVEAWAY_FILE = 'giveaways.json'
+GIVEAWAY_RENDER_INTERVAL = 5  # minimum seconds between edits of one giveaway message
+
+giveaway_renderer = MessageEditDebouncer(GIVEAWAY_RENDER_INTERVAL)
+
+def save_giveaways():
+    """Save active giveaways and their participants"""
+    global giveaways_dirty
+    giveaways_dirty = False
+    try:
+        started = time.perf_counter()
+        with open(GIVEAWAY_FILE, 'w', encoding='utf-8') as f:
+            json.dump(active_giveaways, f, ensure_ascii=False)
+            size = f.tell()
+        record_storage_write('giveaways', started, size)
+    except Exception as e:
+        giveaways_dirty = True
+        print(f"Error saving giveaways: {e}")
+
+def load_giveaways():
+    """Load active giveaways"""
+    try:
+        if os.path.exists(GIVEAWAY_FILE):
+            with open(GIVEAWAY_FILE, 'r', encoding='utf-8') as f:
+                for giveaway_id, giveaway in json.load(f).items():
+                    active_giveaways.setdefault(giveaway_id, giveaway)
+    except Exception as e:
+        print(f"Error loading giveaways: {e}")
+
+def get_giveaway_participants(giveaway_id):
+    """Membership set for O(1) join checks; the list stays the persisted form"""
+    participants = giveaway_participant_sets.get(giveaway_id)
+    if participants is None:
+        participants = set(active_giveaways[giveaway_id]['participants'])
+        giveaway_participant_sets[giveaway_id] = participants
+    return participants
+
+def build_giveaway_embed(giveaway):
+    end_time = int(giveaway['end_time'])
+    embed = discord.Embed(
+        title='🎉 Giveaway開催中！',
+        description=f'**景品:** {giveaway["prize"]}\n\n'
+                   f'**当選者数:** {giveaway.get("winner_count", 1)}人\n'
+                   f'**参加者数:** {len(giveaway["participants"])}人\n'
+                   f'**終了時刻:** <t:{end_time}:F>\n'
+                   f'**残り時間:** <t:{end_time}:R>',
+        color=0xff6b6b
+    )
+    embed.add_field(
+        name='参加方法',
+        value='🎉 ボタンをクリックして参加！',
+        inline=False
+    )
+    embed.set_footer(text='Good luck! 🍀')
+    return embed
+
+async def end_giveaway(giveaway_id):
+    """Draw winners for a giveaway and announce them"""
+    giveaway = active_giveaways.pop(giveaway_id, None)
+    giveaway_participant_sets.pop(giveaway_id, None)
+    giveaway_renderer.cancel(giveaway_id)
+    if giveaway is None:
+        return
+
+    participants = giveaway['participants']
+    winner_count = min(giveaway.get('winner_count', 1), len(participants))
+    # random.sample on the participant array costs O(k), independent of the entrant count
+    winners = random.sample(participants, winner_count)
+    save_giveaways()
+    if persistent_views.pop(f"giveaway_{giveaway_id}", None) is not None:
+        save_persistent_views()
+
+    channel = bot.get_channel(int(giveaway['channel_id']))
+    if not channel:
+        print(f"Giveaway {giveaway_id} ended but channel {giveaway['channel_id']} was not found")
+        return
+
+    winner_mentions = ', '.join(f'<@{user_id}>' for user_id in winners) if winners else '参加者がいませんでした'
+    embed = discord.Embed(
+        title='🎊 Giveaway終了！',
+        description=f'**景品:** {giveaway["prize"]}\n\n'
+                   f'**参加者数:** {len(participants)}人\n'
+                   f'**当選者:** {winner_mentions}',
+        color=0xffd700
+    )
+    embed.set_footer(text=f'終了時刻: {datetime.fromtimestamp(giveaway["end_time"]).strftime("%Y/%m/%d %H:%M")}')
+
+    try:
+        await channel.get_partial_message(int(giveaway_id)).edit(embed=embed, view=None)
+    except Exception as e:
+        print(f"Error updating ended giveaway {giveaway_id}: {e}")
+
+    try:
+        if winners:
+            await channel.send(f'🎉 おめでとうございます！ {winner_mentions} が **{giveaway["prize"]}** に当選しました！')
+        else:
+            await channel.send(f'😢 **{giveaway["prize"]}** のGiveawayは参加者がいなかったため当選者なしで終了しました。')
+    except Exception as e:
+        print(f"Error announcing giveaway winners for {giveaway_id}: {e}")
+
+    print(f"Giveaway ended: {giveaway_id} - Winners: {winners}")
+
+def schedule_giveaway_end(giveaway_id, end_time):
+    async def run_end():
+        await end_giveaway(giveaway_id)
+    scheduler.schedule(f"giveaway:{giveaway_id}", end_time, run_end)
+
+def restore_giveaway_schedules():
+    """Re-register draw jobs for persisted giveaways"""
+    for giveaway_id, giveaway in active_giveaways.items():
+        schedule_giveaway_end(giveaway_id, giveaway['end_time'])
+
+class GiveawayJoinButton(discord.ui.DynamicItem[discord.ui.Button], template=r'giveaway_(?P<giveaway_id>[0-9]+)'):
+    """Join button routed by custom_id so giveaways keep working after a restart"""
+    def __init__(self, giveaway_id):
+        super().__init__(
+            discord.ui.Button(
+                label='🎉 参加する',
+                style=discord.ButtonStyle.primary,
+                emoji='🎉',
+                custom_id=f"giveaway_{giveaway_id}"
+            )
+        )
+        self.giveaway_id = giveaway_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match['giveaway_id'])
+
+    async def callback(self, interaction):
+        await join_giveaway(interaction, self.giveaway_id)
 
 # Giveaway View
 class GiveawayView(discord.ui.View):
     def __init__(self, giveaway_id):
         super().__init__(timeout=None)
         self.giveaway_id = giveaway_id
+        self.add_item(GiveawayJoinButton(giveaway_id))
 
-    @discord.ui.button(label='🎉 参加する', style=discord.ButtonStyle.primary, emoji='🎉')
-    async def join_giveaway(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if self.giveaway_id not in active_giveaways:
-            await interaction.response.send_message('❌ このGiveawayは既に終了しています。', ephemeral=True)
-            return
-
-        giveaway = active_giveaways[self.giveaway_id]
-        user_id = interaction.user.id
+async def join_giveaway(interaction, giveaway_id):
+    global giveaways_dirty
+    if giveaway_id not in active_giveaways:
+        await interaction.response.send_message('❌ このGiveawayは既に終了しています。', ephemeral=True)
+        return
 
-        # Check if giveaway has ended
-        if datetime.now() > giveaway['end_time']:
-            await interaction.response.send_message('❌ このGiveawayは既に終了しています。', ephemeral=True)
-            return
+    giveaway = active_giveaways[giveaway_id]
+    user_id = interaction.user.id
 
-        # Check if user is already participating
-        if user_id in giveaway['participants']:
-            await interaction.response.send_message('❌ 既にこのGiveawayに参加しています！', ephemeral=True)
-            return
+    # Check if giveaway has ended
+    if time.time() > giveaway['end_time']:
+        await interaction.response.send_message('❌ このGiveawayは既に終了しています。', ephemeral=True)
+        return
 
-        # Add user to participants
-        giveaway['participants'].add(user_id)
-        participant_count = len(giveaway['participants'])
+    # Check if user is already participating
+    participants = get_giveaway_participants(giveaway_id)
+    if user_id in participants:
+        await interaction.response.send_message('❌ 既にこのGiveawayに参加しています！', ephemeral=True)
+        return
 
-        await interaction.response.send_message(
-            f'✅ Giveawayに参加しました！\n現在の参加者数: **{participant_count}人**',
-            ephemeral=True
-        )
+    # Add user to participants
+    participants.add(user_id)
+    giveaway['participants'].append(user_id)
+    giveaways_dirty = True
+    participant_count = len(giveaway['participants'])
 
-        # Update the embed with new participant count
-        embed = discord.Embed(
-            title='🎉 Giveaway開催中！',
-            description=f'**景品:** {giveaway["prize"]}\n\n'
-                       f'**参加者数:** {participant_count}人\n'
-                       f'**終了時刻:** <t:{int(giveaway["end_time"].timestamp())}:F>\n'
-                       f'**残り時間:** <t:{int(giveaway["end_time"].timestamp())}:R>',
-            color=0xff6b6b
-        )
-        embed.add_field(
-            name='参加方法',
-            value='🎉 ボタンをクリックして参加！',
-            inline=False
-        )
-        embed.set_footer(text='Good luck! 🍀')
+    await interaction.response.send_message(
+        f'✅ Giveawayに参加しました！\n現在の参加者数: **{participant_count}人**',
+        ephemeral=True
+    )
 
-        try:
-            await interaction.edit_original_response(embed=embed, view=self)
-        except:
-            pass
+    # Participant count updates are coalesced so busy giveaways stay under the edit rate limit
+    giveaway_renderer.schedule(
+        giveaway_id,
+        interaction.message,
+        lambda: {'embed': build_giveaway_embed(giveaway)} if giveaway_id in active_giveaways else None
+    )
 
 # Giveaway time selection
 class GiveawayTimeSelect(discord.ui.Select):
-    def __init__(self, prize):
+    def __init__(self, prize, winner_count=1):
         self.prize = prize
+        self.winner_count = winner_count
         options = [
             discord.SelectOption(label='1時間', value='1h', emoji='⏰'),
             discord.SelectOption(label='3時間', value='3h', emoji='⏰'),
@@ -2141,83 +4317,74 @@ class GiveawayTimeSelect(discord.ui.Select):
         selected_time = self.values[0]
         hours = time_mapping[selected_time]
 
-        from datetime import timedelta
-        end_time = datetime.now() + timedelta(hours=hours)
+        end_time = time.time() + hours * 3600
 
-        # Create giveaway embed
-        embed = discord.Embed(
-            title='🎉 Giveaway開催中！',
-            description=f'**景品:** {self.prize}\n\n'
-                       f'**参加者数:** 0人\n'
-                       f'**終了時刻:** <t:{int(end_time.timestamp())}:F>\n'
-                       f'**残り時間:** <t:{int(end_time.timestamp())}:R>',
-            color=0xff6b6b
-        )
-        embed.add_field(
-            name='参加方法',
-            value='🎉 ボタンをクリックして参加！',
-            inline=False
-        )
-        embed.set_footer(text='Good luck! 🍀')
-
-        # Create giveaway view
-        view = GiveawayView("temp")
+        giveaway = {
+            'end_time': end_time,
+            'prize': self.prize,
+            'winner_count': self.winner_count,
+            'participants': [],
+            'creator_id': interaction.user.id,
+            'channel_id': interaction.channel.id,
+            'guild_id': interaction.guild.id
+        }
 
-        # Send the giveaway message
-        await interaction.response.edit_message(embed=embed, view=view)
+        # Send the giveaway message; the join button needs the message ID
+        await interaction.response.edit_message(embed=build_giveaway_embed(giveaway), view=None)
 
-        # Get the message ID and update the giveaway data
+        # Get the message ID and attach the join button
         message = await interaction.original_response()
         giveaway_id = str(message.id)
-
-        # Update the view with correct giveaway ID
-        view.giveaway_id = giveaway_id
-        await message.edit(view=view)
+        await message.edit(view=GiveawayView(giveaway_id))
 
         # Store giveaway data
-        active_giveaways[giveaway_id] = {
-            'end_time': end_time,
-            'prize': self.prize,
-            'participants': set(),
-            'creator_id': interaction.user.id,
-            'channel_id': interaction.channel.id
+        active_giveaways[giveaway_id] = giveaway
+        save_giveaways()
+
+        persistent_views[f"giveaway_{giveaway_id}"] = {
+            'type': 'giveaway',
+            'giveaway_id': giveaway_id,
+            'guild_id': str(interaction.guild.id),
+            'channel_id': str(interaction.channel.id),
+            'message_id': giveaway_id
         }
+        save_persistent_views()
 
-        print(f"Giveaway created: {giveaway_id} - Prize: {self.prize} - Duration: {selected_time}")
+        # Winners are drawn by the central scheduler at end_time
+        schedule_giveaway_end(giveaway_id, end_time)
 
-        # Schedule giveaway end (we'll check this manually for now)
-        # In a production environment, you'd want to use a proper task scheduler
+        print(f"Giveaway created: {giveaway_id} - Prize: {self.prize} - Duration: {selected_time}")
 
 class GiveawayTimeView(discord.ui.View):
-    def __init__(self, prize):
+    def __init__(self, prize, winner_count=1):
         super().__init__(timeout=300)
-        self.add_item(GiveawayTimeSelect(prize))
+        self.add_item(GiveawayTimeSelect(prize, winner_count))
 
 # Giveaway command
 @bot.tree.command(name='giveaway', description='Giveawayを開始')
-async def giveaway(interaction: discord.Interaction, prize: str):
+async def giveaway(interaction: discord.Interaction, prize: str, winners: int = 1):
     try:
         # Immediately defer the response
         await interaction.response.defer()
         
-        if not is_allowed_server(interaction.guild.id):
-            await interaction.followup.send('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-            return
-
         # Check permissions (optional - you can remove this if anyone should be able to create giveaways)
         if not interaction.user.guild_permissions.manage_messages:
             await interaction.followup.send('❌ メッセージ管理権限が必要です。', ephemeral=True)
             return
 
+        if winners < 1 or winners > 20:
+            await interaction.followup.send('❌ 当選者数は1-20人の間で指定してください。', ephemeral=True)
+            return
+
         # Create time selection embed
         embed = discord.Embed(
             title='🎉 Giveaway設定',
-            description=f'**景品:** {prize}\n\n時間を選択してGiveawayを開始してください。',
+            description=f'**景品:** {prize}\n**当選者数:** {winners}人\n\n時間を選択してGiveawayを開始してください。',
             color=0x00ff99
         )
         embed.set_footer(text='下のメニューから時間を選択してください')
 
-        view = GiveawayTimeView(prize)
+        view = GiveawayTimeView(prize, winners)
         await interaction.followup.send(embed=embed, view=view)
 
     except Exception as e:
@@ -2254,12 +4421,15 @@ def add_experience(user_id, guild_id, amount):
     new_level = (user_data['total_xp'] // 100) + 1
     
     if new_level > user_data['level']:
+        stats_aggregator.record_level_up(new_level - user_data['level'])
         user_data['level'] = new_level
         user_data['xp'] = user_data['total_xp'] % 100
         save_data(data)
+        user_index.set_level(user_key, guild_key, new_level, user_data['total_xp'])
         return new_level  # Return new level for level up message
     
     save_data(data)
+    user_index.set_level(user_key, guild_key, user_data['level'], user_data['total_xp'])
     return None
 
 def get_user_level_data(user_id, guild_id):
@@ -2278,10 +4448,6 @@ def get_user_level_data(user_id, guild_id):
 
 @bot.tree.command(name='level', description='ユーザーのレベルを表示')
 async def level_command(interaction: discord.Interaction, user: discord.Member = None):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
-
     target_user = user or interaction.user
     level_data = get_user_level_data(target_user.id, interaction.guild.id)
     
@@ -2312,10 +4478,6 @@ async def level_command(interaction: discord.Interaction, user: discord.Member =
 
 @bot.tree.command(name='ranking', description='サーバーのレベルランキングを表示')
 async def ranking_command(interaction: discord.Interaction):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
-
     data = load_data()
     if 'user_levels' not in data or str(interaction.guild.id) not in data['user_levels']:
         await interaction.response.send_message('❌ まだレベルデータがありません。', ephemeral=True)
@@ -2347,6 +4509,221 @@ async def ranking_command(interaction: discord.Interaction):
 
 # Voting System
 active_polls = {}  # {message_id: poll_data}
+poll_locks = {}  # {message_id: asyncio.Lock}
+dirty_polls = set()  # poll ids changed since the last flush
+polls_loaded = False
+flush_task = None
+
+FLUSH_INTERVAL = 5  # seconds between batched poll and giveaway writes
+POLL_RENDER_INTERVAL = 1  # minimum seconds between edits of one poll message
+POLL_VOTER_ARCHIVE_FILE = 'poll_voters_archive.jsonl.gz'
+poll_voter_archive_lock = Lock()  # appends run in worker threads; two members written at once would interleave
+
+POLL_EMOJIS = ['1️⃣', '2️⃣', '3️⃣', '4️⃣', '5️⃣', '6️⃣', '7️⃣', '8️⃣', '9️⃣', '🔟']
+
+poll_renderer = MessageEditDebouncer(POLL_RENDER_INTERVAL)
+
+def load_polls():
+    """Load poll data from the data file into memory"""
+    global polls_loaded
+    try:
+        data = load_data()
+        for poll_id, poll_data in data.get('polls', {}).items():
+            # Never overwrite in-memory state that has not been flushed yet
+            active_polls.setdefault(poll_id, poll_data)
+    except Exception as e:
+        print(f"Error loading polls: {e}")
+    polls_loaded = True
+
+def get_poll(poll_id):
+    if not polls_loaded:
+        load_polls()
+    return active_polls.get(poll_id)
+
+def get_poll_lock(poll_id):
+    lock = poll_locks.get(poll_id)
+    if lock is None:
+        lock = poll_locks[poll_id] = asyncio.Lock()
+    return lock
+
+def flush_polls():
+    """Write all changed polls to the data file in one save"""
+    if not dirty_polls:
+        return
+    poll_ids = list(dirty_polls)
+    dirty_polls.clear()
+    try:
+        data = load_data()
+        if 'polls' not in data:
+            data['polls'] = {}
+        for poll_id in poll_ids:
+            if poll_id in active_polls:
+                data['polls'][poll_id] = active_polls[poll_id]
+        save_data(data)
+    except Exception as e:
+        # Keep the polls marked so the next flush retries them
+        dirty_polls.update(poll_ids)
+        print(f"Error flushing polls: {e}")
+
+async def batched_flush_loop():
+    """Periodically persist changed polls and giveaway entries"""
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        flush_polls()
+        if giveaways_dirty:
+            save_giveaways()
+
+def build_poll_embed(poll_data):
+    embed = discord.Embed(
+        title=f'📊 {poll_data["question"]}',
+        description='下のボタンをクリックして投票してください。',
+        color=0x0099ff
+    )
+
+    total_votes = sum(poll_data['votes'])
+    for i, option in enumerate(poll_data['options']):
+        votes = poll_data['votes'][i]
+        percentage = (votes / total_votes * 100) if total_votes > 0 else 0
+        bar_length = 20
+        filled_length = int(bar_length * percentage / 100)
+        bar = '█' * filled_length + '░' * (bar_length - filled_length)
+
+        embed.add_field(
+            name=f'{POLL_EMOJIS[i]} {option}',
+            value=f'`{bar}` {votes} 票 ({percentage:.1f}%)',
+            inline=False
+        )
+
+    if poll_data.get('ends_at'):
+        ends_at = int(poll_data['ends_at'])
+        embed.add_field(name='⏰ 終了時刻', value=f'<t:{ends_at}:F> (<t:{ends_at}:R>)', inline=False)
+
+    embed.set_footer(text=f'総投票数: {total_votes}票 | 作成者: {poll_data["creator"]}')
+    return embed
+
+def build_poll_results_embed(poll_data):
+    result = poll_data.get('result')
+    if result:
+        # Closed polls carry a frozen result record
+        total_votes = result['total_votes']
+        voter_count = result['voter_count']
+        winner_index = result['winner_index']
+    else:
+        total_votes = sum(poll_data['votes'])
+        voter_count = len(poll_data['voters'])
+        winner_index = poll_data['votes'].index(max(poll_data['votes'])) if total_votes > 0 else 0
+
+    embed = discord.Embed(
+        title=f'📊 投票結果: {poll_data["question"]}',
+        color=0x00ff00
+    )
+    
+    for i, option in enumerate(poll_data['options']):
+        votes = poll_data['votes'][i]
+        percentage = (votes / total_votes * 100) if total_votes > 0 else 0
+        status = '🏆 ' if i == winner_index and total_votes > 0 else ''
+        
+        embed.add_field(
+            name=f'{status}{option}',
+            value=f'{votes} 票 ({percentage:.1f}%)',
+            inline=True
+        )
+    
+    stats = f'**総投票数:** {total_votes}\n**投票者数:** {voter_count}\n**作成者:** {poll_data["creator"]}'
+    if result:
+        stats += f'\n**終了:** {result["closed_at"][:16].replace("T", " ")}'
+    embed.add_field(
+        name='📈 統計',
+        value=stats,
+        inline=False
+    )
+    return embed
+
+def archive_poll_voters(poll_id, voters):
+    """Append a closed poll's voter map to the compressed archive; called through the worker bridge"""
+    line = json.dumps({'poll_id': poll_id, 'voters': voters}, ensure_ascii=False) + '\n'
+    with poll_voter_archive_lock:
+        with gzip.open(POLL_VOTER_ARCHIVE_FILE, 'at', encoding='utf-8') as f:
+            f.write(line)
+
+async def close_poll(poll_id):
+    """Freeze the final tallies of a poll and move its voters out of hot storage"""
+    async with get_poll_lock(poll_id):
+        poll_data = get_poll(poll_id)
+        if poll_data is None or poll_data.get('closed'):
+            return
+
+        votes = poll_data['votes']
+        total_votes = sum(votes)
+        voters = poll_data.get('voters', {})
+        poll_data['result'] = {
+            'total_votes': total_votes,
+            'voter_count': len(voters),
+            'winner_index': votes.index(max(votes)) if total_votes > 0 else None,
+            'closed_at': datetime.now().isoformat()
+        }
+        poll_data['closed'] = True
+
+        try:
+            await worker_bridge.call('poll_voter_archive', archive_poll_voters, poll_id, voters)
+            poll_data.pop('voters', None)
+        except Exception as e:
+            print(f"Error archiving voters of poll {poll_id}: {e}")
+
+        dirty_polls.add(poll_id)
+        flush_polls()
+
+    # Drop any pending re-render and replace the buttons with the final result
+    poll_renderer.cancel(poll_id)
+    poll_locks.pop(poll_id, None)
+    if persistent_views.pop(f"poll_{poll_id}", None) is not None:
+        save_persistent_views()
+    try:
+        channel = bot.get_channel(int(poll_data['channel_id']))
+        if channel:
+            embed = build_poll_results_embed(poll_data)
+            embed.title = f'🔒 投票終了: {poll_data["question"]}'
+            await channel.get_partial_message(int(poll_id)).edit(embed=embed, view=None)
+    except Exception as e:
+        print(f"Error updating closed poll {poll_id}: {e}")
+
+    print(f"Poll closed: {poll_id}")
+
+def schedule_poll_close(poll_id, ends_at):
+    async def run_close():
+        await close_poll(poll_id)
+    scheduler.schedule(f"poll:{poll_id}", ends_at, run_close)
+
+def restore_poll_schedules():
+    """Re-register close jobs for timed polls that are still open"""
+    for poll_id, poll_data in active_polls.items():
+        if poll_data.get('ends_at') and not poll_data.get('closed'):
+            schedule_poll_close(poll_id, poll_data['ends_at'])
+
+class PollVoteButton(discord.ui.DynamicItem[discord.ui.Button], template=r'poll_(?P<poll_id>[0-9]+|temp)_(?P<option_index>[0-9]+)'):
+    """Vote button routed by custom_id, so one registration serves every poll"""
+    def __init__(self, poll_id, option_index, label=None, emoji=None):
+        super().__init__(
+            discord.ui.Button(
+                label=label,
+                style=discord.ButtonStyle.primary,
+                emoji=emoji,
+                custom_id=f"poll_{poll_id}_{option_index}"
+            )
+        )
+        self.poll_id = poll_id
+        self.option_index = option_index
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        poll_id = match['poll_id']
+        # Polls created by older versions kept the placeholder id; the poll id is the message id
+        if poll_id == 'temp':
+            poll_id = str(interaction.message.id)
+        return cls(poll_id, int(match['option_index']))
+
+    async def callback(self, interaction):
+        await record_poll_vote(interaction, self.poll_id, self.option_index)
 
 class PollView(discord.ui.View):
     def __init__(self, poll_id, options):
@@ -2355,85 +4732,59 @@ class PollView(discord.ui.View):
         self.options = options
         self.setup_buttons()
 
-    def setup_buttons(self):
-        emojis = ['1️⃣', '2️⃣', '3️⃣', '4️⃣', '5️⃣', '6️⃣', '7️⃣', '8️⃣', '9️⃣', '🔟']
-        for i, option in enumerate(self.options[:10]):  # Max 10 options
-            button = discord.ui.Button(
-                label=f"{option[:80]}",  # Truncate if too long
-                style=discord.ButtonStyle.primary,
-                emoji=emojis[i],
-                custom_id=f"poll_{self.poll_id}_{i}"
-            )
-            button.callback = self.create_vote_callback(i)
-            self.add_item(button)
+    def setup_buttons(self):
+        for i, option in enumerate(self.options[:10]):  # Max 10 options
+            self.add_item(PollVoteButton(
+                self.poll_id,
+                i,
+                label=f"{option[:80]}",  # Truncate if too long
+                emoji=POLL_EMOJIS[i]
+            ))
+
+async def record_poll_vote(interaction, poll_id, option_index):
+    """Record a vote in memory and schedule a debounced embed update"""
+    async with get_poll_lock(poll_id):
+        poll_data = get_poll(poll_id)
+        if poll_data is None:
+            await interaction.response.send_message('❌ この投票は見つかりません。', ephemeral=True)
+            return
+
+        if poll_data.get('closed'):
+            await interaction.response.send_message('❌ この投票は既に終了しています。', ephemeral=True)
+            return
+
+        user_id = str(interaction.user.id)
+
+        # Check if user already voted
+        old_option = poll_data['voters'].get(user_id)
+        if old_option == option_index:
+            await interaction.response.send_message(f'ℹ️ 既に **{poll_data["options"][option_index]}** に投票しています。', ephemeral=True)
+            return
+        if old_option is not None:
+            poll_data['votes'][old_option] -= 1
+
+        # Record new vote
+        poll_data['voters'][user_id] = option_index
+        poll_data['votes'][option_index] += 1
+        dirty_polls.add(poll_id)
+
+    await interaction.response.send_message(f'✅ **{poll_data["options"][option_index]}** に投票しました！', ephemeral=True)
 
-    def create_vote_callback(self, option_index):
-        async def vote_callback(interaction):
-            data = load_data()
-            if 'polls' not in data:
-                data['polls'] = {}
-            
-            if self.poll_id not in data['polls']:
-                await interaction.response.send_message('❌ この投票は見つかりません。', ephemeral=True)
-                return
-            
-            poll_data = data['polls'][self.poll_id]
-            user_id = str(interaction.user.id)
-            
-            # Check if user already voted
-            if user_id in poll_data['voters']:
-                old_option = poll_data['voters'][user_id]
-                poll_data['votes'][old_option] -= 1
-            
-            # Record new vote
-            poll_data['voters'][user_id] = option_index
-            poll_data['votes'][option_index] += 1
-            
-            save_data(data)
-            
-            # Update embed
-            embed = discord.Embed(
-                title=f'📊 {poll_data["question"]}',
-                description='下のボタンをクリックして投票してください。',
-                color=0x0099ff
-            )
-            
-            total_votes = sum(poll_data['votes'])
-            for i, option in enumerate(poll_data['options']):
-                votes = poll_data['votes'][i]
-                percentage = (votes / total_votes * 100) if total_votes > 0 else 0
-                bar_length = 20
-                filled_length = int(bar_length * percentage / 100)
-                bar = '█' * filled_length + '░' * (bar_length - filled_length)
-                
-                embed.add_field(
-                    name=f'{["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣", "🔟"][i]} {option}',
-                    value=f'`{bar}` {votes} 票 ({percentage:.1f}%)',
-                    inline=False
-                )
-            
-            embed.set_footer(text=f'総投票数: {total_votes}票 | 作成者: {poll_data["creator"]}')
-            
-            try:
-                await interaction.response.edit_message(embed=embed, view=self)
-                
-                # Add XP for voting
-                add_experience(interaction.user.id, interaction.guild.id, 10)
-                
-            except:
-                await interaction.response.send_message(f'✅ **{self.options[option_index]}** に投票しました！', ephemeral=True)
-        
-        return vote_callback
+    # The embed is rendered when the edit is sent, so bursts collapse into one edit
+    poll_renderer.schedule(
+        poll_id,
+        interaction.message,
+        lambda: None if poll_data.get('closed') else {'embed': build_poll_embed(poll_data)}
+    )
+
+    # Add XP for voting
+    add_experience(interaction.user.id, interaction.guild.id, 10)
 
 @bot.tree.command(name='poll', description='投票を作成')
-async def poll_command(interaction: discord.Interaction, question: str, options: str):
+async def poll_command(interaction: discord.Interaction, question: str, options: str, duration: str = None):
     try:
         await interaction.response.defer()
         
-        if not is_allowed_server(interaction.guild.id):
-            await interaction.followup.send('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-            return
-
         # Parse options (comma separated)
         option_list = [opt.strip() for opt in options.split(',')]
         
@@ -2445,51 +4796,49 @@ async def poll_command(interaction: discord.Interaction, question: str, options:
             await interaction.followup.send('❌ 選択肢は最大10個までです。', ephemeral=True)
             return
 
-        # Create poll embed
-        embed = discord.Embed(
-            title=f'📊 {question}',
-            description='下のボタンをクリックして投票してください。',
-            color=0x0099ff
-        )
-        
-        for i, option in enumerate(option_list):
-            embed.add_field(
-                name=f'{["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣", "🔟"][i]} {option}',
-                value='`░░░░░░░░░░░░░░░░░░░░` 0 票 (0.0%)',
-                inline=False
-            )
-        
-        embed.set_footer(text=f'総投票数: 0票 | 作成者: {interaction.user.display_name}')
-        
-        # Create poll view
-        view = PollView("temp", option_list)
-        
-        # Send poll
-        await interaction.followup.send(embed=embed, view=view)
-        
-        # Get message and update poll data
-        message = await interaction.original_response()
-        poll_id = str(message.id)
-        
-        # Update view with correct poll ID
-        view.poll_id = poll_id
-        await message.edit(view=view)
-        
-        # Save poll data
-        data = load_data()
-        if 'polls' not in data:
-            data['polls'] = {}
-            
-        data['polls'][poll_id] = {
+        ends_at = None
+        if duration:
+            try:
+                ends_at = time.time() + parse_duration(duration)
+            except ValueError:
+                await interaction.followup.send('❌ 時間形式が正しくありません。1以上の値で指定してください。例: 30m, 2h, 1d', ephemeral=True)
+                return
+
+        poll_data = {
             'question': question,
             'options': option_list,
             'votes': [0] * len(option_list),
             'voters': {},  # {user_id: option_index}
             'creator': interaction.user.display_name,
             'channel_id': interaction.channel.id,
-            'guild_id': interaction.guild.id
+            'guild_id': interaction.guild.id,
+            'ends_at': ends_at
         }
-        save_data(data)
+
+        # Send poll; the buttons are attached once the message ID (the poll ID) is known
+        message = await interaction.followup.send(embed=build_poll_embed(poll_data))
+        poll_id = str(message.id)
+        
+        view = PollView(poll_id, option_list)
+        await message.edit(view=view)
+        
+        # Save poll data
+        active_polls[poll_id] = poll_data
+        dirty_polls.add(poll_id)
+        flush_polls()
+        
+        # Save persistent view data; votes are routed by custom_id after a restart
+        persistent_views[f"poll_{poll_id}"] = {
+            'type': 'poll',
+            'poll_id': poll_id,
+            'guild_id': str(interaction.guild.id),
+            'channel_id': str(interaction.channel.id),
+            'message_id': poll_id
+        }
+        save_persistent_views()
+        
+        if ends_at:
+            schedule_poll_close(poll_id, ends_at)
         
         # Add XP for creating poll
         add_experience(interaction.user.id, interaction.guild.id, 20)
@@ -2506,102 +4855,371 @@ async def poll_command(interaction: discord.Interaction, question: str, options:
 
 @bot.tree.command(name='poll-results', description='投票結果を表示')
 async def poll_results_command(interaction: discord.Interaction, poll_id: str):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
+    poll_data = get_poll(poll_id)
+    if poll_data is None:
+        await interaction.response.send_message('❌ 指定された投票が見つかりません。', ephemeral=True)
         return
+    
+    await interaction.response.send_message(embed=build_poll_results_embed(poll_data))
 
+# Ticket system commands
+open_ticket_index = {}  # {guild_id: {ticket_id: user_id}}
+open_ticket_by_user = {}  # {guild_id: {user_id: ticket_id}}
+guild_ticket_ids = {}  # {guild_id: set(ticket_id)}
+ticket_index_loaded = False
+
+def ticket_key(guild_id, ticket_id):
+    """Ticket IDs are numbered per guild, so records are keyed by guild and number"""
+    return f"{guild_id}-{ticket_id}"
+
+def index_ticket(guild_id, ticket_id, ticket_data):
+    guild_id = str(guild_id)
+    ticket_id = int(ticket_id)
+    guild_ticket_ids.setdefault(guild_id, set()).add(ticket_id)
+    if ticket_data['status'] == 'open':
+        open_ticket_index.setdefault(guild_id, {})[ticket_id] = ticket_data['user_id']
+        open_ticket_by_user.setdefault(guild_id, {})[ticket_data['user_id']] = ticket_id
+        user_index.set_open_ticket(ticket_data['user_id'], guild_id, ticket_id)
+
+def unindex_open_ticket(guild_id, ticket_id):
+    guild_id = str(guild_id)
+    user_id = open_ticket_index.get(guild_id, {}).pop(int(ticket_id), None)
+    if user_id is not None and open_ticket_by_user.get(guild_id, {}).get(user_id) == int(ticket_id):
+        del open_ticket_by_user[guild_id][user_id]
+        user_index.set_open_ticket(user_id, guild_id, None)
+
+def build_ticket_index():
+    """Build the per-guild ticket index and migrate globally numbered tickets"""
+    global ticket_index_loaded
     data = load_data()
-    if 'polls' not in data or poll_id not in data['polls']:
-        await interaction.response.send_message('❌ 指定された投票が見つかりません。', ephemeral=True)
+    tickets = data.get('tickets', {})
+    counters = data.setdefault('ticket_counters', {})
+    migrated = False
+
+    for key in list(tickets.keys()):
+        ticket_data = tickets[key]
+        if '-' in key:
+            ticket_id = int(key.split('-', 1)[1])
+        else:
+            # Older tickets used one global sequence; their numbers are unique per guild too
+            ticket_id = int(key)
+            tickets[ticket_key(ticket_data['guild_id'], ticket_id)] = tickets.pop(key)
+            migrated = True
+        guild_id = ticket_data['guild_id']
+        if counters.get(guild_id, 0) < ticket_id:
+            counters[guild_id] = ticket_id
+            migrated = True
+        index_ticket(guild_id, ticket_id, ticket_data)
+
+    if migrated:
+        save_data(data)
+    ticket_index_loaded = True
+
+def ensure_ticket_index():
+    if not ticket_index_loaded:
+        build_ticket_index()
+
+def allocate_ticket_id(data, guild_id):
+    """Take the next number from the guild's counter (no await, so it is atomic on the event loop)"""
+    counters = data.setdefault('ticket_counters', {})
+    ticket_id = counters.get(str(guild_id), 0) + 1
+    counters[str(guild_id)] = ticket_id
+    stats_aggregator.record_ticket(guild_id, ticket_id)
+    return ticket_id
+
+def release_ticket_slot(guild_id, ticket_id, user_id):
+    """Free a user's open-ticket reservation if the ticket was never recorded"""
+    if ticket_id not in open_ticket_index.get(guild_id, {}):
+        if open_ticket_by_user.get(guild_id, {}).get(user_id) == ticket_id:
+            del open_ticket_by_user[guild_id][user_id]
+
+def close_ticket_record(data, guild_id, ticket_id, closed_by):
+    ticket_data = data['tickets'][ticket_key(guild_id, ticket_id)]
+    ticket_data['status'] = 'closed'
+    ticket_data['closed_at'] = datetime.now().isoformat()
+    ticket_data['closed_by'] = str(closed_by)
+    unindex_open_ticket(guild_id, ticket_id)
+
+def remove_ticket_close_view(guild_id, ticket_id):
+    """Clean up persistent view data of a closed ticket"""
+    removed = persistent_views.pop(f"ticket_close_{ticket_key(guild_id, ticket_id)}", None)
+    legacy_key = f"ticket_close_{ticket_id}"
+    if persistent_views.get(legacy_key, {}).get('guild_id') == str(guild_id):
+        removed = persistent_views.pop(legacy_key)
+    if removed is not None:
+        save_persistent_views()
+
+TICKET_ARCHIVE_DIR = 'ticket_archive'
+TICKET_RETENTION_DAYS = int(os.environ.get('TICKET_RETENTION_DAYS', 7))
+TICKET_COMPACTION_INTERVAL = 6 * 60 * 60
+TICKET_LIST_PAGE_SIZE = 10
+
+def ticket_archive_path(guild_id):
+    return os.path.join(TICKET_ARCHIVE_DIR, f"{guild_id}.jsonl")
+
+ticket_archive_offsets = {}  # {guild_id: {ticket_id: byte offset of its line in the archive}}
+
+def load_archive_offsets(guild_id):
+    """Index a guild's archive by ticket number; the file is scanned once per process"""
+    guild_id = str(guild_id)
+    offsets = ticket_archive_offsets.get(guild_id)
+    if offsets is None:
+        offsets = {}
+        path = ticket_archive_path(guild_id)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                offset = 0
+                for line in f:
+                    if line.strip():
+                        # Archives written by an interrupted compaction can repeat a ticket; the last line wins
+                        offsets[json.loads(line)['ticket_id']] = offset
+                    offset += len(line)
+        # Export and transcript lookups build this from worker threads; the first index stored wins
+        offsets = ticket_archive_offsets.setdefault(guild_id, offsets)
+    return offsets
+
+def iter_archived_tickets(guild_id, exclude=()):
+    """Yield a guild's archived tickets once each in ticket number order, skipping IDs in exclude"""
+    offsets = load_archive_offsets(guild_id)
+    if not offsets:
         return
+    with open(ticket_archive_path(guild_id), 'rb') as f:
+        for ticket_id in sorted(offsets):
+            if ticket_id in exclude:
+                continue
+            f.seek(offsets[ticket_id])
+            yield ticket_id, json.loads(f.readline())['ticket']
+
+def find_archived_ticket(guild_id, ticket_id):
+    offset = load_archive_offsets(guild_id).get(int(ticket_id))
+    if offset is None:
+        return None
+    with open(ticket_archive_path(guild_id), 'rb') as f:
+        f.seek(offset)
+        return json.loads(f.readline())['ticket']
+
+def compact_closed_tickets():
+    """Move closed tickets past the retention period out of bot_data.json into the per-guild archive"""
+    ensure_ticket_index()
+    data = load_data()
+    tickets = data.get('tickets', {})
+    cutoff = datetime.now() - timedelta(days=TICKET_RETENTION_DAYS)
+
+    expired = {}
+    for key, ticket_data in tickets.items():
+        if ticket_data['status'] != 'closed' or not ticket_data.get('closed_at'):
+            continue
+        if datetime.fromisoformat(ticket_data['closed_at']) < cutoff:
+            expired.setdefault(ticket_data['guild_id'], []).append(key)
+
+    if not expired:
+        return 0
+
+    # Append to the archive before dropping from the hot store, so a crash can never lose a ticket.
+    # Tickets already archived by an interrupted run are only dropped from the hot store.
+    os.makedirs(TICKET_ARCHIVE_DIR, exist_ok=True)
+    for guild_id, keys in expired.items():
+        keys.sort(key=lambda k: int(k.split('-', 1)[1]))
+        offsets = load_archive_offsets(guild_id)
+        with open(ticket_archive_path(guild_id), 'ab') as f:
+            for key in keys:
+                ticket_id = int(key.split('-', 1)[1])
+                if ticket_id in offsets:
+                    continue
+                offsets[ticket_id] = f.tell()
+                f.write((json.dumps({'ticket_id': ticket_id, 'ticket': tickets[key]}, ensure_ascii=False) + '\n').encode('utf-8'))
+
+    for guild_id, keys in expired.items():
+        for key in keys:
+            del tickets[key]
+            guild_ticket_ids.get(guild_id, set()).discard(int(key.split('-', 1)[1]))
+    save_data(data)
+
+    archived = sum(len(keys) for keys in expired.values())
+    print(f"Archived {archived} closed tickets older than {TICKET_RETENTION_DAYS} days")
+    return archived
+
+async def run_ticket_compaction():
+    try:
+        compact_closed_tickets()
+    finally:
+        scheduler.schedule('ticket_compaction', time.time() + TICKET_COMPACTION_INTERVAL, run_ticket_compaction)
+
+TRANSCRIPT_DIR = 'transcripts'
+
+def serialize_transcript_message(message):
+    return {
+        'id': str(message.id),
+        'author_id': str(message.author.id),
+        'author': message.author.display_name,
+        'bot': message.author.bot,
+        'content': message.content,
+        'created_at': message.created_at.isoformat(),
+        'attachments': [attachment.url for attachment in message.attachments],
+        'embeds': [embed.to_dict() for embed in message.embeds]
+    }
+
+TRANSCRIPT_WRITE_BATCH = 100  # one history() page
+
+def write_transcript_rows(f, rows):
+    f.write(''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in rows))
+
+async def export_ticket_transcript(channel, guild_id, ticket_id):
+    """Write the channel history to a gzip'd JSONL file, one message per line"""
+    os.makedirs(TRANSCRIPT_DIR, exist_ok=True)
+    path = os.path.join(TRANSCRIPT_DIR, f"{ticket_key(guild_id, ticket_id)}.jsonl.gz")
+    temp_path = path + '.tmp'
+
+    # history() fetches pages of 100; each page is encoded and compressed in a worker thread while the next is fetched
+    count = 0
+    rows = []
+    f = await worker_bridge.call('transcript_write', gzip.open, temp_path, 'wt', 9, 'utf-8')
+    try:
+        async for message in channel.history(limit=None, oldest_first=True):
+            rows.append(serialize_transcript_message(message))
+            count += 1
+            if len(rows) >= TRANSCRIPT_WRITE_BATCH:
+                await worker_bridge.call('transcript_write', write_transcript_rows, f, rows)
+                rows = []
+        if rows:
+            await worker_bridge.call('transcript_write', write_transcript_rows, f, rows)
+    finally:
+        await worker_bridge.call('transcript_write', f.close)
+    os.replace(temp_path, path)
+    return path, count
+
+async def archive_ticket_transcript(channel, guild_id, ticket_id):
+    """Export the transcript of a closing ticket and store its location in the ticket record"""
+    try:
+        path, count = await export_ticket_transcript(channel, guild_id, ticket_id)
+
+        def record_transcript(data):
+            ticket_data = data.get('tickets', {}).get(ticket_key(guild_id, ticket_id))
+            if ticket_data is None:
+                return False, None
+            ticket_data['transcript'] = path
+            ticket_data['transcript_messages'] = count
+            return True, None
+
+        await update_data(record_transcript)
+        return path
+    except Exception as e:
+        print(f"Error archiving ticket transcript {ticket_key(guild_id, ticket_id)}: {e}")
+        return None
+
+def iter_transcript_html(path, title):
+    """Render a transcript file as HTML piece by piece"""
+    import html
+    yield f'<!DOCTYPE html><html lang="ja"><head><meta charset="UTF-8"><title>{html.escape(title)}</title>'
+    yield '<style>body{font-family:sans-serif;background:#36393f;color:#dcddde}.msg{padding:6px 12px}.author{font-weight:bold;color:#fff}.time{color:#72767d;font-size:12px;margin-left:8px}.content{white-space:pre-wrap}</style></head><body>'
+    yield f'<h2>{html.escape(title)}</h2>'
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            message = json.loads(line)
+            parts = [f'<div class="msg"><span class="author">{html.escape(message["author"])}</span>',
+                     f'<span class="time">{html.escape(message["created_at"][:19])}</span>',
+                     f'<div class="content">{html.escape(message["content"])}</div>']
+            for url in message.get('attachments', []):
+                parts.append(f'<div><a href="{html.escape(url)}">{html.escape(url)}</a></div>')
+            for embed in message.get('embeds', []):
+                parts.append(f'<div class="content">[{html.escape(embed.get("title", "埋め込み"))}] {html.escape(embed.get("description", ""))}</div>')
+            parts.append('</div>')
+            yield ''.join(parts)
+    yield '</body></html>'
+
+def build_ticket_overwrites(guild, user):
+    """Permission overwrites for a new ticket channel: the creator, the bot and the staff roles"""
+    allow = discord.PermissionOverwrite(read_messages=True, send_messages=True)
+    overwrites = {
+        guild.default_role: discord.PermissionOverwrite(read_messages=False),
+        user: allow,
+        guild.me: allow
+    }
+
+    # Administrators see every channel anyway; staff are granted per role instead of per member
+    staff_roles = get_server_settings(guild.id).get('ticket_staff_roles', [])
+    if staff_roles:
+        for role in guild.roles:
+            if role.name in staff_roles:
+                overwrites[role] = allow
+    return overwrites
+
+async def close_ticket_from_button(interaction, ticket_id):
+    ensure_ticket_index()
+    data = load_data()
+    tickets = data.get('tickets', {})
+    key = ticket_key(interaction.guild.id, ticket_id)
     
-    poll_data = data['polls'][poll_id]
+    if key not in tickets:
+        await interaction.response.send_message('❌ チケットが見つかりません。', ephemeral=True)
+        return
     
-    embed = discord.Embed(
-        title=f'📊 投票結果: {poll_data["question"]}',
-        color=0x00ff00
-    )
+    ticket_data = tickets[key]
     
-    total_votes = sum(poll_data['votes'])
-    winner_index = poll_data['votes'].index(max(poll_data['votes'])) if total_votes > 0 else 0
+    # Check if user is ticket creator or admin
+    is_creator = str(interaction.user.id) == ticket_data['user_id']
+    is_admin = interaction.user.guild_permissions.administrator
     
-    for i, option in enumerate(poll_data['options']):
-        votes = poll_data['votes'][i]
-        percentage = (votes / total_votes * 100) if total_votes > 0 else 0
-        status = '🏆 ' if i == winner_index and total_votes > 0 else ''
-        
-        embed.add_field(
-            name=f'{status}{option}',
-            value=f'{votes} 票 ({percentage:.1f}%)',
-            inline=True
-        )
+    if not is_creator and not is_admin:
+        await interaction.response.send_message('❌ チケットを閉じる権限がありません。', ephemeral=True)
+        return
     
-    embed.add_field(
-        name='📈 統計',
-        value=f'**総投票数:** {total_votes}\n**投票者数:** {len(poll_data["voters"])}\n**作成者:** {poll_data["creator"]}',
-        inline=False
+    if ticket_data['status'] == 'closed':
+        await interaction.response.send_message('❌ このチケットは既に閉じられています。', ephemeral=True)
+        return
+    
+    # Update ticket status
+    close_ticket_record(data, interaction.guild.id, ticket_id, interaction.user.id)
+    save_data(data)
+    
+    # Send closure message
+    embed = discord.Embed(
+        title='🔒 チケットクローズ',
+        description=f'チケット #{ticket_id} が閉じられました。\n\n**閉じたユーザー:** {interaction.user.mention}\n**閉じた時刻:** <t:{int(datetime.now().timestamp())}:F>',
+        color=0xff0000
     )
+    embed.set_footer(text='このチャンネルは5秒後に削除されます')
     
     await interaction.response.send_message(embed=embed)
+    
+    remove_ticket_close_view(interaction.guild.id, ticket_id)
+    
+    # Keep the conversation before the channel goes away
+    await archive_ticket_transcript(interaction.channel, interaction.guild.id, ticket_id)
+    
+    # Delete channel after 5 seconds
+    import asyncio
+    await asyncio.sleep(5)
+    try:
+        await interaction.channel.delete()
+    except:
+        pass
+
+class TicketCloseButton(discord.ui.DynamicItem[discord.ui.Button], template=r'ticket_close:(?P<ticket_id>[0-9]+)'):
+    """Close button of a ticket channel; the ticket number is encoded in the custom_id"""
+    def __init__(self, ticket_id):
+        super().__init__(
+            discord.ui.Button(
+                label='🔒 チケットを閉じる',
+                style=discord.ButtonStyle.danger,
+                emoji='🔒',
+                custom_id=f"ticket_close:{ticket_id}"
+            )
+        )
+        self.ticket_id = int(ticket_id)
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match['ticket_id'])
+
+    async def callback(self, interaction):
+        await close_ticket_from_button(interaction, self.ticket_id)
 
-# Ticket system commands
 class TicketCloseView(discord.ui.View):
     def __init__(self, ticket_id):
         super().__init__(timeout=None)
         self.ticket_id = ticket_id
-
-    @discord.ui.button(label='🔒 チケットを閉じる', style=discord.ButtonStyle.danger, emoji='🔒', custom_id='close_ticket_button')
-    async def close_ticket(self, interaction: discord.Interaction, button: discord.ui.Button):
-        data = load_data()
-        tickets = data.get('tickets', {})
-        
-        if str(self.ticket_id) not in tickets:
-            await interaction.response.send_message('❌ チケットが見つかりません。', ephemeral=True)
-            return
-        
-        ticket_data = tickets[str(self.ticket_id)]
-        
-        # Check if user is ticket creator or admin
-        is_creator = str(interaction.user.id) == ticket_data['user_id']
-        is_admin = interaction.user.guild_permissions.administrator
-        
-        if not is_creator and not is_admin:
-            await interaction.response.send_message('❌ チケットを閉じる権限がありません。', ephemeral=True)
-            return
-        
-        if ticket_data['status'] == 'closed':
-            await interaction.response.send_message('❌ このチケットは既に閉じられています。', ephemeral=True)
-            return
-        
-        # Update ticket status
-        data['tickets'][str(self.ticket_id)]['status'] = 'closed'
-        data['tickets'][str(self.ticket_id)]['closed_at'] = datetime.now().isoformat()
-        data['tickets'][str(self.ticket_id)]['closed_by'] = str(interaction.user.id)
-        save_data(data)
-        
-        # Send closure message
-        embed = discord.Embed(
-            title='🔒 チケットクローズ',
-            description=f'チケット #{self.ticket_id} が閉じられました。\n\n**閉じたユーザー:** {interaction.user.mention}\n**閉じた時刻:** <t:{int(datetime.now().timestamp())}:F>',
-            color=0xff0000
-        )
-        embed.set_footer(text='このチャンネルは5秒後に削除されます')
-        
-        await interaction.response.send_message(embed=embed)
-        
-        # Clean up persistent view data
-        view_key = f"ticket_close_{self.ticket_id}"
-        if view_key in persistent_views:
-            del persistent_views[view_key]
-            save_persistent_views()
-        
-        # Delete channel after 5 seconds
-        import asyncio
-        await asyncio.sleep(5)
-        try:
-            await interaction.channel.delete()
-        except:
-            pass
+        self.add_item(TicketCloseButton(ticket_id))
 
 class TicketPanelView(discord.ui.View):
     def __init__(self, category_name=None):
@@ -2613,44 +5231,53 @@ class TicketPanelView(discord.ui.View):
         await self.create_ticket_channel(interaction)
     
     async def create_ticket_channel(self, interaction):
-        data = load_data()
+        # Acknowledge first; channel creation can take longer than the 3 second window
+        await interaction.response.defer(ephemeral=True, thinking=True)
+
+        ensure_ticket_index()
         user_id = str(interaction.user.id)
         guild_id = str(interaction.guild.id)
 
-        # Create new ticket ID
-        ticket_id = 1
-        while str(ticket_id) in data.get('tickets', {}):
-            ticket_id += 1
+        # One open ticket per user
+        existing_ticket_id = open_ticket_by_user.get(guild_id, {}).get(user_id)
+        if existing_ticket_id is not None:
+            existing = load_data().get('tickets', {}).get(ticket_key(guild_id, existing_ticket_id), {})
+            channel = interaction.guild.get_channel(int(existing.get('channel_id', 0)))
+            location = f' {channel.mention}' if channel else ''
+            await interaction.followup.send(f'❌ 既にチケット #{existing_ticket_id} が開いています。{location}', ephemeral=True)
+            return
+
+        # Reserve the ticket number and the user's open slot before any await
+        data = load_data()
+        ticket_id = allocate_ticket_id(data, guild_id)
+        save_data(data)
+        open_ticket_by_user.setdefault(guild_id, {})[user_id] = ticket_id
 
         try:
+            # After a restart one shared view serves every panel; its category comes from the panel's entry
+            category_name = self.category_name
+            if category_name is None and interaction.message:
+                category_name = persistent_views.get(f"ticket_panel_{interaction.message.id}", {}).get('category_name')
+
             # Check if category exists, create if necessary
-            if self.category_name:
-                category = discord.utils.get(interaction.guild.categories, name=self.category_name)
+            if category_name:
+                category = discord.utils.get(interaction.guild.categories, name=category_name)
                 if not category:
-                    category = await interaction.guild.create_category(self.category_name)
+                    category = await interaction.guild.create_category(category_name)
             else:
                 category = discord.utils.get(interaction.guild.categories, name="🎫 チケット")
                 if not category:
                     category = await interaction.guild.create_category("🎫 チケット")
 
-            # Create the channel with format: name-チケット
+            # Create the channel with format: name-チケット, permissions included in the same request
             channel_name = f"{interaction.user.name}-チケット"
             channel = await interaction.guild.create_text_channel(
                 name=channel_name,
                 topic=f'チケット #{ticket_id} | 作成者: {interaction.user.display_name}',
-                category=category
+                category=category,
+                overwrites=build_ticket_overwrites(interaction.guild, interaction.user)
             )
 
-            # Set channel permissions
-            await channel.set_permissions(interaction.user, read_messages=True, send_messages=True)
-            await channel.set_permissions(interaction.guild.default_role, read_messages=False)
-            await channel.set_permissions(interaction.guild.me, read_messages=True, send_messages=True)
-
-            # Add permissions for administrators
-            for member in interaction.guild.members:
-                if member.guild_permissions.administrator:
-                    await channel.set_permissions(member, read_messages=True, send_messages=True)
-
             # Send initial message
             embed = discord.Embed(
                 title=f'🎫 チケット #{ticket_id}',
@@ -2675,8 +5302,9 @@ class TicketPanelView(discord.ui.View):
             await message.pin()
             
             # Save persistent view data
-            persistent_views[f"ticket_close_{ticket_id}"] = {
+            persistent_views[f"ticket_close_{ticket_key(guild_id, ticket_id)}"] = {
                 'type': 'ticket_close',
+                'custom_id': f"ticket_close:{ticket_id}",
                 'ticket_id': ticket_id,
                 'guild_id': guild_id,
                 'channel_id': str(channel.id),
@@ -2686,10 +5314,11 @@ class TicketPanelView(discord.ui.View):
             await channel.send(f"{interaction.user.mention} へのメンション", delete_after=1)
 
             # Save ticket data
+            data = load_data()
             if 'tickets' not in data:
                 data['tickets'] = {}
 
-            data['tickets'][str(ticket_id)] = {
+            ticket_data = {
                 'user_id': user_id,
                 'guild_id': guild_id,
                 'channel_id': str(channel.id),
@@ -2697,30 +5326,36 @@ class TicketPanelView(discord.ui.View):
                 'description': 'チケット作成',
                 'status': 'open'
             }
+            data['tickets'][ticket_key(guild_id, ticket_id)] = ticket_data
             save_data(data)
+            index_ticket(guild_id, ticket_id, ticket_data)
 
             # Send confirmation
-            await interaction.response.send_message(f'✅ チケット #{ticket_id} を作成しました！ {channel.mention} で詳細を確認してください。', ephemeral=True)
+            await interaction.followup.send(f'✅ チケット #{ticket_id} を作成しました！ {channel.mention} で詳細を確認してください。', ephemeral=True)
 
         except discord.Forbidden:
-            await interaction.response.send_message('❌ チャンネルを作成する権限がありません。', ephemeral=True)
+            release_ticket_slot(guild_id, ticket_id, user_id)
+            await interaction.followup.send('❌ チャンネルを作成する権限がありません。', ephemeral=True)
         except Exception as e:
-            await interaction.response.send_message(f'❌ チケットの作成に失敗しました: {str(e)}', ephemeral=True)
+            release_ticket_slot(guild_id, ticket_id, user_id)
+            await interaction.followup.send(f'❌ チケットの作成に失敗しました: {str(e)}', ephemeral=True)
 
 @bot.tree.command(name='ticket-panel', description='チケット作成パネルを設置')
-async def ticket_panel(interaction: discord.Interaction, category_name: str = None):
+async def ticket_panel(interaction: discord.Interaction, category_name: str = None, staff_role: discord.Role = None):
     try:
         # Immediately defer the response
         await interaction.response.defer()
         
-        if not is_allowed_server(interaction.guild.id):
-            await interaction.followup.send('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-            return
-
         if not interaction.user.guild_permissions.manage_channels:
             await interaction.followup.send('❌ チャンネル管理権限が必要です。', ephemeral=True)
             return
 
+        if staff_role:
+            guild_settings = get_server_settings(interaction.guild.id)
+            if staff_role.name not in guild_settings['ticket_staff_roles']:
+                guild_settings['ticket_staff_roles'].append(staff_role.name)
+                save_server_settings()
+
         embed = discord.Embed(
             title='🎫 サポートチケット',
             description='サポートが必要な場合は、下のボタンをクリックしてチケットを作成してください。\n\n'
@@ -2761,24 +5396,37 @@ async def ticket_panel(interaction: discord.Interaction, category_name: str = No
             pass
 
 @bot.tree.command(name='ticket-list', description='チケット一覧を表示')
-async def ticket_list(interaction: discord.Interaction, status: str = "all"):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
-
+async def ticket_list(interaction: discord.Interaction, status: str = "all", page: int = 1):
     if not interaction.user.guild_permissions.manage_messages:
         await interaction.response.send_message('❌ メッセージ管理権限が必要です。', ephemeral=True)
         return
 
+    ensure_ticket_index()
     data = load_data()
     tickets = data.get('tickets', {})
+    guild_id = str(interaction.guild.id)
 
-    # Filter tickets by guild and status
-    guild_tickets = []
-    for ticket_id, ticket_data in tickets.items():
-        if ticket_data['guild_id'] == str(interaction.guild.id):
-            if status == "all" or ticket_data['status'] == status:
-                guild_tickets.append((ticket_id, ticket_data))
+    # Only this guild's tickets are visited, via the index
+    if status == "open":
+        ticket_ids = open_ticket_index.get(guild_id, {}).keys()
+    else:
+        ticket_ids = guild_ticket_ids.get(guild_id, set())
+
+    def iter_guild_tickets():
+        # Old open tickets stay in the hot store, so both sources are merged by ticket number
+        sources = [((ticket_id, tickets.get(ticket_key(guild_id, ticket_id))) for ticket_id in sorted(ticket_ids))]
+        if status != "open":
+            sources.append(iter_archived_tickets(guild_id, exclude=guild_ticket_ids.get(guild_id, set())))
+        for ticket_id, ticket_data in heapq.merge(*sources, key=lambda item: item[0]):
+            if ticket_data and (status == "all" or ticket_data['status'] == status):
+                yield ticket_id, ticket_data
+
+    # Read only up to the requested page (plus one to know whether another page follows)
+    page = max(page, 1)
+    start = (page - 1) * TICKET_LIST_PAGE_SIZE
+    guild_tickets = list(itertools.islice(iter_guild_tickets(), start, start + TICKET_LIST_PAGE_SIZE + 1))
+    has_next = len(guild_tickets) > TICKET_LIST_PAGE_SIZE
+    guild_tickets = guild_tickets[:TICKET_LIST_PAGE_SIZE]
 
     if not guild_tickets:
         await interaction.response.send_message('❌ 該当するチケットが見つかりません。', ephemeral=True)
@@ -2786,11 +5434,11 @@ async def ticket_list(interaction: discord.Interaction, status: str = "all"):
 
     embed = discord.Embed(
         title=f'🎫 チケット一覧 ({status})',
-        description=f'サーバー内のチケット: {len(guild_tickets)}件',
+        description=f'ページ {page} (#{start + 1}〜#{start + len(guild_tickets)}件目)',
         color=0x0099ff
     )
 
-    for ticket_id, ticket_data in guild_tickets[:10]:  # Show max 10 tickets
+    for ticket_id, ticket_data in guild_tickets:
         user = interaction.guild.get_member(int(ticket_data['user_id']))
         user_name = user.display_name if user else 'ユーザーが見つかりません'
 
@@ -2801,49 +5449,45 @@ async def ticket_list(interaction: discord.Interaction, status: str = "all"):
             inline=True
         )
 
-    if len(guild_tickets) > 10:
-        embed.set_footer(text=f'表示: 10/{len(guild_tickets)}件')
+    if has_next:
+        embed.set_footer(text=f'次のページ: /ticket-list status:{status} page:{page + 1}')
 
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 @bot.tree.command(name='close-ticket', description='チケットを強制的に閉じる')
 async def close_ticket_command(interaction: discord.Interaction, ticket_id: int):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
-
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message('❌ 管理者権限が必要です。', ephemeral=True)
         return
 
+    ensure_ticket_index()
     data = load_data()
     tickets = data.get('tickets', {})
+    key = ticket_key(interaction.guild.id, ticket_id)
 
-    if str(ticket_id) not in tickets:
+    # Ticket numbers are per guild, so a ticket of another guild can never match here
+    if key not in tickets:
         await interaction.response.send_message('❌ 指定されたチケットが見つかりません。', ephemeral=True)
         return
 
-    ticket_data = tickets[str(ticket_id)]
-
-    if ticket_data['guild_id'] != str(interaction.guild.id):
-        await interaction.response.send_message('❌ このサーバーのチケットではありません。', ephemeral=True)
-        return
+    ticket_data = tickets[key]
 
     if ticket_data['status'] == 'closed':
         await interaction.response.send_message('❌ このチケットは既に閉じられています。', ephemeral=True)
         return
 
     # Update ticket status
-    data['tickets'][str(ticket_id)]['status'] = 'closed'
-    data['tickets'][str(ticket_id)]['closed_at'] = datetime.now().isoformat()
-    data['tickets'][str(ticket_id)]['closed_by'] = str(interaction.user.id)
+    close_ticket_record(data, interaction.guild.id, ticket_id, interaction.user.id)
     save_data(data)
+    remove_ticket_close_view(interaction.guild.id, ticket_id)
 
     # Try to find and delete the channel
     channel_id = ticket_data.get('channel_id')
     if channel_id:
         channel = interaction.guild.get_channel(int(channel_id))
         if channel:
+            await interaction.response.defer(ephemeral=True)
+            await archive_ticket_transcript(channel, interaction.guild.id, ticket_id)
             try:
                 await channel.delete()
             except:
@@ -2854,15 +5498,14 @@ async def close_ticket_command(interaction: discord.Interaction, ticket_id: int)
         description=f'チケット #{ticket_id} を強制的に閉じました。',
         color=0x00ff00
     )
-    await interaction.response.send_message(embed=embed, ephemeral=True)
+    if interaction.response.is_done():
+        await interaction.followup.send(embed=embed, ephemeral=True)
+    else:
+        await interaction.response.send_message(embed=embed, ephemeral=True)
 
 # Server logging commands
 @bot.tree.command(name='setup-server-log', description='サーバー間ログ転送を設定')
 async def setup_server_log(interaction: discord.Interaction, target_server_id: str, channel_id: str = None):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
-
     if not interaction.user.guild_permissions.manage_guild:
         await interaction.response.send_message('❌ サーバー管理権限が必要です。', ephemeral=True)
         return
@@ -2924,10 +5567,6 @@ async def setup_server_log(interaction: discord.Interaction, target_server_id: s
 
 @bot.tree.command(name='server-log-status', description='サーバーログ設定状況を確認')
 async def server_log_status(interaction: discord.Interaction):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
-
     source_guild_id = str(interaction.guild.id)
     
     embed = discord.Embed(
@@ -3111,10 +5750,6 @@ async def send_interval_meigen(guild_id, channel_id, interval_seconds):
 # Delete command
 @bot.tree.command(name='delete', description='指定した数のメッセージを削除')
 async def delete_messages(interaction: discord.Interaction, count: int, user: discord.Member = None):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
-
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message('❌ 管理者権限が必要です。', ephemeral=True)
         return
@@ -3207,10 +5842,6 @@ async def send_scheduled_message(guild_id, channel_id, message_content, interval
 
 @bot.tree.command(name='setmessage', description='指定した時間間隔でメッセージを定期送信')
 async def setmessage_command(interaction: discord.Interaction, message: str, interval: str, everyone: str = "no"):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
-
     if not interaction.user.guild_permissions.manage_messages:
         await interaction.response.send_message('❌ メッセージ管理権限が必要です。', ephemeral=True)
         return
@@ -3317,10 +5948,6 @@ async def setmessage_command(interaction: discord.Interaction, message: str, int
 
 @bot.tree.command(name='stopmessage', description='定期メッセージ送信を停止')
 async def stopmessage_command(interaction: discord.Interaction):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
-
     if not interaction.user.guild_permissions.manage_messages:
         await interaction.response.send_message('❌ メッセージ管理権限が必要です。', ephemeral=True)
         return
@@ -3351,10 +5978,6 @@ async def stopmessage_command(interaction: discord.Interaction):
 
 @bot.tree.command(name='messagestatus', description='定期メッセージの設定状況を確認')
 async def messagestatus_command(interaction: discord.Interaction):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
-
     guild_id = str(interaction.guild.id)
     
     # Find all scheduled messages for this guild
@@ -3422,10 +6045,6 @@ async def messagestatus_command(interaction: discord.Interaction):
 # Meigen channel setting command
 @bot.tree.command(name='meigen_channel_setting', description='名言を指定間隔で送信するチャンネルを設定')
 async def meigen_channel_setting(interaction: discord.Interaction, interval: str = "1h"):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
-
     if not interaction.user.guild_permissions.manage_guild:
         await interaction.response.send_message('❌ サーバー管理権限が必要です。', ephemeral=True)
         return
@@ -3533,8 +6152,8 @@ COMMAND_HELP = {
     },
     'giveaway': {
         'description': 'Giveawayを開始',
-        'usage': '/giveaway <景品>',
-        'details': '指定した景品でGiveawayを開始します。時間は1h, 3h, 5h, 24h, 48hから選択できます。参加者はボタンをクリックして参加できます。メッセージ管理権限が必要です。'
+        'usage': '/giveaway <景品> [当選者数]',
+        'details': '指定した景品でGiveawayを開始します。時間は1h, 3h, 5h, 24h, 48hから選択できます。参加者はボタンをクリックして参加できます。終了時刻になると自動で当選者（既定1人、最大20人）が抽選されます。Bot再起動後も継続されます。メッセージ管理権限が必要です。'
     },
 
     'set-join-leave-channel': {
@@ -3565,13 +6184,13 @@ COMMAND_HELP = {
     },
     'ticket-panel': {
         'description': 'チケット作成パネルを設置',
-        'usage': '/ticket-panel [カテゴリー名]',
-        'details': 'チケット作成パネルを設置します。カテゴリー名を指定すると、作成されるチケットチャンネルが特定のカテゴリーに分類されます。チャンネル管理権限が必要です。'
+        'usage': '/ticket-panel [カテゴリー名] [スタッフロール]',
+        'details': 'チケット作成パネルを設置します。カテゴリー名を指定すると、作成されるチケットチャンネルが特定のカテゴリーに分類されます。スタッフロールを指定すると、そのロールがチケットチャンネルを閲覧・対応できるようになります。チャンネル管理権限が必要です。'
     },
     'ticket-list': {
         'description': 'チケット一覧を表示',
-        'usage': '/ticket-list [状態]',
-        'details': 'チケットの一覧を表示します。状態を指定すると、特定の状態のチケットのみを表示します（例: open, closed）。メッセージ管理権限が必要です。'
+        'usage': '/ticket-list [状態] [ページ]',
+        'details': 'チケットの一覧を表示します。状態を指定すると、特定の状態のチケットのみを表示します（例: open, closed）。一定期間が経過した閉じたチケットはアーカイブに移され、closed/all ではアーカイブも含めて10件ずつページ表示します。メッセージ管理権限が必要です。'
     },
     'close-ticket': {
         'description': 'チケットを強制的に閉じる',
@@ -3580,8 +6199,8 @@ COMMAND_HELP = {
     },
     'poll': {
         'description': '投票を作成',
-        'usage': '/poll <質問> <選択肢1,選択肢2,選択肢3...>',
-        'details': '投票を作成します。選択肢はカンマで区切って入力してください。最大10個まで設定可能です。投票作成で20XP、投票参加で10XPを獲得できます。'
+        'usage': '/poll <質問> <選択肢1,選択肢2,選択肢3...> [期間]',
+        'details': '投票を作成します。選択肢はカンマで区切って入力してください。最大10個まで設定可能です。期間を30m（分）、2h（時間）、1d（日）の形式で指定すると、期間終了時に自動で締め切られ最終結果が表示されます。投票作成で20XP、投票参加で10XPを獲得できます。'
     },
     'poll-results': {
         'description': '投票結果を表示',
@@ -3637,10 +6256,6 @@ COMMAND_HELP = {
 
 @bot.tree.command(name='online_check', description='ボットのオンライン状態を確認')
 async def online_check(interaction: discord.Interaction):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
-
     # Get bot uptime
     uptime_seconds = (datetime.now() - bot_start_time).total_seconds()
     uptime_hours = int(uptime_seconds // 3600)
@@ -3680,7 +6295,7 @@ async def online_check(interaction: discord.Interaction):
 async def bot_link_command(ctx):
     """Show invite links for all servers the bot is in"""
     if not is_allowed_server(ctx.guild.id):
-        await ctx.send('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq')
+        await ctx.send(PURCHASE_MESSAGE)
         return
 
     if not ctx.author.guild_permissions.administrator:
@@ -3791,10 +6406,6 @@ async def bot_link_command(ctx):
 
 @bot.tree.command(name='help', description='ヘルプを表示')
 async def help_command(interaction: discord.Interaction, command: str = None):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
-
     if command is None:
         # Show all commands
         embed = discord.Embed(
@@ -3839,7 +6450,7 @@ def run_bot():
         print('DISCORD_TOKEN環境変数が設定されていません。')
         return
     print("Starting Discord bot...")
-    bot.run(token)
+    asyncio.run(run_services(token))
 
 server_log_configs = {}
 
@@ -4003,9 +6614,6 @@ async def execute_time_nuke(guild_id, channel_id, interval_seconds):
 
 @bot.tree.command(name='timenuke', description='指定した時間間隔でチャンネルを定期的にnuke')
 async def timenuke_command(interaction: discord.Interaction, interval: str):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message('❌ 管理者権限が必要です。', ephemeral=True)
         return
@@ -4060,9 +6668,6 @@ async def timenuke_command(interaction: discord.Interaction, interval: str):
 
 @bot.tree.command(name='stop-timenuke', description='定期nukeを停止')
 async def stop_timenuke_command(interaction: discord.Interaction):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message('❌ 管理者権限が必要です。', ephemeral=True)
         return
@@ -4102,19 +6707,19 @@ def add_user_warning(user_id, guild_id, reason, moderator_id):
     if user_key not in data['warnings'][guild_key]:
         data['warnings'][guild_key][user_key] = {'count': 0, 'history': []}
     data['warnings'][guild_key][user_key]['count'] += 1
+    warned_at = datetime.now()
     data['warnings'][guild_key][user_key]['history'].append({
         'reason': reason,
         'moderator_id': str(moderator_id),
-        'timestamp': datetime.now().isoformat()
+        'timestamp': warned_at.isoformat()
     })
     save_data(data)
+    stats_aggregator.record_warning(guild_id, user_id, data['warnings'][guild_key][user_key]['count'], warned_at)
+    user_index.set_warnings(user_key, guild_key, data['warnings'][guild_key][user_key]['count'])
     return data['warnings'][guild_key][user_key]['count']
 
 @bot.tree.command(name='warn', description='ユーザーに警告を与える')
 async def warn_user(interaction: discord.Interaction, user: discord.Member, reason: str = "規則違反"):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
     if not interaction.user.guild_permissions.manage_messages:
         await interaction.response.send_message('❌ メッセージ管理権限が必要です。', ephemeral=True)
         return
@@ -4167,10 +6772,6 @@ async def warn_user(interaction: discord.Interaction, user: discord.Member, reas
 
 @bot.tree.command(name='warnings', description='ユーザーの警告履歴を表示')
 async def show_warnings(interaction: discord.Interaction, user: discord.Member):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
-
     if not interaction.user.guild_permissions.manage_messages:
         await interaction.response.send_message('❌ メッセージ管理権限が必要です。', ephemeral=True)
         return
@@ -4206,10 +6807,6 @@ async def show_warnings(interaction: discord.Interaction, user: discord.Member):
 # Temporary mute command
 @bot.tree.command(name='tempmute', description='ユーザーを一時的にミュート')
 async def temp_mute(interaction: discord.Interaction, user: discord.Member, duration: str, reason: str = "規則違反"):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
-
     if not interaction.user.guild_permissions.moderate_members:
         await interaction.response.send_message('❌ メンバータイムアウト権限が必要です。', ephemeral=True)
         return
@@ -4370,8 +6967,8 @@ async def use_bot_command(interaction: discord.Interaction, server_id: str):
             await interaction.followup.send('❌ 無効なサーバーIDです。数字のみを入力してください。', ephemeral=True)
             return
 
-        # Check if server ID is already in allowed list
-        if target_server_id in ALLOWED_SERVERS:
+        # Add server to allowed list (persisted); False means it was already there
+        if not allowlist.add(target_server_id):
             target_guild = bot.get_guild(target_server_id)
             guild_name = target_guild.name if target_guild else f'サーバーID: {server_id}'
             
@@ -4383,9 +6980,6 @@ async def use_bot_command(interaction: discord.Interaction, server_id: str):
             await interaction.followup.send(embed=embed, ephemeral=True)
             return
 
-        # Add server to allowed list
-        ALLOWED_SERVERS.append(target_server_id)
-
         # Get server info for display
         target_guild = bot.get_guild(target_server_id)
         if target_guild:
@@ -4421,13 +7015,13 @@ async def use_bot_command(interaction: discord.Interaction, server_id: str):
                 inline=False
             )
 
-        embed.set_footer(text=f'許可者: {interaction.user.display_name} | 総許可サーバー数: {len(ALLOWED_SERVERS)}')
+        embed.set_footer(text=f'許可者: {interaction.user.display_name} | 総許可サーバー数: {len(allowlist)}')
 
         await interaction.followup.send(embed=embed, ephemeral=True)
 
         # Log the action
-        print(f"Server {server_id} ({guild_name}) added to ALLOWED_SERVERS by {interaction.user.display_name}")
-        print(f"Current ALLOWED_SERVERS: {ALLOWED_SERVERS}")
+        print(f"Server {server_id} ({guild_name}) added to the allowlist by {interaction.user.display_name}")
+        print(f"Current allowlist: {allowlist.to_list()}")
 
     except Exception as e:
         print(f"Error in use_bot command: {e}")
@@ -4444,10 +7038,6 @@ async def use_botlink_command(interaction: discord.Interaction, server_links: st
     try:
         await interaction.response.defer()
         
-        if not is_allowed_server(interaction.guild.id):
-            await interaction.followup.send('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-            return
-
         # Check if user is mume_dayo
         if interaction.user.name != 'mume_dayo' and interaction.user.display_name != 'mume_dayo':
             await interaction.followup.send('❌ このコマンドは mume_dayo のみが使用できます。', ephemeral=True)
@@ -4638,10 +7228,6 @@ class SupportResponseView(discord.ui.View):
 
 @bot.tree.command(name='support-request', description='サポートを要請')
 async def support_request(interaction: discord.Interaction, content: str):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
-
     support_channel = discord.utils.get(interaction.guild.text_channels, name="サポート要請")
     if not support_channel:
         try:
@@ -4663,12 +7249,43 @@ async def support_request(interaction: discord.Interaction, content: str):
     
     await interaction.response.send_message('✅ サポート要請を送信しました。対応者が決まり次第、DMでご連絡します。', ephemeral=True)
 
-@bot.tree.command(name='allmessage', description='サーバーの全メッセージを指定したサーバーにコピー')
-async def allmessage_command(interaction: discord.Interaction, target_server_id: str, channel_id: str = None):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
+@bot.tree.command(name='perf', description='コマンドごとの処理時間とAPI呼び出し回数を表示')
+@discord.app_commands.choices(sort=[
+    discord.app_commands.Choice(name='処理時間 (p95)', value='time'),
+    discord.app_commands.Choice(name='API呼び出し回数', value='rest'),
+    discord.app_commands.Choice(name='初回応答までの時間 (p95)', value='first_response')
+])
+async def perf_command(interaction: discord.Interaction, sort: str = 'time'):
+    if interaction.user.name != 'mume_dayo' and interaction.user.display_name != 'mume_dayo':
+        await interaction.response.send_message('❌ このコマンドは mume_dayo のみが使用できます。', ephemeral=True)
+        return
+
+    rows = command_perf.summary(sort)
+    if not rows:
+        await interaction.response.send_message('📭 まだ計測データがありません。', ephemeral=True)
         return
 
+    embed = discord.Embed(
+        title='⏱️ コマンドパフォーマンス',
+        description=f'直近{PERF_WINDOW}回までの実行から集計 (上位10件)',
+        color=0x0099ff
+    )
+    for row in rows[:10]:
+        first_response = f"{row['first_response_p95_ms']:.0f}ms" if row['first_response_p95_ms'] is not None else '-'
+        embed.add_field(
+            name=row['command'] if row['command'].startswith('!') else f"/{row['command']}",
+            value=(
+                f"**処理時間:** p50 {row['p50_ms']:.0f}ms / p95 {row['p95_ms']:.0f}ms\n"
+                f"**初回応答:** p95 {first_response}\n"
+                f"**API呼び出し:** 平均 {row['rest_avg']:.1f}回 / 最大 {row['rest_max']}回\n"
+                f"**実行回数:** {row['count']}回 (エラー {row['errors']}回)"
+            ),
+            inline=False
+        )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name='allmessage', description='サーバーの全メッセージを指定したサーバーにコピー')
+async def allmessage_command(interaction: discord.Interaction, target_server_id: str, channel_id: str = None):
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message('❌ 管理者権限が必要です。', ephemeral=True)
         return
@@ -4862,10 +7479,6 @@ async def allmessage_command(interaction: discord.Interaction, target_server_id:
 
 @bot.tree.command(name='allmember', description='指定したロールをサーバーの全メンバーに付与')
 async def allmember_command(interaction: discord.Interaction, role: discord.Role):
-    if not is_allowed_server(interaction.guild.id):
-        await interaction.response.send_message('❌ m.m.botを購入してください　https://discord.gg/5kwyPgd5fq', ephemeral=True)
-        return
-
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message('❌ 管理者権限が必要です。', ephemeral=True)
         return
@@ -5211,7 +7824,7 @@ COMMAND_HELP.update({
     'use_bot': {
         'description': '指定したサーバーでBotを使用可能にする',
         'usage': '/use_bot <サーバーID>',
-        'details': '指定されたサーバーIDをALLOWED_SERVERSリストに追加し、そのサーバーでBotの全機能を使用できるようにします。このコマンドはmume_dayoのみが使用できます。'
+        'details': '指定されたサーバーIDを許可リストに追加し（再起動後も保持されます）、そのサーバーでBotの全機能を使用できるようにします。このコマンドはmume_dayoのみが使用できます。'
     },
     'use_botlink': {
         'description': 'サーバーリンク認証システムを設置',
@@ -5222,21 +7835,18 @@ COMMAND_HELP.update({
         'description': '指定したサーバーからBotを退出させる',
         'usage': '/leave_bot <サーバーID>',
         'details': '指定されたサーバーIDからBotを強制的に退出させます。サーバー情報と退出日時が記録され、現在の参加サーバー数も更新されます。このコマンドはmume_dayoのみが使用できます。'
+    },
+    'perf': {
+        'description': 'コマンドごとの処理時間とAPI呼び出し回数を表示',
+        'usage': '/perf [並び順]',
+        'details': '直近の実行からコマンドごとの処理時間 (p50/p95)、初回応答 (defer/送信) までの時間、1回あたりのAPI呼び出し回数を集計し、上位10件を表示します。このコマンドはmume_dayoのみが使用できます。'
     }
 })
 if __name__ == '__main__':
-    # Start Flask server in a separate thread
-    flask_thread = Thread(target=run_flask)
-    flask_thread.daemon = True
-    flask_thread.start()
-
-    port = int(os.environ.get('PORT', 5000))
-    print(f"Flask server started on port {port}")
-
-    # Start Discord bot
+    # The admin HTTP server and the Discord bot share one event loop
     token = os.getenv('DISCORD_TOKEN')
     if not token:
         print('DISCORD_TOKEN環境変数が設定されていません。')
         exit(1)
 
-    bot.run(token)
+    asyncio.run(run_services(token))
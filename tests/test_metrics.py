@@ -0,0 +1,98 @@
+"""Render the /metrics registry and parse the output as a Prometheus scraper would.
+
+main.py connects to Discord on import, so only the metric definitions are loaded from it.
+"""
+import ast
+import bisect
+import pathlib
+import re
+
+MAIN = pathlib.Path(__file__).resolve().parent.parent / 'main.py'
+METRIC_DEFINITIONS = {'LATENCY_BUCKETS', 'format_metric_labels', 'MetricCounter', 'MetricHistogram', 'MetricGauge', 'MetricsRegistry'}
+
+SAMPLE_PATTERN = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+LABEL_PATTERN = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"(?:,|$)')
+
+
+def load_metrics():
+    tree = ast.parse(MAIN.read_text(encoding='utf-8'))
+    nodes = []
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)) and node.name in METRIC_DEFINITIONS:
+            nodes.append(node)
+        elif isinstance(node, ast.Assign) and any(getattr(target, 'id', None) in METRIC_DEFINITIONS for target in node.targets):
+            nodes.append(node)
+    namespace = {'bisect': bisect}
+    exec(compile(ast.Module(nodes, []), str(MAIN), 'exec'), namespace)
+    return namespace
+
+
+def unescape(value):
+    return re.sub(r'\\(.)', lambda match: '\n' if match.group(1) == 'n' else match.group(1), value)
+
+
+def parse_exposition(text):
+    """Return {family: {'type', 'help', 'samples': [(name, labels, value)]}}, checking the format on the way"""
+    assert text.endswith('\n')
+    families = {}
+    family = None
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            family, help_text = line[7:].split(' ', 1)
+            families[family] = {'help': help_text, 'samples': []}
+        elif line.startswith('# TYPE '):
+            name, kind = line[7:].split(' ', 1)
+            assert kind in ('counter', 'gauge', 'histogram')
+            families[name]['type'] = kind
+        else:
+            match = SAMPLE_PATTERN.match(line)
+            assert match, line
+            name, label_text, value = match.groups()
+            labels = {}
+            if label_text:
+                pairs = LABEL_PATTERN.findall(label_text)
+                assert ','.join(f'{key}="{raw}"' for key, raw in pairs) == label_text, line
+                labels = {key: unescape(raw) for key, raw in pairs}
+            assert family is not None and name.startswith(family), line
+            families[family]['samples'].append((name, labels, float(value)))
+    return families
+
+
+def test_render_parses_as_exposition_format():
+    namespace = load_metrics()
+    registry = namespace['MetricsRegistry']()
+    requests = registry.register(namespace['MetricCounter']('bot_requests_total', 'Requests', ('route',)))
+    latency = registry.register(namespace['MetricHistogram']('bot_request_seconds', 'Request time', ('route',), (0.1, 1)))
+    registry.register(namespace['MetricGauge']('bot_guilds', 'Guilds', lambda: 3))
+
+    route = 'say "hi"\\\nnow'
+    requests.inc(route)
+    requests.inc(route, amount=2)
+    for value in (0.05, 0.1, 0.5, 4):
+        latency.observe(value, route)
+
+    families = parse_exposition(registry.render())
+
+    assert families['bot_requests_total']['type'] == 'counter'
+    assert families['bot_requests_total']['samples'] == [('bot_requests_total', {'route': route}, 3.0)]
+    assert families['bot_guilds']['type'] == 'gauge'
+    assert families['bot_guilds']['samples'] == [('bot_guilds', {}, 3.0)]
+
+    histogram = families['bot_request_seconds']
+    assert histogram['type'] == 'histogram'
+    buckets = [(labels['le'], value) for name, labels, value in histogram['samples'] if name == 'bot_request_seconds_bucket']
+    assert buckets == [('0.1', 2.0), ('1', 3.0), ('+Inf', 4.0)]
+    totals = {name: value for name, labels, value in histogram['samples'] if name != 'bot_request_seconds_bucket'}
+    assert totals == {'bot_request_seconds_sum': 4.65, 'bot_request_seconds_count': 4.0}
+
+
+def test_failing_gauge_does_not_break_the_scrape():
+    namespace = load_metrics()
+    registry = namespace['MetricsRegistry']()
+    registry.register(namespace['MetricGauge']('bot_broken', 'Raises', lambda: 1 / 0))
+    registry.register(namespace['MetricGauge']('bot_guilds', 'Guilds', lambda: 2))
+
+    families = parse_exposition(registry.render())
+
+    assert families['bot_broken']['samples'] == []
+    assert families['bot_guilds']['samples'] == [('bot_guilds', {}, 2.0)]